@@ -8,6 +8,7 @@ import fs from "fs";
 import multer from 'multer';
 import cors from 'cors';
 import { spawn } from 'child_process'
+import readline from 'readline';
 import dotenv from 'dotenv';
 dotenv.config();
 
@@ -20,6 +21,13 @@ const PORT = process.env.PORT || 3000;
 // Google Maps APIキーを取得
 const GOOGLE_MAPS_API_KEY = process.env.GOOGLE_MAPS_API_KEY;
 
+// Pythonワーカーの起動 (spawn から "Worker ready" まで) にかけてよい時間 (ミリ秒)
+// scripts/startup_profile.py と同じ値を使う
+const STARTUP_BUDGET_MS = Number(process.env.STARTUP_BUDGET_MS || 600);
+
+// Pythonワーカーの1ジョブを待つ上限 (ミリ秒)。超えたらそのジョブだけ失敗扱いにする
+const PY_JOB_TIMEOUT_MS = Number(process.env.PY_JOB_TIMEOUT_MS || 120000);
+
 // ----------------------------------------
 // 2. 初期ミドルウェアと設定
 // ----------------------------------------
@@ -62,9 +70,9 @@ app.post('/api/upload', upload.array('photos', 10), async (req, res) => {
         // ここではまだ decideEffects は呼ばない
         const imageProcessingPromises = req.files.map(async file => {
             const processedResult = await processImage(file, path, __dirname);
-            // processedResult = { filepath, date_time, location, temp_path }
+            // processedResult = { filepath, renditions, date_time, location, temp_path }
             
-            resultsImageUrls.push(path.join('public', processedResult.filepath));
+            resultImagePaths(processedResult).forEach(url => resultsImageUrls.push(path.join('public', url)));
             return processedResult;
         });
 
@@ -93,18 +101,28 @@ app.post('/api/upload', upload.array('photos', 10), async (req, res) => {
             };
         });
         
+        // [Step 4] 撮影日時と位置から旅程 (mock_data.json と同じ trip_title / timeline の形) を組み立てる
+        // 旅程が作れなくても画像の結果は返せるので、失敗しても全体エラーにはしない
+        let trip = {};
+        try {
+            trip = await buildTimeline(results);
+        } catch (error) {
+            console.error('旅程の作成に失敗しました:', error);
+        }
+
         // ⭐️ 処理後の画像URLのリストをJSONデータとして格納
         const resultData = {
             id: resultId,
             timestamp: new Date().toISOString(),
             fileCount: results.length,
-            imageData: results
+            imageData: results,
+            ...trip     // trip_title, timeline, summary, unplaced
         };
 
         // uploads/ の一時ファイルを削除
         if (req.files) {
             req.files.forEach(file => {
-                cleanupSingleFile(file.path); 
+                cleanupUploadFile(file.path);
             });
         }
         
@@ -126,7 +144,7 @@ app.post('/api/upload', upload.array('photos', 10), async (req, res) => {
         // エラー時のクリーンアップ処理
         if (req.files) {
             req.files.forEach(file => {
-                cleanupSingleFile(file.path); 
+                cleanupUploadFile(file.path);
             });
         }
         
@@ -180,7 +198,7 @@ app.delete('/api/results/:id', (req, res) => {
         const results = JSON.parse(data);
         const imageUrls = [];
         for (const imageData of results.imageData) {
-            imageUrls.push(imageData.filepath);
+            imageUrls.push(...resultImagePaths(imageData));
         }
 
         imageUrls.forEach(url => {
@@ -212,114 +230,156 @@ app.get("/", (req, res) => {
 // ユーティリティ関数
 // *******************************************************************
 
-// 単一ファイルを処理
-function processImage(file, pathModule, dirname) {
-    return new Promise((resolve, reject) => {
-        const tempFilePath = file.path;
-        const originalName = file.originalname;
-        const outputDir = pathModule.join(dirname, 'public', 'results', 'images');
-        const resultId = Date.now().toString();
-
-        if (!fs.existsSync(outputDir)) {
-            fs.mkdirSync(outputDir, { recursive: true });
-        }
-        
-        const pythonProcess = spawn('python3', [
-            './scripts/process_image.py',
-            tempFilePath,
-            outputDir,
-            resultId,
-            originalName
-        ]);
-
-        let pythonOutput = '';
-        pythonProcess.stdout.on('data', (data) => {
-            pythonOutput += data.toString();
-            console.log(`[Python ProcessImage STDOUT]: ${pythonOutput}`);
-        });
+// 常駐Pythonワーカー
+// 1プロセスを使い回し、stdin/stdout の NDJSON でジョブをやり取りする。
+// (画像ごとに python3 を起動すると import と TLS 接続のコストが毎回かかるため)
+class PythonWorker {
+    constructor(name, scriptPath) {
+        this.name = name;
+        this.scriptPath = scriptPath;
+        this.process = null;
+        this.nextId = 1;
+        this.pending = new Map(); // id -> { resolve, reject, timer }
+    }
 
-        let pythonErrorOutput = '';
-        pythonProcess.stderr.on('data', (data) => {
-            pythonErrorOutput += data.toString();
-            console.error(`[Python ProcessImage STDERR]: ${pythonErrorOutput}`);
-        });
+    start() {
+        const proc = spawn('python3', [this.scriptPath, '--worker']);
+        this.process = proc;
+        const spawnedAt = Date.now();
 
-        pythonProcess.on('error', (err) => {
-            console.error('Pythonプロセス起動エラー:', err);
-            cleanupSingleFile(tempFilePath);
-            reject(new Error('Pythonプロセス起動に失敗。'));
+        readline.createInterface({ input: proc.stdout }).on('line', (line) => {
+            if (!line.trim()) return;
+            let message;
+            try {
+                message = JSON.parse(line);
+            } catch (e) {
+                console.error(`[Python ${this.name} STDOUT] 解析できない出力: ${line}`);
+                return;
+            }
+            const job = this.pending.get(message.id);
+            if (!job) return;
+            this.pending.delete(message.id);
+            clearTimeout(job.timer);
+            if (message.ok) {
+                job.resolve(message.result);
+            } else {
+                job.reject(new Error(`${this.name} 処理エラー: ${message.error}`));
+            }
         });
 
-        pythonProcess.on('close', (code) => {
-            if (code !== 0) {
-                const errorMsg = `Python実行エラー (Code ${code}): ${pythonErrorOutput.substring(0, 100)}...`;
-                console.error(errorMsg);
-                reject(new Error(errorMsg));
+        readline.createInterface({ input: proc.stderr }).on('line', (line) => {
+            // telemetry.py の span / メトリクス (JSON) はログ収集で解析できるよう、そのまま1行で出す
+            if (line.startsWith('{"type":')) {
+                console.error(line);
                 return;
             }
-
-            try {
-                const rawOutput = pythonOutput.trim();
-                const parsedResult = JSON.parse(rawOutput);
-
-                if (!parsedResult.filepath) {
-                    throw new Error("Pythonからの出力に必要なデータが不足しています。");
-                }
-                resolve(parsedResult); 
-            } catch (e) {
-                console.error(`Python出力解析エラー: ${e.message}`, { output: pythonOutput, error: pythonErrorOutput });
-                reject(new Error(`Pythonスクリプトからの結果解析に失敗しました。`));
+            if (line.startsWith('Worker ready')) {
+                // 起動時間を記録し、予算を超えたら警告する (import が重くなっていないかの確認用)
+                const startupMs = Date.now() - spawnedAt;
+                const level = startupMs > STARTUP_BUDGET_MS ? '警告: 起動時間が予算を超えています' : '起動時間';
+                console.error(`${this.name}: ${level} ${startupMs}ms (予算 ${STARTUP_BUDGET_MS}ms)`);
             }
+            console.error(`[Python ${this.name} STDERR]: ${line}`);
         });
-    });
-}
 
-// 効果音・スタンプを決定する関数 (リスト対応済み)
-function decideEffects(imageData) {
-    return new Promise((resolve, reject) => {
-        // Pythonに渡すデータをJSON文字列に変換 (配列でもOK)
-        const jsonString = JSON.stringify(imageData);
-
-        const pythonProcess = spawn('python3', [
-            './scripts/decide_effects.py',
-            jsonString
-        ]);
-
-        let pythonOutput = '';
-        pythonProcess.stdout.on('data', (data) => {
-            pythonOutput += data.toString();
-            console.log(`[Python DecideEffects STDOUT]: ${pythonOutput}`);
+        proc.stdin.on('error', (err) => {
+            console.error(`${this.name}: Pythonワーカーへの書き込みエラー:`, err);
         });
 
-        let pythonErrorOutput = '';
-        pythonProcess.stderr.on('data', (data) => {
-            const output = data.toString();
-            pythonErrorOutput += output;
-            console.error(`[Python DecideEffects STDERR]: ${output.trim()}`);
+        proc.on('error', (err) => {
+            console.error(`${this.name}: Pythonプロセス起動エラー:`, err);
+            this.stop(proc, new Error(`${this.name}: Pythonプロセス起動に失敗。${err.message}`));
         });
 
-        pythonProcess.on('error', (err) => {
-            console.error('decideEffects: Pythonプロセス起動エラー:', err);
-            reject(new Error(`decideEffects: Pythonプロセス起動に失敗。${err.message}`));
+        proc.on('exit', (code) => {
+            console.error(`${this.name}: Pythonワーカーがコード ${code} で終了しました。`);
+            this.stop(proc, new Error(`${this.name}: Pythonワーカーが異常終了しました。`));
         });
+    }
 
-        pythonProcess.on('close', (code) => {
-            if (code === 0) {
-                try {
-                    const result = JSON.parse(pythonOutput);
-                    console.log(`[Python DecideEffects STDOUT]: ${JSON.stringify(result)}`);
-                    resolve(result); 
-                } catch (e) {
-                    console.error('decideEffects: JSONパースエラー:', e);
-                    console.error('Python Output:', pythonOutput);
-                    reject(new Error(`decideEffects: Pythonの出力解析に失敗しました。Error: ${pythonErrorOutput}`));
+    // 応答待ちのジョブはすべて失敗扱いにする (次のジョブで再起動される)
+    stop(proc, error) {
+        if (this.process !== proc) return;
+        this.process = null;
+        for (const job of this.pending.values()) {
+            clearTimeout(job.timer);
+            job.reject(error);
+        }
+        this.pending.clear();
+    }
+
+    call(op, args) {
+        if (!this.process) {
+            this.start();
+        }
+        return new Promise((resolve, reject) => {
+            const id = this.nextId++;
+            // 応答が来ないまま待ち続けないようにする (遅れて届いた応答は pending にないので捨てられる)
+            const timer = setTimeout(() => {
+                if (this.pending.delete(id)) {
+                    reject(new Error(`${this.name}: ${op} が ${PY_JOB_TIMEOUT_MS}ms 以内に応答しませんでした。`));
                 }
-            } else {
-                console.error(`decideEffects: Pythonプロセスがコード ${code} で終了しました。`);
-                reject(new Error(`decideEffects処理エラー: ${pythonErrorOutput}`));
-            }
+            }, PY_JOB_TIMEOUT_MS);
+            this.pending.set(id, { resolve, reject, timer });
+            this.process.stdin.write(JSON.stringify({ id, op, args }) + '\n');
         });
+    }
+}
+
+const processImageWorker = new PythonWorker('ProcessImage', './scripts/process_image.py');
+const decideEffectsWorker = new PythonWorker('DecideEffects', './scripts/decide_effects.py');
+
+// 単一ファイルを処理
+async function processImage(file, pathModule, dirname) {
+    const tempFilePath = file.path;
+    const originalName = file.originalname;
+    const outputDir = pathModule.join(dirname, 'public', 'results', 'images');
+    const resultId = Date.now().toString();
+
+    if (!fs.existsSync(outputDir)) {
+        fs.mkdirSync(outputDir, { recursive: true });
+    }
+
+    const parsedResult = await processImageWorker.call('process_image', {
+        temp_path: tempFilePath,
+        output_dir: outputDir,
+        result_id: resultId,
+        original_name: originalName,
+        // decide_effects 用の解析用 JPEG とサイドカーを一時ファイルの隣に書いてもらう (削除は cleanupUploadFile)
+        handoff: true
     });
+
+    if (!parsedResult || !parsedResult.filepath) {
+        throw new Error("Pythonからの出力に必要なデータが不足しています。");
+    }
+    console.log(`[Python ProcessImage RESULT]: ${JSON.stringify(parsedResult)}`);
+    return parsedResult;
+}
+
+// 効果音・スタンプを決定する関数 (リスト対応済み)
+async function decideEffects(imageData) {
+    // 配列でも単体でもOK (Python側でリストに統一される)
+    const result = await decideEffectsWorker.call('decide_effects', { items: imageData });
+    console.log(`[Python DecideEffects RESULT]: ${JSON.stringify(result)}`);
+    return result;
+}
+
+// 全画像のメタデータから旅程 (立ち寄り地点ごとの timeline) を作る
+async function buildTimeline(imageData) {
+    return decideEffectsWorker.call('timeline', { items: imageData });
+}
+
+// 1枚分の処理済み画像のパス (原寸・Web 表示用・サムネイル) を重複なしで返す
+function resultImagePaths(meta) {
+    const urls = [meta.filepath, ...Object.values(meta.renditions || {})];
+    return [...new Set(urls.filter(Boolean))];
+}
+
+// アップロードの一時ファイルと、process_image が隣に書いた受け渡しファイル (scripts/handoff.py) を削除する
+function cleanupUploadFile(filePath) {
+    cleanupSingleFile(filePath);
+    cleanupSingleFile(`${filePath}.analysis.jpg`);
+    cleanupSingleFile(`${filePath}.analysis.json`);
 }
 
 // 単一ファイルを削除する関数
@@ -105,7 +105,7 @@ document.addEventListener('DOMContentLoaded', async () => {
                     <p>${date_time}</p>
                     <p class="image-address">${hasLocation ? '住所: 取得中...' : '住所: なし'}</p>
                     <div class="image-frame">
-                        <img class="image" src="${imageData.filepath}" alt="写真 ${index + 1}">
+                        <img class="image" src="${imageData.renditions?.web || imageData.filepath}" alt="写真 ${index + 1}">
                         <img class="stamp${emotionClass}" src="${imageData.effects.stamp}" alt="スタンプ画像">
                     </div>
                     <audio class="bgm-player" controls src="${imageData.effects.sound}" type="audio/mp3">効果音</audio>
@@ -230,7 +230,7 @@ function showInfoWindow(map, marker, data, index) {
         <div class="map-info-window">
             <!-- <p><strong>撮影地点 ${index + 1}</strong></p> -->
             <p>${dateStr}</p>
-            <img src="${data.filepath}" alt="写真 ${index + 1}" style="width: 100%; height: auto; margin-top: 8px; border-radius: 4px;">
+            <img src="${data.renditions?.thumb || data.filepath}" alt="写真 ${index + 1}" style="width: 100%; height: auto; margin-top: 8px; border-radius: 4px;">
             <!-- <p>緯度: ${data.location.latitude.toFixed(5)}</p> -->
             <!-- <p>経度: ${data.location.longitude.toFixed(5)}</p> -->
         </div>
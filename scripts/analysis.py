@@ -0,0 +1,420 @@
+import sys
+import os
+import json
+import base64
+import hashlib
+import threading
+from io import BytesIO
+from typing import Any, Dict, List, Optional
+from PIL import Image
+
+sys.path.append(os.path.dirname(__file__))
+from mapping_config import (
+    STYLE_LABELS, SCENERY_LABELS, EMOTION_LABELS, ANALYSIS_PROMPT_PREFIX,
+    ANALYSIS_RESPONSE_FORMAT, BATCH_ANALYSIS_RESPONSE_FORMAT, BATCH_ANALYSIS_SCHEMA
+)
+from metadata import get_exif, rotate_image
+from analysis_cache import get_cache, file_sha256, make_key
+from phash import BKTree, PHASH_THRESHOLD, Signature, colors_match, parse_signature, signature
+from openai_client import create_chat_completion, circuit_breaker
+from telemetry import span, count
+from handoff import read_handoff, read_sidecar, write_handoff
+
+# =================================================================
+# 画像解析 (フィルタースタイル + 風景 + 感情 を1回のAPI呼び出しで判定)
+# =================================================================
+
+# scenery / emotion の判定精度が必要なので gpt-4o を使う
+ANALYSIS_MODEL = os.environ.get("ANALYSIS_MODEL", "gpt-4o")
+
+# 解析用縮小画像の長辺 (px) と JPEG 品質。サーバー側でも縮小されるので原寸は不要
+ANALYSIS_MAX_EDGE = int(os.environ.get("ANALYSIS_MAX_EDGE", "768"))
+ANALYSIS_JPEG_QUALITY = int(os.environ.get("ANALYSIS_JPEG_QUALITY", "80"))
+
+FALLBACK_ANALYSIS = {
+    'style': 'vivid',      # フィルターのデフォルト
+    'scenery': 'default',  # -> MUSIC_MAPPING["default"]
+    'emotion': 'default',  # -> STAMP_MAPPING["default"]
+}
+
+# 1回のリクエストにまとめる画像の枚数 (decide_effects のバッチ解析。1 で1枚ずつ)
+ANALYSIS_BATCH_SIZE = int(os.environ.get("ANALYSIS_BATCH_SIZE", "4"))
+
+# 先頭は mapping_config.ANALYSIS_PROMPT_PREFIX で共通にし、違いは末尾の1行だけにする
+# (ラベルの一覧は JSON スキーマの enum で渡す)
+SYSTEM_PROMPT = ANALYSIS_PROMPT_PREFIX + "Analyze the image."
+
+BATCH_SYSTEM_PROMPT = (
+    ANALYSIS_PROMPT_PREFIX
+    + "Analyze each numbered image independently and return one result per image with its index."
+)
+
+# キャッシュキーに含めるプロンプトのバージョン。プロンプトや解析画像の設定が変われば自動で変わる
+# (1枚用とバッチ用は同じ判定基準なので、どちらの結果も同じキーで共有する)
+PROMPT_VERSION = hashlib.sha256(
+    f"{SYSTEM_PROMPT}|{BATCH_SYSTEM_PROMPT}|{json.dumps(BATCH_ANALYSIS_SCHEMA, sort_keys=True)}"
+    f"|{ANALYSIS_MAX_EDGE}|{ANALYSIS_JPEG_QUALITY}".encode('utf-8')
+).hexdigest()[:12]
+
+# 受け渡しファイル (handoff.py) の解析用 JPEG がこの設定で作られたものか確認するための値
+ANALYSIS_IMAGE_SETTINGS = f"{ANALYSIS_MAX_EDGE}|{ANALYSIS_JPEG_QUALITY}"
+
+
+def prepare_analysis_image(image_path: str, img: Optional[Image.Image] = None) -> bytes:
+    """
+    解析用の縮小JPEGをメモリ上に作成して返す。
+    img を渡した場合は（rotate_image 済みとみなして）それを縮小する。
+    渡さない場合はファイルを開き、JPEG の draft デコードで縮小読み込みしてから向きを補正する。
+    """
+    original_bytes = os.path.getsize(image_path)
+    edge = ANALYSIS_MAX_EDGE
+
+    if img is None:
+        img = Image.open(image_path)
+        exif = get_exif(img)
+        # JPEG は 1/2, 1/4, 1/8 スケールで直接デコードできる
+        img.draft('RGB', (edge, edge))
+        img = rotate_image(img, exif)
+    original_size = img.size
+
+    # 原寸のコピーを作らないよう、先に縮小してから RGB に変換する
+    scale = min(1.0, edge / max(original_size))
+    size = (max(1, round(original_size[0] * scale)), max(1, round(original_size[1] * scale)))
+    thumb = img.resize(size, Image.LANCZOS, reducing_gap=2.0) if scale < 1.0 else img
+    thumb = thumb.convert("RGB")
+
+    buffer = BytesIO()
+    thumb.save(buffer, format="JPEG", quality=ANALYSIS_JPEG_QUALITY, optimize=True)
+    data = buffer.getvalue()
+
+    saved = original_bytes - len(data)
+    ratio = (saved / original_bytes * 100) if original_bytes else 0.0
+    print(
+        f"Analysis image: {original_size[0]}x{original_size[1]} -> {thumb.size[0]}x{thumb.size[1]}, "
+        f"{original_bytes} -> {len(data)} bytes ({ratio:.1f}% saved)",
+        file=sys.stderr
+    )
+    return data
+
+
+def write_analysis_handoff(image_path: str, img: Image.Image, phash: Optional[str] = None,
+                           image_hash: Optional[str] = None) -> None:
+    """
+    process_image 用。デコード済みの img (rotate_image 済み) から解析用 JPEG を作り、
+    image_path の隣に受け渡しファイルとして書き出す。decide_effects はこれを使い、原寸を読み直さない。
+    image_hash は process_image が読み込みと一緒に計算した SHA-256 (キャッシュキー用)。
+    ここではファイルを読み直さない。None なら decide_effects が必要なときに計算する。
+    """
+    write_handoff(image_path, prepare_analysis_image(image_path, img), ANALYSIS_IMAGE_SETTINGS, image_hash, phash)
+
+
+def validate_analysis(raw: Dict[str, Any]) -> Dict[str, str]:
+    """
+    GPTの回答を検証し、想定外の値はフォールバック値に置き換える。
+    """
+    style = str(raw.get('style', '')).strip(" '\"").lower()
+    if style not in STYLE_LABELS:
+        print(f"GPT returned unexpected style: {style}. Fallback to 'vivid'.", file=sys.stderr)
+        style = FALLBACK_ANALYSIS['style']
+
+    scenery = raw.get('scenery')
+    if scenery not in SCENERY_LABELS:
+        print(f"GPT returned unexpected scenery: {scenery}. Fallback to 'default'.", file=sys.stderr)
+        scenery = FALLBACK_ANALYSIS['scenery']
+
+    emotion = raw.get('emotion')
+    if emotion not in EMOTION_LABELS:
+        print(f"GPT returned unexpected emotion: {emotion}. Fallback to 'default'.", file=sys.stderr)
+        emotion = FALLBACK_ANALYSIS['emotion']
+
+    return {'style': style, 'scenery': scenery, 'emotion': emotion}
+
+
+# =================================================================
+# ほぼ同じ写真 (連写など) の解析結果の使い回し
+# =================================================================
+# キャッシュの phash テーブルから BK-tree を作り、dHash が PHASH_THRESHOLD 以内で平均色も近い写真の
+# 解析結果があればそれを返す (dHash の距離だけでは使い回さない)。平坦な写真・平均色のない古い行は対象外。
+# 他のワーカーが追加した分は検索のたびに差分だけ取り込む。
+# キャッシュの削除 (TTL・最大件数) で取り込み済みの行が消えていたら、木を作り直す。
+
+_phash_tree = BKTree()
+_phash_rowid = 0
+_phash_rows = 0
+_phash_lock = threading.Lock()
+
+
+def _sync_phash_tree(cache) -> None:
+    global _phash_tree, _phash_rowid, _phash_rows
+    if _phash_rows and cache.phash_count(_phash_rowid) != _phash_rows:
+        _phash_tree = BKTree()
+        _phash_rowid = 0
+        _phash_rows = 0
+    for rowid, image_hash, phash in cache.phashes_since(_phash_rowid):
+        parsed = parse_signature(phash)
+        if parsed is not None:
+            _phash_tree.add(parsed[0], (image_hash, parsed[1]))
+        _phash_rowid = rowid
+        _phash_rows += 1
+
+
+def find_near_duplicate(cache, image_hash: str, image_signature: Signature) -> Optional[Dict[str, str]]:
+    """
+    ほぼ同じ写真の解析結果（同じモデル・プロンプトのもの）をキャッシュから探す。
+    """
+    image_dhash, image_colors = image_signature
+    with _phash_lock:
+        _sync_phash_tree(cache)
+        matches = _phash_tree.search(image_dhash, PHASH_THRESHOLD)
+    for distance, (other_hash, other_colors) in matches:
+        if other_hash == image_hash or not colors_match(image_colors, other_colors):
+            continue
+        cached = cache.get(make_key(other_hash, ANALYSIS_MODEL, PROMPT_VERSION))
+        if cached is not None:
+            print(f"Near-duplicate analysis reused (distance {distance}, {other_hash[:12]})", file=sys.stderr)
+            return cached
+    return None
+
+
+def log_usage(response: Any, label: str) -> None:
+    """
+    1回の呼び出しのトークン数を stderr に出す (cached はプロンプトキャッシュに載った入力トークン)。
+    """
+    usage = getattr(response, 'usage', None)
+    if usage is None:
+        return
+    details = getattr(usage, 'prompt_tokens_details', None)
+    cached = getattr(details, 'cached_tokens', 0) if details is not None else 0
+    count("openai_tokens_total", usage.prompt_tokens, kind="prompt")
+    count("openai_tokens_total", cached or 0, kind="cached")
+    count("openai_tokens_total", usage.completion_tokens, kind="completion")
+    print(
+        f"Token usage ({label}): prompt={usage.prompt_tokens} (cached={cached or 0}), "
+        f"completion={usage.completion_tokens}, total={usage.total_tokens}",
+        file=sys.stderr
+    )
+
+
+class _CacheEntry:
+    """
+    1枚分のキャッシュのキーと近似重複用のシグネチャ（キャッシュが無効なら None のまま）。
+    """
+
+    def __init__(self, cache, image_path: str, img: Optional[Image.Image] = None):
+        self.cache = cache
+        self.image_path = image_path
+        self.img = img
+        self.key = None
+        self.image_hash = None
+        self.image_signature: Optional[str] = None
+        self._signature_ready = False
+        if cache is not None:
+            # process_image の受け渡しファイルがあれば、原寸を読み直さずに SHA-256 とシグネチャを使う
+            sidecar = read_sidecar(image_path, ANALYSIS_IMAGE_SETTINGS) if img is None else None
+            if sidecar and 'phash' in sidecar:
+                self.image_signature = sidecar['phash']
+                self._signature_ready = True
+            self.image_hash = (sidecar or {}).get('sha256') or file_sha256(image_path)
+            self.key = make_key(self.image_hash, ANALYSIS_MODEL, PROMPT_VERSION)
+
+    def lookup(self) -> Optional[Dict[str, str]]:
+        """
+        同じ画像、またはほぼ同じ写真の解析結果がキャッシュにあれば返す。
+        """
+        if self.cache is None:
+            return None
+        cached = self.cache.get(self.key)
+        stats = self.cache.stats()
+        if cached is not None:
+            print(f"Analysis cache hit: {self.image_path} (hits={stats['hits']}, misses={stats['misses']})", file=sys.stderr)
+            count("analysis_cache_total", result="hit")
+            return cached
+        print(f"Analysis cache miss: {self.image_path} (hits={stats['hits']}, misses={stats['misses']})", file=sys.stderr)
+
+        # 連写などでほぼ同じ写真が解析済みなら、その結果を使う
+        if not self._signature_ready:
+            self.image_signature = signature(self.img if self.img is not None else self.image_path)
+            self._signature_ready = True
+        parsed = parse_signature(self.image_signature)
+        near = find_near_duplicate(self.cache, self.image_hash, parsed) if parsed is not None else None
+        if near is not None:
+            self.store(near)
+        count("analysis_cache_total", result="near_duplicate" if near is not None else "miss")
+        return near
+
+    def store(self, result: Dict[str, str]) -> None:
+        if self.cache is None:
+            return
+        self.cache.put(self.key, result)
+        if self.image_signature is not None:
+            self.cache.put_phash(self.image_hash, self.image_signature)
+
+
+def _fallback(fallback_style: Optional[str] = None) -> Dict[str, str]:
+    fallback = dict(FALLBACK_ANALYSIS)
+    if fallback_style in STYLE_LABELS:
+        fallback['style'] = fallback_style
+    return fallback
+
+
+def _image_part(image_path: str, img: Optional[Image.Image] = None) -> Dict[str, Any]:
+    handoff = read_handoff(image_path, ANALYSIS_IMAGE_SETTINGS) if img is None else None
+    if handoff is not None:
+        # process_image が作った解析用 JPEG (メモリマップ) をそのまま base64 にする
+        with handoff:
+            base64_image = base64.b64encode(handoff.jpeg).decode('utf-8')
+        count("analysis_handoff_total", result="hit")
+    else:
+        base64_image = base64.b64encode(prepare_analysis_image(image_path, img)).decode('utf-8')
+        count("analysis_handoff_total", result="miss")
+    url = f"data:image/jpeg;base64,{base64_image}"
+    count("analysis_api_bytes_total", len(url))
+    return {"type": "image_url", "image_url": {"url": url}}
+
+
+def analyze(image_path: str, img: Optional[Image.Image] = None, fallback_style: Optional[str] = None) -> Dict[str, str]:
+    """
+    画像を1回だけGPTに送信し、style / scenery / emotion をまとめて判定する。
+    送信するのは prepare_analysis_image で作った縮小JPEG（向き補正済み）。
+    同じ画像・モデル・プロンプトの結果がキャッシュにあれば API を呼ばない。
+    API エラー時はフォールバック値を返す（例外は送出しない、キャッシュもしない）。
+    fallback_style を渡すと、エラー時の style は 'vivid' ではなくその値になる（ローカル判定の結果など）。
+    """
+    with span("analysis", mode="single") as s:
+        entry = _CacheEntry(get_cache(), image_path, img)
+        cached = entry.lookup()
+        s['cache'] = 'hit' if cached is not None else ('off' if entry.cache is None else 'miss')
+        if cached is not None:
+            return cached
+        return _request_single(entry, image_path, img, fallback_style, s)
+
+
+def _request_single(entry: "_CacheEntry", image_path: str, img: Optional[Image.Image],
+                    fallback_style: Optional[str], fields: Dict[str, Any]) -> Dict[str, str]:
+    print(f"GPT Analyzing: {image_path}", file=sys.stderr)
+
+    try:
+        # 画像の読み込み・エンコードの失敗もフォールバックで扱う
+        image_part = _image_part(image_path, img)
+        fields['bytes_sent'] = len(image_part['image_url']['url'])
+        response = create_chat_completion(
+            label=os.path.basename(image_path),
+            model=ANALYSIS_MODEL,
+            messages=[
+                {"role": "system", "content": SYSTEM_PROMPT},
+                {"role": "user", "content": [
+                    {"type": "text", "text": "Analyze this image."},
+                    image_part,
+                ]},
+            ],
+            response_format=ANALYSIS_RESPONSE_FORMAT
+        )
+        log_usage(response, image_path)
+        result = validate_analysis(json.loads(response.choices[0].message.content))
+
+    except Exception as e:
+        print(f"GPT API Error: {e}. Fallback to defaults.", file=sys.stderr)
+        fields['outcome'] = 'fallback'
+        count("analysis_fallback_total")
+        return _fallback(fallback_style)
+
+    fields['outcome'] = 'ok'
+    entry.store(result)
+    return result
+
+
+# =================================================================
+# 複数枚をまとめて1回で解析する
+# =================================================================
+
+def parse_batch_response(raw: Any, count: int) -> Dict[int, Dict[str, str]]:
+    """
+    バッチの回答 {"results": [{"index": i, ...}, ...]} を {index: 検証済みの結果} にする。
+    順番ではなく index で対応付ける。範囲外・重複・形式違いの要素は捨てる（呼び出し側で再解析する）。
+    """
+    items = raw.get('results') if isinstance(raw, dict) else raw
+    parsed: Dict[int, Dict[str, str]] = {}
+    if not isinstance(items, list):
+        return parsed
+    for item in items:
+        if not isinstance(item, dict):
+            continue
+        try:
+            index = int(item.get('index'))
+        except (TypeError, ValueError):
+            continue
+        if 0 <= index < count and index not in parsed:
+            parsed[index] = validate_analysis(item)
+    return parsed
+
+
+def _analyze_chunk(image_paths: List[str]) -> List[Optional[Dict[str, str]]]:
+    """
+    最大 ANALYSIS_BATCH_SIZE 枚を1回のリクエストで解析する。回答がなかった画像は None。
+    """
+    content: List[Dict[str, Any]] = [{"type": "text", "text": f"Analyze these {len(image_paths)} images."}]
+    for index, image_path in enumerate(image_paths):
+        content.append({"type": "text", "text": f"Image {index}:"})
+        content.append(_image_part(image_path))
+
+    response = create_chat_completion(
+        label=f"batch of {len(image_paths)}",
+        model=ANALYSIS_MODEL,
+        messages=[
+            {"role": "system", "content": BATCH_SYSTEM_PROMPT},
+            {"role": "user", "content": content},
+        ],
+        response_format=BATCH_ANALYSIS_RESPONSE_FORMAT
+    )
+    log_usage(response, f"batch of {len(image_paths)}")
+    parsed = parse_batch_response(json.loads(response.choices[0].message.content), len(image_paths))
+    return [parsed.get(index) for index in range(len(image_paths))]
+
+
+def analyze_batch(image_paths: List[str], batch_size: int = ANALYSIS_BATCH_SIZE) -> List[Dict[str, str]]:
+    """
+    複数の画像を batch_size 枚ずつまとめて解析し、入力と同じ順序で結果を返す。
+    キャッシュにある画像は送らない。回答が欠けた画像と、リクエスト自体が失敗したまとまりは
+    1枚ずつの analyze で解析し直す。
+    """
+    cache = get_cache()
+    results: List[Optional[Dict[str, str]]] = [None] * len(image_paths)
+    entries = []
+    pending = []
+    for index, image_path in enumerate(image_paths):
+        entry = _CacheEntry(cache, image_path)
+        entries.append(entry)
+        results[index] = entry.lookup()
+        if results[index] is None:
+            pending.append(index)
+
+    if batch_size <= 1:
+        for index in pending:
+            results[index] = analyze(image_paths[index])
+        return results
+
+    for start in range(0, len(pending), batch_size):
+        chunk = pending[start:start + batch_size]
+        print(f"GPT Analyzing batch of {len(chunk)}: {[image_paths[i] for i in chunk]}", file=sys.stderr)
+        try:
+            with span("analysis", mode="batch", images=len(chunk)) as s:
+                answers = _analyze_chunk([image_paths[i] for i in chunk])
+                s['answered'] = sum(1 for a in answers if a is not None)
+        except Exception as e:
+            if circuit_breaker.state != "closed":
+                # API が不調な間は1枚ずつ送り直しても失敗するだけなので、すぐにフォールバックする
+                print(f"GPT API Error (batch): {e}. Circuit breaker {circuit_breaker.state}; using fallback.", file=sys.stderr)
+                for index in chunk:
+                    results[index] = _fallback()
+                continue
+            print(f"GPT API Error (batch): {e}. Retrying one by one.", file=sys.stderr)
+            answers = [None] * len(chunk)
+
+        for index, answer in zip(chunk, answers):
+            if answer is None:
+                print(f"Batch answer missing for {image_paths[index]}. Retrying alone.", file=sys.stderr)
+                results[index] = analyze(image_paths[index])
+            else:
+                entries[index].store(answer)
+                results[index] = answer
+    return results
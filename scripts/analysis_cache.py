@@ -0,0 +1,172 @@
+import sys
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+from typing import Any, Dict, List, Optional, Tuple
+
+# =================================================================
+# GPT解析結果のキャッシュ (SQLite, コンテンツアドレス)
+# =================================================================
+# キー: 画像ファイルの SHA-256 + モデル名 + プロンプトのバージョン
+# 同じ写真を再アップロードした場合は API を呼ばずに結果を返す。
+# process_image と decide_effects のワーカーが同じファイルを共有するので WAL モードで開く。
+# phash テーブルには画像のシグネチャ (dHash + 平均色、phash.signature) を保存し、ほぼ同じ写真の解析結果を使い回す。
+# dhash 列の名前は古いデータベースとの互換のため。平均色のない古い行は近似重複の判定に使わない。
+
+DEFAULT_CACHE_PATH = os.path.join(os.path.dirname(__file__), '../cache/analysis_cache.sqlite3')
+
+CACHE_PATH = os.environ.get("ANALYSIS_CACHE_PATH", DEFAULT_CACHE_PATH)
+CACHE_TTL_SECONDS = float(os.environ.get("ANALYSIS_CACHE_TTL_DAYS", "30")) * 24 * 60 * 60
+CACHE_MAX_ENTRIES = int(os.environ.get("ANALYSIS_CACHE_MAX_ENTRIES", "10000"))
+CACHE_DISABLED = os.environ.get("ANALYSIS_CACHE_DISABLE") == "1"
+
+
+def file_sha256(path: str, chunk_size: int = 1 << 20) -> str:
+    """
+    ファイル内容の SHA-256 を返す（ファイル名ではなく中身で同一性を判定する）。
+    """
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def make_key(image_hash: str, model: str, prompt_version: str) -> str:
+    return f"{image_hash}:{model}:{prompt_version}"
+
+
+class AnalysisCache:
+    """
+    TTL と最大件数で古いエントリを削除する LRU キャッシュ。
+    ヒット/ミスの回数はプロセス内で数え、ログに出す。
+    """
+
+    def __init__(self, path: str, ttl_seconds: float, max_entries: int):
+        self.path = path
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._conn = sqlite3.connect(path, timeout=5.0, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS analysis ("
+            " key TEXT PRIMARY KEY,"
+            " value TEXT NOT NULL,"
+            " created_at REAL NOT NULL,"
+            " last_access REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_analysis_last_access ON analysis (last_access)")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS phash ("
+            " image_hash TEXT PRIMARY KEY,"
+            " dhash TEXT NOT NULL,"
+            " created_at REAL NOT NULL)"
+        )
+        self._conn.commit()
+        self.evict()
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT value, created_at FROM analysis WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None or now - row[1] > self.ttl_seconds:
+                self.misses += 1
+                return None
+            self._conn.execute("UPDATE analysis SET last_access = ? WHERE key = ?", (now, key))
+            self._conn.commit()
+            self.hits += 1
+        return json.loads(row[0])
+
+    def put(self, key: str, value: Dict[str, Any]) -> None:
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO analysis (key, value, created_at, last_access) VALUES (?, ?, ?, ?)",
+                (key, json.dumps(value), now, now)
+            )
+            self._conn.commit()
+        self.evict()
+
+    def put_phash(self, image_hash: str, phash: str) -> None:
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR IGNORE INTO phash (image_hash, dhash, created_at) VALUES (?, ?, ?)",
+                (image_hash, phash, time.time())
+            )
+            self._conn.commit()
+
+    def phashes_since(self, rowid: int) -> List[Tuple[int, str, str]]:
+        """
+        rowid より後に追加された (rowid, image_hash, シグネチャ) を返す。
+        他のワーカープロセスが追加した分も、次の検索の前に取り込める。
+        """
+        with self._lock:
+            return self._conn.execute(
+                "SELECT rowid, image_hash, dhash FROM phash WHERE rowid > ? ORDER BY rowid", (rowid,)
+            ).fetchall()
+
+    def phash_count(self, rowid: int) -> int:
+        """
+        rowid 以下で残っているシグネチャの件数。取り込み済みの件数より少なければ、その間に削除された行がある。
+        """
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM phash WHERE rowid <= ?", (rowid,)).fetchone()[0]
+
+    def evict(self) -> None:
+        """
+        期限切れのエントリを削除し、最大件数を超えた分は最終アクセスが古い順に削除する。
+        解析結果を削除したら、その画像のシグネチャも削除する (phash テーブルが件数上限なしに増えないように)。
+        """
+        with self._lock:
+            removed = self._conn.execute(
+                "DELETE FROM analysis WHERE created_at < ?", (time.time() - self.ttl_seconds,)
+            ).rowcount
+            self._conn.execute("DELETE FROM phash WHERE created_at < ?", (time.time() - self.ttl_seconds,))
+            removed += self._conn.execute(
+                "DELETE FROM analysis WHERE key IN ("
+                " SELECT key FROM analysis ORDER BY last_access DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,)
+            ).rowcount
+            if removed:
+                # キーは "<image_hash>:<モデル>:<プロンプト>" なので、主キーの範囲検索で残っている解析結果を探す
+                self._conn.execute(
+                    "DELETE FROM phash WHERE NOT EXISTS ("
+                    " SELECT 1 FROM analysis"
+                    " WHERE key > phash.image_hash || ':' AND key < phash.image_hash || ';')"
+                )
+            self._conn.commit()
+
+    def stats(self) -> Dict[str, int]:
+        return {'hits': self.hits, 'misses': self.misses}
+
+
+_cache: Optional[AnalysisCache] = None
+_cache_lock = threading.Lock()
+
+
+def get_cache() -> Optional[AnalysisCache]:
+    """
+    プロセス内で共有するキャッシュを返す。無効化されている・開けない場合は None。
+    """
+    global _cache
+    if CACHE_DISABLED:
+        return None
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                try:
+                    _cache = AnalysisCache(CACHE_PATH, CACHE_TTL_SECONDS, CACHE_MAX_ENTRIES)
+                except sqlite3.Error as e:
+                    print(f"Analysis cache unavailable: {e}", file=sys.stderr)
+                    return None
+    return _cache
@@ -0,0 +1,99 @@
+import sys
+import os
+import json
+import time
+import argparse
+from typing import List
+
+import cv2
+import numpy as np
+from PIL import Image
+
+sys.path.append(os.path.dirname(__file__))
+from process_image import pencil_sketch_filter
+from sketch_engines import SKETCH_ENGINES
+from image_metrics import ssim, display_ssim
+
+# =================================================================
+# 鉛筆画エンジンのベンチマーク
+# =================================================================
+# 使い方: python scripts/bench_sketch.py --mp 1 12 24 --repeat 2
+# 解像度ごとに各エンジンの処理時間と、opencv エンジン（元の実装）に対する SSIM を JSON で出力する。
+
+
+def synthetic_scene(width: int, height: int, seed: int = 0) -> np.ndarray:
+    """
+    ベンチマーク用の RGB 画像を作る。
+    複数スケールのノイズ（空・地面のようななだらかな変化）に、直線的な輪郭（建物のような形）を重ねる。
+    """
+    rng = np.random.default_rng(seed)
+    scene = np.zeros((height, width, 3), np.float32)
+    for cell in (8, 32, 128, 512):
+        noise = rng.random((height // cell + 2, width // cell + 2, 3)).astype(np.float32)
+        scene += cv2.resize(noise, (width, height), interpolation=cv2.INTER_CUBIC) * (cell / 512)
+    scene = (np.clip(scene / scene.max(), 0, 1) * 255).astype(np.uint8)
+    thickness = max(2, width // 400)
+    for _ in range(30):
+        p1 = (int(rng.integers(0, width)), int(rng.integers(0, height)))
+        p2 = (int(rng.integers(0, width)), int(rng.integers(0, height)))
+        color = tuple(int(c) for c in rng.integers(0, 256, 3))
+        cv2.rectangle(scene, p1, p2, color, int(rng.integers(1, 6)) * thickness)
+    return scene
+
+
+def size_for_megapixels(mp: float) -> tuple:
+    """
+    4:3 の画像で mp メガピクセルになる (幅, 高さ) を返す。
+    """
+    height = int(round((mp * 1_000_000 * 3 / 4) ** 0.5))
+    return int(round(height * 4 / 3)), height
+
+
+def run(megapixels: List[float], engines: List[str], repeat: int) -> List[dict]:
+    rows = []
+    for mp in megapixels:
+        width, height = size_for_megapixels(mp)
+        img = Image.fromarray(synthetic_scene(width, height))
+        outputs = {}
+        timings = {}
+        for engine in engines:
+            best = None
+            for _ in range(repeat):
+                start = time.perf_counter()
+                outputs[engine] = np.asarray(pencil_sketch_filter(img, engine=engine))
+                elapsed = time.perf_counter() - start
+                best = elapsed if best is None else min(best, elapsed)
+            timings[engine] = best
+
+        reference = outputs.get('opencv')
+        for engine in engines:
+            row = {
+                'megapixels': mp,
+                'size': [width, height],
+                'engine': engine,
+                'seconds': round(timings[engine], 3),
+            }
+            if reference is not None:
+                row['speedup'] = round(timings['opencv'] / timings[engine], 2)
+                row['ssim'] = round(ssim(reference, outputs[engine]), 4)
+                row['display_ssim'] = round(display_ssim(reference, outputs[engine]), 4)
+            rows.append(row)
+            print(json.dumps(row), flush=True)
+    return rows
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark pencil sketch engines")
+    parser.add_argument("--mp", type=float, nargs="+", default=[1, 12, 24], help="resolutions in megapixels")
+    parser.add_argument("--engines", nargs="+", default=list(SKETCH_ENGINES), choices=list(SKETCH_ENGINES))
+    parser.add_argument("--repeat", type=int, default=1)
+    parser.add_argument("--min-ssim", type=float, default=None,
+                        help="exit 1 if any engine's display_ssim against opencv falls below this value")
+    args = parser.parse_args()
+
+    results = run(args.mp, args.engines, args.repeat)
+    if args.min_ssim is not None:
+        failed = [r for r in results if r.get('display_ssim', 1.0) < args.min_ssim]
+        if failed:
+            print(f"Parity check failed for: {[(r['engine'], r['megapixels']) for r in failed]}", file=sys.stderr)
+            sys.exit(1)
@@ -0,0 +1,107 @@
+import sys
+import os
+import json
+import time
+import argparse
+from typing import Dict, List, Optional
+
+from PIL import Image
+
+sys.path.append(os.path.dirname(__file__))
+from style_classifier import STYLE_LABELS, FEATURE_EDGE, classify_style
+from analysis import ANALYSIS_MODEL, PROMPT_VERSION
+from analysis_cache import get_cache, file_sha256, make_key
+
+# =================================================================
+# ローカルのスタイル判定と GPT の判定の一致率 (オフライン)
+# =================================================================
+# 使い方:
+#   python scripts/bench_style_classifier.py photos/ --labels labels.json
+#   python scripts/bench_style_classifier.py photos/          # 解析キャッシュにある GPT の判定を使う
+# labels.json は {"画像パス": "vivid|sad|sketch", ...}。API は呼ばない。
+# 閾値ごとに「ローカルで確定する割合 (coverage)」と「そのうち GPT と一致した割合 (agreement)」を出す。
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.webp')
+THRESHOLDS = [0.5, 0.6, 0.7, 0.8, 0.85, 0.9, 0.95]
+
+
+def collect_images(inputs: List[str]) -> List[str]:
+    paths = []
+    for item in inputs:
+        if os.path.isdir(item):
+            for name in sorted(os.listdir(item)):
+                if name.lower().endswith(IMAGE_EXTENSIONS):
+                    paths.append(os.path.join(item, name))
+        else:
+            paths.append(item)
+    return paths
+
+
+def cached_gpt_style(path: str) -> Optional[str]:
+    """
+    解析キャッシュに残っている GPT の style を返す（なければ None）。
+    """
+    cache = get_cache()
+    if cache is None:
+        return None
+    cached = cache.get(make_key(file_sha256(path), ANALYSIS_MODEL, PROMPT_VERSION))
+    return cached.get('style') if cached else None
+
+
+def run(paths: List[str], labels: Optional[Dict[str, str]]) -> Dict:
+    rows = []
+    elapsed = 0.0
+    for path in paths:
+        expected = labels.get(path) if labels is not None else cached_gpt_style(path)
+        if expected not in STYLE_LABELS:
+            continue
+        start = time.perf_counter()
+        with Image.open(path) as img:
+            img.draft('RGB', (FEATURE_EDGE, FEATURE_EDGE))
+            style, confidence = classify_style(img)
+        elapsed += time.perf_counter() - start
+        rows.append({'path': path, 'gpt': expected, 'local': style, 'confidence': round(confidence, 3)})
+
+    confusion = {gpt: {local: 0 for local in STYLE_LABELS} for gpt in STYLE_LABELS}
+    for row in rows:
+        confusion[row['gpt']][row['local']] += 1
+
+    by_threshold = []
+    for threshold in THRESHOLDS:
+        covered = [r for r in rows if r['confidence'] >= threshold]
+        agreed = sum(1 for r in covered if r['local'] == r['gpt'])
+        by_threshold.append({
+            'threshold': threshold,
+            'coverage': round(len(covered) / len(rows), 3) if rows else 0.0,
+            'agreement': round(agreed / len(covered), 3) if covered else None,
+        })
+
+    return {
+        'images': len(rows),
+        'agreement': round(sum(1 for r in rows if r['local'] == r['gpt']) / len(rows), 3) if rows else None,
+        'ms_per_image': round(elapsed / len(rows) * 1000, 2) if rows else None,
+        'by_threshold': by_threshold,
+        'confusion': confusion,
+        'rows': rows,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare the local style classifier with GPT labels")
+    parser.add_argument("inputs", nargs="+", help="image files or directories")
+    parser.add_argument("--labels", default=None, help="JSON file mapping image path to GPT style")
+    parser.add_argument("--rows", action="store_true", help="include per-image rows in the output")
+    args = parser.parse_args()
+
+    labels = None
+    if args.labels:
+        with open(args.labels, encoding='utf-8') as f:
+            labels = json.load(f)
+
+    report = run(collect_images(args.inputs), labels)
+    if not args.rows:
+        report.pop('rows')
+    print(json.dumps(report, indent=2, ensure_ascii=False))
+    if not report['images']:
+        print("No labelled images found (pass --labels or populate the analysis cache).", file=sys.stderr)
+        sys.exit(1)
@@ -0,0 +1,316 @@
+import sys
+import os
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import resource
+import multiprocessing
+from typing import Any, Dict, List, Optional
+
+# span の JSON 行でベンチマークの出力が埋もれないようにする (import より前に設定する)
+os.environ.setdefault("TELEMETRY", "0")
+
+import numpy as np
+from PIL import Image, ExifTags
+
+sys.path.append(os.path.dirname(__file__))
+from bench_sketch import synthetic_scene, size_for_megapixels
+
+# =================================================================
+# フィルターと process_image 全体のオフラインベンチマーク
+# =================================================================
+# 使い方:
+#   python scripts/benchmark.py --mp 1 12 --repeat 3 --output bench.json
+#   python scripts/benchmark.py --baseline bench_baseline.json          # 基準値と比較 (悪化していれば exit 1)
+#   python scripts/benchmark.py --baseline bench_baseline.json --write-baseline   # 基準値を更新
+#   python scripts/benchmark.py --parity-only                            # 元の実装との一致確認だけ
+# 解像度ごとに合成画像の JPEG を Exif なし / あり (向き 6 + GPS + 撮影日時) で作り、
+# 各フィルターと process_image 全体の処理時間 (p50 / p95)、スループット、ピーク RSS を JSON で出す。
+# GPT の解析はスタブに置き換えるので API キーは不要。
+# ピーク RSS を計測対象ごとに分けるため、1ケースごとに新しいプロセス (spawn) で実行する。
+# 計測の前に、高速版のフィルターが元の実装 (process_image の参照実装) と許容差以内で一致するかを確認し、
+# 外れていれば計測結果にかかわらず exit 1 にする。
+
+FILTERS = ['enhance', 'sad', 'sketch']
+EXIF_VARIANTS = ['plain', 'exif']
+
+# Exif ありの画像に書き込む値
+FIXTURE_DATETIME = "2024:05:01 10:30:00"
+FIXTURE_GPS = {'lat': (35, 39, 29.1), 'lon': (139, 42, 3.6)}
+
+
+def write_fixture(path: str, mp: float, with_exif: bool, seed: int = 0) -> None:
+    """
+    mp メガピクセルの合成画像を JPEG で書き出す。
+    with_exif なら向き (6: 90度回転)、撮影日時、GPS を付ける（process_image の回転・メタデータ抽出も通す）。
+    """
+    width, height = size_for_megapixels(mp)
+    img = Image.fromarray(synthetic_scene(width, height, seed))
+    exif = Image.Exif()
+    if with_exif:
+        exif[ExifTags.Base.Orientation] = 6
+        exif.get_ifd(ExifTags.IFD.Exif)[ExifTags.Base.DateTimeOriginal] = FIXTURE_DATETIME
+        gps = exif.get_ifd(ExifTags.IFD.GPSInfo)
+        gps[ExifTags.GPS.GPSLatitudeRef] = 'N'
+        gps[ExifTags.GPS.GPSLatitude] = FIXTURE_GPS['lat']
+        gps[ExifTags.GPS.GPSLongitudeRef] = 'E'
+        gps[ExifTags.GPS.GPSLongitude] = FIXTURE_GPS['lon']
+    img.save(path, "JPEG", quality=90, exif=exif)
+
+
+def percentile(values: List[float], q: float) -> float:
+    """
+    最近傍順位法でのパーセンタイル (q は 0〜100)。
+    """
+    ordered = sorted(values)
+    rank = max(1, -(-len(ordered) * q // 100))
+    return ordered[int(rank) - 1]
+
+
+# 一致確認に使う合成画像の大きさ (メガピクセル)。違うサイズを交互に通してバッファプールの使い回しも確かめる
+PARITY_MP = [1.0, 0.3]
+
+# enhance_image と元の実装の最大差 (階調)
+ENHANCE_TOLERANCE = 1
+# 一致確認で試す enhance_image の彩度の倍率
+PARITY_SATURATION_SCALES = [0.8, 1.0, 1.1, 1.15, 1.3, 1.5]
+# sad_filter (LUT 版) と元の実装の最大差。LUT は元の実装と同じ丸めで作るので一致する
+SAD_TOLERANCE = 0
+# enhance_image のタイル版 (全体の CLAHE LUT を横帯ごとに適用) と全体処理の最大差。OpenCV と同じ式なので一致する
+TILED_TOLERANCE = 0
+# タイル版を通すための作業メモリの上限 (MB)。小さくして横帯を多く・のりしろの境目を多くする
+PARITY_TILE_BUDGET_MB = 8
+
+
+def check_parity(megapixels: List[float] = PARITY_MP) -> List[str]:
+    """
+    高速版のフィルターと元の実装 (タイル版は全体処理) の最大差を確かめ、許容差を超えたものを返す。
+    enhance_image はバッファプールの配列を使い回すので、違うサイズの画像を挟んでから
+    同じサイズに戻したとき (前の画像の値が残ったバッファを使うとき) も確かめる。
+    """
+    import process_image as pipeline
+    from color_lut import max_abs_diff
+    from buffer_pool import release_buffers
+    from tiling import enhance_tiled
+
+    failures = []
+
+    def check(name: str, fast: Image.Image, reference: Image.Image, tolerance: int) -> None:
+        diff = max_abs_diff(np.asarray(fast), np.asarray(reference))
+        print(json.dumps({'parity': name, 'max_abs_diff': diff, 'tolerance': tolerance}), flush=True)
+        if diff > tolerance:
+            failures.append(f"{name}: max diff {diff} > {tolerance}")
+
+    images = [Image.fromarray(synthetic_scene(*size_for_megapixels(mp), seed=i)) for i, mp in enumerate(megapixels)]
+    release_buffers()
+    for i, img in enumerate(images + images[:1]):
+        check(f"enhance/pooled/{i}", pipeline.enhance_image(img), pipeline._enhance_image_reference(img), ENHANCE_TOLERANCE)
+    # 既定の 1.2 倍以外の彩度 (float32 で LUT を作ると 1 ずれる倍率がある) も確かめる。
+    # 合成画像では当たらない値もあるので、全階調が出るノイズ画像を使う
+    noise = Image.fromarray(np.random.default_rng(0).integers(0, 256, (600, 800, 3), dtype=np.uint8))
+    for scale in PARITY_SATURATION_SCALES:
+        check(f"enhance/saturation{scale:g}", pipeline.enhance_image(noise, saturation_scale=scale),
+              pipeline._enhance_image_reference(noise, saturation_scale=scale), ENHANCE_TOLERANCE)
+    for i, img in enumerate(images):
+        for mood in (0.3, 0.6, 1.0):
+            check(f"sad/{i}/mood{mood:g}", pipeline.sad_filter(img, mood), pipeline._sad_filter_reference(img, mood), SAD_TOLERANCE)
+    # CLAHE のタイル数 (8) で割り切れない大きさも通す (OpenCV は右・下を拡張してからヒストグラムを取る)
+    for i, img in enumerate(images + [img.crop((0, 0, img.size[0] - 3, img.size[1] - 5)) for img in images[:1]]):
+        tiled = enhance_tiled(
+            img,
+            lambda region, equalize: pipeline._enhance_kernel(region, 2.0, 1.2, equalize),
+            lambda region: pipeline._sharpen(region, 0.3),
+            2.0,
+            budget_mb=PARITY_TILE_BUDGET_MB,
+        )
+        check(f"enhance/tiled/{i}", tiled, pipeline.enhance_image(img), TILED_TOLERANCE)
+    release_buffers()
+    return failures
+
+
+def _peak_rss_mb() -> float:
+    # Linux の ru_maxrss は exec をまたいで親プロセスの値を引き継ぐので、プロセスごとの VmHWM を優先する
+    try:
+        with open("/proc/self/status", encoding="ascii") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux は KB、macOS はバイト単位
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+def _stub_analysis(latency: float):
+    """
+    GPT の解析の代わりに、ローカル判定のスタイルをそのまま返すスタブ (latency 秒だけ待つ)。
+    """
+    from mapping_config import SCENERY_LABELS, EMOTION_LABELS
+
+    def analyze(image_path: str, img: Optional[Image.Image] = None, fallback_style: Optional[str] = None) -> Dict[str, str]:
+        if latency:
+            time.sleep(latency)
+        return {'style': fallback_style or 'vivid', 'scenery': SCENERY_LABELS[0], 'emotion': EMOTION_LABELS[0]}
+    return analyze
+
+
+def run_case(case: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    1ケースを計測する（子プロセスで呼ばれる）。
+    filter: 原寸でデコードした画像にフィルターをかける時間（デコードは含まない）
+    pipeline: process_image 全体（ローカル判定・解析スタブ・デコード・フィルター・保存）
+    """
+    import process_image as pipeline
+
+    times = []
+    if case['kind'] == 'filter':
+        img, _ = pipeline.load_image(case['path'], max_dim=0)
+        apply = {'enhance': pipeline.enhance_image, 'sad': pipeline.sad_filter, 'sketch': pipeline.pencil_sketch_filter}[case['name']]
+        for i in range(case['warmup'] + case['repeat']):
+            start = time.perf_counter()
+            apply(img)
+            if i >= case['warmup']:
+                times.append(time.perf_counter() - start)
+    else:
+        pipeline.analyze = _stub_analysis(case['analysis_latency'])
+        # force_analysis: ローカル判定で確定させず、解析 (スタブ) を待つ経路を通す
+        # それ以外: 既定の閾値 (無効) にかかわらず、ローカル判定で確定する経路を通す
+        pipeline.LOCAL_STYLE_THRESHOLD = float('inf') if case['force_analysis'] else 0.0
+        output_dir = tempfile.mkdtemp(prefix="bench-out-")
+        try:
+            for i in range(case['warmup'] + case['repeat']):
+                start = time.perf_counter()
+                pipeline.process_image(case['path'], output_dir, f"bench{i}", os.path.basename(case['path']))
+                if i >= case['warmup']:
+                    times.append(time.perf_counter() - start)
+        finally:
+            shutil.rmtree(output_dir, ignore_errors=True)
+
+    p50 = percentile(times, 50)
+    return {
+        'p50_ms': round(p50 * 1000, 1),
+        'p95_ms': round(percentile(times, 95) * 1000, 1),
+        'images_per_sec': round(len(times) / sum(times), 3),
+        'mp_per_sec': round(case['megapixels'] / p50, 2),
+        'peak_rss_mb': round(_peak_rss_mb(), 1),
+    }
+
+
+def _run_isolated(case: Dict[str, Any]) -> Dict[str, Any]:
+    with multiprocessing.get_context("spawn").Pool(1) as pool:
+        return pool.apply(run_case, (case,))
+
+
+def build_cases(fixtures: List[Dict[str, Any]], filters: List[str], args) -> List[Dict[str, Any]]:
+    common = {'repeat': args.repeat, 'warmup': args.warmup}
+    cases = []
+    for fixture in fixtures:
+        for name in filters:
+            cases.append(dict(common, kind='filter', name=name, **fixture))
+        if args.pipeline:
+            cases.append(dict(common, kind='pipeline', name='process_image',
+                              analysis_latency=args.analysis_latency, force_analysis=not args.local_only, **fixture))
+    return cases
+
+
+def case_key(case: Dict[str, Any]) -> str:
+    return f"{case['name']}/{case['label']}/{case['variant']}"
+
+
+def run(cases: List[Dict[str, Any]]) -> Dict[str, Dict[str, Any]]:
+    results = {}
+    for case in cases:
+        row = {'megapixels': case['megapixels'], **_run_isolated(case)}
+        results[case_key(case)] = row
+        print(json.dumps({'case': case_key(case), **row}), flush=True)
+    return results
+
+
+def compare(
+    results: Dict[str, Dict[str, Any]],
+    baseline: Dict[str, Dict[str, Any]],
+    threshold: float,
+    min_delta: float = 5.0
+) -> List[str]:
+    """
+    基準値より p50 / p95 / ピーク RSS が threshold (割合) を超えて悪化したケースを返す。
+    差が min_delta (ms または MB) 未満なら小さな画像の揺らぎとみなして無視する。
+    基準値にないケースは比較しない。
+    """
+    regressions = []
+    for key, row in results.items():
+        base = baseline.get(key)
+        if not base:
+            continue
+        for metric in ('p50_ms', 'p95_ms', 'peak_rss_mb'):
+            if metric in base and row[metric] > base[metric] * (1 + threshold) and row[metric] - base[metric] >= min_delta:
+                regressions.append(f"{key}: {metric} {base[metric]} -> {row[metric]} (+{row[metric] / base[metric] - 1:.0%})")
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark image filters and the process_image pipeline offline")
+    parser.add_argument("--mp", type=float, nargs="+", default=[1, 12, 24, 48], help="synthetic resolutions in megapixels")
+    parser.add_argument("--fixtures", nargs="*", default=[], help="extra JPEG files to benchmark as-is")
+    parser.add_argument("--variants", nargs="+", default=EXIF_VARIANTS, choices=EXIF_VARIANTS)
+    parser.add_argument("--filters", nargs="*", default=FILTERS, choices=FILTERS)
+    parser.add_argument("--no-pipeline", dest="pipeline", action="store_false", help="skip the end-to-end process_image cases")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--warmup", type=int, default=1)
+    parser.add_argument("--analysis-latency", type=float, default=0.0, help="seconds the stubbed GPT analysis takes")
+    parser.add_argument("--local-only", action="store_true", help="let the local style classifier decide (no analysis wait, regardless of LOCAL_STYLE_THRESHOLD)")
+    parser.add_argument("--output", default=None, help="write the results JSON here")
+    parser.add_argument("--baseline", default=None, help="baseline JSON to compare against")
+    parser.add_argument("--write-baseline", action="store_true", help="overwrite --baseline with these results")
+    parser.add_argument("--threshold", type=float, default=0.2, help="allowed slowdown / memory growth over the baseline (0.2 = 20%%)")
+    parser.add_argument("--min-delta", type=float, default=5.0, help="ignore regressions smaller than this many ms / MB")
+    parser.add_argument("--parity-only", action="store_true", help="only check the fast filters against the reference implementations")
+    parser.add_argument("--no-parity", dest="parity", action="store_false", help="skip the parity check")
+    args = parser.parse_args()
+
+    parity_failures = check_parity() if args.parity or args.parity_only else []
+    if parity_failures:
+        print("Parity check failed:\n  " + "\n  ".join(parity_failures), file=sys.stderr)
+    if args.parity_only:
+        sys.exit(1 if parity_failures else 0)
+
+    workdir = tempfile.mkdtemp(prefix="bench-")
+    try:
+        fixtures = []
+        for mp in args.mp:
+            for variant in args.variants:
+                path = os.path.join(workdir, f"{mp:g}mp-{variant}.jpg")
+                write_fixture(path, mp, variant == 'exif')
+                fixtures.append({'path': path, 'megapixels': mp, 'label': f"{mp:g}mp", 'variant': variant})
+        for path in args.fixtures:
+            with Image.open(path) as img:
+                mp = img.size[0] * img.size[1] / 1_000_000
+            fixtures.append({'path': os.path.abspath(path), 'megapixels': round(mp, 2),
+                             'label': os.path.basename(path), 'variant': 'fixture'})
+
+        results = run(build_cases(fixtures, args.filters, args))
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    report = {'cpu_count': os.cpu_count(), 'repeat': args.repeat, 'results': results}
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2)
+
+    if args.baseline and args.write_baseline:
+        with open(args.baseline, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2)
+        print(f"Baseline written to {args.baseline}", file=sys.stderr)
+    elif args.baseline:
+        with open(args.baseline, encoding='utf-8') as f:
+            baseline = json.load(f)['results']
+        regressions = compare(results, baseline, args.threshold, args.min_delta)
+        if regressions:
+            print("Regressions over the baseline:\n  " + "\n  ".join(regressions), file=sys.stderr)
+            sys.exit(1)
+        print(f"No regressions beyond {args.threshold:.0%} of the baseline.", file=sys.stderr)
+    if parity_failures:
+        sys.exit(1)
@@ -0,0 +1,71 @@
+import os
+import threading
+from typing import Dict, Tuple
+
+import cv2
+import numpy as np
+
+# =================================================================
+# 作業用バッファの使い回し
+# =================================================================
+# フィルターの中間画像 (LAB, HSV, ぼかし等) は毎回同じサイズになることが多いので、
+# 名前・形状・型ごとに確保済みの配列を使い回す。
+# 常駐ワーカーは複数スレッドで画像を処理するため、プールはスレッドごとに持つ。
+# 1スレッドのプールは BUFFER_POOL_MAX_MB までにし、超える分は最後に使ったのが古い順に手放す。
+# process_image はジョブの終わりに release_buffers() を呼ぶので、待機中のスレッドはバッファを持たない。
+
+# 1スレッドのプールが持つバッファの合計の上限 (MB)。これより大きいバッファはプールに入れない
+BUFFER_POOL_MAX_MB = int(os.environ.get("BUFFER_POOL_MAX_MB", "96"))
+
+_local = threading.local()
+
+
+def get_buffer(name: str, shape: Tuple[int, ...], dtype=np.uint8) -> np.ndarray:
+    """
+    name 用の作業バッファを返す。形状か型が前回と違う場合だけ確保し直す。
+    返した配列は次に同じ name で呼ばれるまで有効（呼び出し側の戻り値にはしないこと）。
+    """
+    pool: Dict[str, np.ndarray] = getattr(_local, "buffers", None)
+    if pool is None:
+        pool = _local.buffers = {}
+    # dict の順序を「最後に使った順」として使う
+    buf = pool.pop(name, None)
+    if buf is None or buf.shape != tuple(shape) or buf.dtype != np.dtype(dtype):
+        buf = np.empty(shape, dtype=dtype)
+    limit = BUFFER_POOL_MAX_MB * 1024 * 1024
+    if buf.nbytes > limit:
+        return buf
+    total = sum(b.nbytes for b in pool.values()) + buf.nbytes
+    while total > limit:
+        total -= pool.pop(next(iter(pool))).nbytes
+    pool[name] = buf
+    return buf
+
+
+def pooled_bytes() -> int:
+    """
+    このスレッドのプールが持っているバッファの合計 (バイト)。
+    """
+    return sum(b.nbytes for b in getattr(_local, "buffers", {}).values())
+
+
+def release_buffers() -> None:
+    """
+    このスレッドのバッファをすべて解放する（ジョブの終わりに呼ぶ）。
+    """
+    _local.buffers = {}
+
+
+def get_clahe(clip_limit: float, tile_grid_size: Tuple[int, int] = (8, 8)):
+    """
+    CLAHE オブジェクトをパラメータごとに使い回す（スレッドごと）。
+    """
+    cache = getattr(_local, "clahe", None)
+    if cache is None:
+        cache = _local.clahe = {}
+    key = (clip_limit, tuple(tile_grid_size))
+    clahe = cache.get(key)
+    if clahe is None:
+        clahe = cv2.createCLAHE(clipLimit=clip_limit, tileGridSize=tuple(tile_grid_size))
+        cache[key] = clahe
+    return clahe
@@ -0,0 +1,41 @@
+from functools import lru_cache
+from typing import Tuple
+
+import numpy as np
+
+# =================================================================
+# 色変換用のルックアップテーブル (cv2.LUT で適用する)
+# =================================================================
+# sad_filter や enhance_image の彩度調整は「チャンネルごとの値を定数倍するだけ」なので、
+# パラメータごとに 256 要素の表を一度だけ作っておけば cv2.LUT 1回で適用できる。
+# float32 の中間配列も split / merge も不要になる。
+# 表の値は元の実装と同じ丸め方で作っているので、結果は元の実装とビット単位で一致する。
+
+
+@lru_cache(maxsize=32)
+def scale_lut(scales: Tuple[float, float, float], rounding: str = "floor") -> np.ndarray:
+    """
+    3チャンネルそれぞれを定数倍する (256, 1, 3) の uint8 LUT を返す。
+    rounding="floor": float32 で掛けて astype(np.uint8) した場合と同じ（切り捨て）
+    rounding="round": cv2.multiply と同じ（double で掛けて最近接偶数への丸め）
+    """
+    columns = []
+    for scale in scales:
+        if rounding == "floor":
+            values = np.arange(256, dtype=np.float32) * np.float32(scale)
+        elif rounding == "round":
+            # cv2.multiply は double で計算するので、float32 で作ると 1 ずれる値がある (1.1 倍の 55 など)
+            values = np.round(np.arange(256, dtype=np.float64) * float(scale))
+        else:
+            raise ValueError(f"Unknown rounding: {rounding}")
+        columns.append(np.clip(values, 0, 255).astype(np.uint8))
+    lut = np.stack(columns, axis=-1).reshape(256, 1, 3)
+    lut.setflags(write=False)
+    return lut
+
+
+def max_abs_diff(a: np.ndarray, b: np.ndarray) -> int:
+    """
+    2枚の uint8 画像の最大差（階調数）を返す。LUT 版と元の実装の一致確認に使う。
+    """
+    return int(np.abs(a.astype(np.int16) - b.astype(np.int16)).max())
@@ -1,36 +1,174 @@
 import sys
 import json
 import os
-import base64
-from openai import OpenAI
-from dotenv import load_dotenv
 import random
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List
 
-# 設定ファイルと.envの読み込み
+# 設定ファイルの読み込み (.env は openai_client 側で読み込む)
 sys.path.append(os.path.dirname(__file__))
-from mapping_config import SCENERY_LABELS, EMOTION_LABELS, MUSIC_MAPPING, STAMP_MAPPING
-
-load_dotenv(os.path.join(os.path.dirname(__file__), '../.env'))
-client = OpenAI(api_key=os.environ.get("OPENAI_API_KEY"))
-
-# AI分析用のヘルパー関数
-def encode_image(image_path):
-    with open(image_path, "rb") as image_file:
-        return base64.b64encode(image_file.read()).decode('utf-8')
-
-def analyze_image(image_path):
-    print(f"GPT Analyzing: {image_path}", file=sys.stderr)
-    base64_image = encode_image(image_path)
-    # base64_image = convert_to_base64_uri(image_path)
-    response = client.chat.completions.create(
-        model="gpt-4o",
-        messages=[
-            {"role": "system", "content": f"""Analyze this image and return JSON. Scenery Options: {SCENERY_LABELS} Emotion Options: {EMOTION_LABELS} Format: {{ "scenery": "...", "emotion": "..." }}"""},
-            {"role": "user", "content": [{"type": "text", "text": "Analyze this image."}, {"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{base64_image}"}}]},
-        ],
-        response_format={"type": "json_object"}
-    )
-    return json.loads(response.choices[0].message.content)
+from mapping_config import MUSIC_MAPPING, STAMP_MAPPING
+from analysis import analyze_batch, ANALYSIS_BATCH_SIZE
+from phash import signature, parse_signature, group_near_duplicates
+from telemetry import span, count, flush
+from timeline import timeline_job
+
+# 同時に投げる解析リクエストの上限 (1分あたりの上限は OPENAI_RPM_LIMIT)
+ANALYSIS_CONCURRENCY = int(os.environ.get("ANALYSIS_CONCURRENCY", "5"))
+
+def analyze_all(input_data: List[Dict[str, Any]]) -> List[Dict[str, str]]:
+    """
+    全画像の解析を実行し、入力と同じ順序で結果を返す。
+    process_image.py で判定済みでない画像は ANALYSIS_BATCH_SIZE 枚ずつ1回のリクエストにまとめ、
+    まとまり同士は並行して実行する。待ち時間は合計ではなく、最も遅い1件に近づく。
+    """
+    results: List[Dict[str, str]] = [None] * len(input_data)
+    pending = []
+    for index, data in enumerate(input_data):
+        gpt_result = data.get('analysis') or {}
+        if gpt_result.get('scenery') and gpt_result.get('emotion'):
+            results[index] = gpt_result
+        else:
+            print(f"Reading file from: {data['temp_path']}", file=sys.stderr)
+            pending.append(index)
+
+    batch_size = max(1, ANALYSIS_BATCH_SIZE)
+    chunks = [pending[i:i + batch_size] for i in range(0, len(pending), batch_size)]
+
+    def run_chunk(chunk: List[int]) -> List[Dict[str, str]]:
+        analyses = analyze_batch([input_data[i]['temp_path'] for i in chunk], batch_size)
+        return [{"scenery": a["scenery"], "emotion": a["emotion"]} for a in analyses]
+
+    if len(chunks) <= 1 or ANALYSIS_CONCURRENCY <= 1:
+        chunk_results = [run_chunk(chunk) for chunk in chunks]
+    else:
+        with ThreadPoolExecutor(max_workers=min(ANALYSIS_CONCURRENCY, len(chunks))) as executor:
+            chunk_results = list(executor.map(run_chunk, chunks))
+
+    for chunk, analyses in zip(chunks, chunk_results):
+        for index, analysis in zip(chunk, analyses):
+            results[index] = analysis
+    return results
+
+def _item_signature(data: Dict[str, Any]):
+    """
+    process_image.py が計算したシグネチャ (dHash + 平均色) を使い、なければファイルから計算する。
+    平坦な写真・読めない写真は None (近似重複として扱わない)。
+    """
+    if 'phash' in data:
+        return parse_signature(data['phash'])
+    try:
+        return parse_signature(signature(data['temp_path']))
+    except Exception as e:
+        print(f"dHash Warning: {data.get('temp_path')}: {e}", file=sys.stderr)
+        return None
+
+def build_effects(input_data: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """
+    画像メタデータのリストを受け取り、画像ごとの解析結果と効果（BGM・スタンプ）のリストを返す。
+    CLI と常駐ワーカーの両方から呼ばれる。
+    """
+    results = []
+    
+    # ★ポイント: 「どのスタンプをもう使ったか」を管理する辞書
+    # キー: 感情ラベル, 値: まだ使っていないスタンプのリスト
+    available_stamps = {}
+
+    # マッピング定義からコピーしてシャッフルしておく（ランダム順にするため）
+    for emotion, stamps in STAMP_MAPPING.items():
+        if isinstance(stamps, list):
+            shuffled = stamps[:] # コピー作成
+            random.shuffle(shuffled) # シャッフル
+            available_stamps[emotion] = shuffled
+        else:
+            available_stamps[emotion] = [stamps] # 1個だけの場合もリスト化
+
+    # 2. 連写などのほぼ同じ写真は、先頭の写真 (代表) の解析結果と効果をそのまま使う
+    with span("dedupe", images=len(input_data)) as s:
+        representatives = group_near_duplicates([_item_signature(data) for data in input_data])
+        unique_indexes = [i for i, rep in enumerate(representatives) if rep is None]
+        s['duplicates'] = len(input_data) - len(unique_indexes)
+    if len(unique_indexes) < len(input_data):
+        print(f"Near-duplicates: {len(input_data) - len(unique_indexes)} of {len(input_data)} reuse a representative", file=sys.stderr)
+        count("near_duplicates_total", len(input_data) - len(unique_indexes))
+
+    # 3. GPT解析は代表の写真だけを並行で実行する (結果は入力順)
+    with span("analysis_all", images=len(unique_indexes)):
+        unique_analyses = analyze_all([input_data[i] for i in unique_indexes])
+    analyses = [None] * len(input_data)
+    for i, result in zip(unique_indexes, unique_analyses):
+        analyses[i] = result
+
+    # 4. スタンプの重複防止は入力順に処理する
+    for index, data in enumerate(input_data):
+        rep = representatives[index]
+        if rep is not None:
+            # 代表と同じ BGM・スタンプにする（スタンプの在庫は消費しない）
+            results.append({
+                'temp_path': data['temp_path'],
+                'analysis': dict(results[rep]['analysis']),
+                'effects': dict(results[rep]['effects']),
+                'duplicate_of': rep
+            })
+            continue
+        gpt_result = analyses[index]
+        file_system_path = data['temp_path']
+        scenery = gpt_result.get("scenery", "default")
+        emotion = gpt_result.get("emotion", "default")
+        
+        # 音楽決定 (シチュエーションに基づく)
+        music_id = MUSIC_MAPPING.get(scenery, MUSIC_MAPPING["default"])
+        
+        # ==========================================
+        # ★スタンプ決定 (重複防止ロジック)
+        # ==========================================
+        
+        # その感情の「まだ使っていないスタンプリスト」を取得
+        # なければデフォルトのリストを取得
+        candidates = available_stamps.get(emotion)
+        if not candidates:
+             # 万が一空なら補充（リセット）
+            refill = STAMP_MAPPING.get(emotion, STAMP_MAPPING["default"])
+            if isinstance(refill, list):
+                candidates = refill[:]
+                random.shuffle(candidates)
+            else:
+                candidates = [refill]
+            available_stamps[emotion] = candidates
+
+        # リストから1つ取り出す (pop) -> 「使った」ことになる
+        stamp_id = candidates.pop(0) 
+        
+        # もしリストが空になったら、次に来る同じ感情のために補充しておく
+        if len(candidates) == 0:
+            refill = STAMP_MAPPING.get(emotion, STAMP_MAPPING["default"])
+            if isinstance(refill, list):
+                new_stock = refill[:]
+                random.shuffle(new_stock)
+                available_stamps[emotion] = new_stock
+            else:
+                available_stamps[emotion] = [refill]
+
+        # ==========================================
+
+        sound_file = f"{music_id}.mp3"
+        stamp_file = f"{stamp_id}.png"
+        
+        # 結果リストに追加
+        results.append({
+            # 元のデータ情報を保持したい場合はここに追加
+            'temp_path': file_system_path,
+            'analysis':{
+                'scenery': scenery,
+                'emotion': emotion
+            },
+            'effects': {
+                'sound': f'/assets/sounds/{sound_file}',
+                'stamp': f'/assets/stamps/{stamp_file}'
+            }
+        })
+
+    return results
 
 def decide_effects(json_str: str):
     try:
@@ -40,85 +178,10 @@ def decide_effects(json_str: str):
         # もしリストじゃなかったらリストに変換（後方互換性のため）
         if not isinstance(input_data, list):
             input_data = [input_data]
-            
-        results = []
-        
-        # ★ポイント: 「どのスタンプをもう使ったか」を管理する辞書
-        # キー: 感情ラベル, 値: まだ使っていないスタンプのリスト
-        available_stamps = {}
-
-        # マッピング定義からコピーしてシャッフルしておく（ランダム順にするため）
-        for emotion, stamps in STAMP_MAPPING.items():
-            if isinstance(stamps, list):
-                shuffled = stamps[:] # コピー作成
-                random.shuffle(shuffled) # シャッフル
-                available_stamps[emotion] = shuffled
-            else:
-                available_stamps[emotion] = [stamps] # 1個だけの場合もリスト化
-
-        # 2. 画像ごとにループ処理
-        for data in input_data:
-            file_system_path = data['temp_path']
-            print(f"Reading file from: {file_system_path}", file=sys.stderr)
-            
-            # GPT解析
-            gpt_result = analyze_image(file_system_path)
-            scenery = gpt_result.get("scenery", "default")
-            emotion = gpt_result.get("emotion", "default")
-            
-            # 音楽決定 (シチュエーションに基づく)
-            music_id = MUSIC_MAPPING.get(scenery, MUSIC_MAPPING["default"])
-            
-            # ==========================================
-            # ★スタンプ決定 (重複防止ロジック)
-            # ==========================================
-            
-            # その感情の「まだ使っていないスタンプリスト」を取得
-            # なければデフォルトのリストを取得
-            candidates = available_stamps.get(emotion)
-            if not candidates:
-                 # 万が一空なら補充（リセット）
-                refill = STAMP_MAPPING.get(emotion, STAMP_MAPPING["default"])
-                if isinstance(refill, list):
-                    candidates = refill[:]
-                    random.shuffle(candidates)
-                else:
-                    candidates = [refill]
-                available_stamps[emotion] = candidates
-
-            # リストから1つ取り出す (pop) -> 「使った」ことになる
-            stamp_id = candidates.pop(0) 
-            
-            # もしリストが空になったら、次に来る同じ感情のために補充しておく
-            if len(candidates) == 0:
-                refill = STAMP_MAPPING.get(emotion, STAMP_MAPPING["default"])
-                if isinstance(refill, list):
-                    new_stock = refill[:]
-                    random.shuffle(new_stock)
-                    available_stamps[emotion] = new_stock
-                else:
-                    available_stamps[emotion] = [refill]
-
-            # ==========================================
-
-            sound_file = f"{music_id}.mp3"
-            stamp_file = f"{stamp_id}.png"
-            
-            # 結果リストに追加
-            results.append({
-                # 元のデータ情報を保持したい場合はここに追加
-                'temp_path': file_system_path,
-                'analysis':{
-                    'scenery': scenery,
-                    'emotion': emotion
-                },
-                'effects': {
-                    'sound': f'/assets/sounds/{sound_file}',
-                    'stamp': f'/assets/stamps/{stamp_file}'
-                }
-            })
 
-        # 4. JSON文字列を標準出力に書き出し、Node.jsに返す
+        results = build_effects(input_data)
+
+        # JSON文字列を標準出力に書き出し、Node.jsに返す
         print(json.dumps(results))
         print(f"Successfully decided effects", file=sys.stderr)
         sys.exit(0)
@@ -127,9 +190,39 @@ def decide_effects(json_str: str):
         print(f"Error in effect decision: {e}", file=sys.stderr)
         sys.exit(1)
 
+def decide_effects_job(args: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """
+    常駐ワーカー用のジョブハンドラ。
+    args: {"items": [画像メタデータ, ...]}
+    """
+    input_data = args.get('items', [])
+    if not isinstance(input_data, list):
+        input_data = [input_data]
+    try:
+        with span("decide_effects", images=len(input_data)):
+            results = build_effects(input_data)
+    finally:
+        flush()
+    print(f"Successfully decided effects", file=sys.stderr)
+    return results
+
 if __name__ == "__main__":
+    if len(sys.argv) >= 2 and sys.argv[1] == "--profile-startup":
+        # 起動時間 (import) をモジュールごとに計測し、STARTUP_BUDGET_MS を超えていれば終了コード 1
+        from startup_profile import main as profile_startup
+        sys.exit(profile_startup("decide_effects"))
+
+    if len(sys.argv) >= 2 and sys.argv[1] == "--worker":
+        # 常駐モード: stdin から NDJSON のジョブを受け取り続ける
+        from worker import serve
+        concurrency = int(os.environ.get("PY_WORKER_CONCURRENCY", "4"))
+        serve({"decide_effects": decide_effects_job, "timeline": timeline_job}, concurrency=concurrency)
+        sys.exit(0)
+
     if len(sys.argv) != 2:
         print("Usage: python decide_effects.py <metadata_json_string>", file=sys.stderr)
+        print("       python decide_effects.py --worker", file=sys.stderr)
+        print("       python decide_effects.py --profile-startup", file=sys.stderr)
         sys.exit(1)
     
     json_str = sys.argv[1]
@@ -0,0 +1,111 @@
+import sys
+import os
+import json
+import mmap
+from typing import Any, Dict, Optional, Tuple
+
+# =================================================================
+# process_image → decide_effects の受け渡しファイル
+# =================================================================
+# process_image が一時ファイルの隣に書き出し、decide_effects が原寸の画像を読み直す代わりに使う。
+#   <temp_path>.analysis.jpg  : 向き補正・縮小済みの解析用 JPEG (prepare_analysis_image と同じもの)
+#   <temp_path>.analysis.json : 元ファイルのサイズ・更新時刻、解析画像の設定、SHA-256、近似重複用のシグネチャ (phash.signature)
+# 元ファイルが変わっていたり、解析画像の設定 (ANALYSIS_MAX_EDGE など) が違ったりしたら使わない。
+# 削除は一時ファイルと一緒に呼び出し側 (index.js) が行う。
+
+HANDOFF_VERSION = 2
+
+JPEG_SUFFIX = ".analysis.jpg"
+SIDECAR_SUFFIX = ".analysis.json"
+
+
+def handoff_paths(temp_path: str) -> Tuple[str, str]:
+    return temp_path + JPEG_SUFFIX, temp_path + SIDECAR_SUFFIX
+
+
+def _write_atomic(path: str, data: bytes) -> None:
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+
+def write_handoff(
+    temp_path: str,
+    jpeg: bytes,
+    settings: str,
+    sha256: Optional[str] = None,
+    phash: Optional[str] = None
+) -> None:
+    """
+    解析用 JPEG とサイドカーを書き出す。サイドカーは最後に書くので、サイドカーがあれば JPEG も揃っている。
+    """
+    stat = os.stat(temp_path)
+    jpeg_path, sidecar_path = handoff_paths(temp_path)
+    _write_atomic(jpeg_path, jpeg)
+    sidecar = {
+        'version': HANDOFF_VERSION,
+        'source_size': stat.st_size,
+        'source_mtime_ns': stat.st_mtime_ns,
+        'settings': settings,
+        'jpeg_bytes': len(jpeg),
+        'sha256': sha256,
+        'phash': phash,
+    }
+    _write_atomic(sidecar_path, json.dumps(sidecar).encode("utf-8"))
+
+
+class Handoff:
+    """
+    読み込んだ受け渡しファイル。jpeg はメモリマップ (コピーせずに base64 に渡せる)。
+    使い終わったら close() する。
+    """
+
+    def __init__(self, sidecar: Dict[str, Any], jpeg: mmap.mmap):
+        self.sha256: Optional[str] = sidecar.get('sha256')
+        self.phash: Optional[str] = sidecar.get('phash')
+        self.jpeg = jpeg
+
+    def close(self) -> None:
+        self.jpeg.close()
+
+    def __enter__(self) -> "Handoff":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+
+def read_sidecar(temp_path: str, settings: str) -> Optional[Dict[str, Any]]:
+    """
+    サイドカーを読み、元ファイルと設定が一致していれば返す（なければ・古ければ None）。
+    """
+    jpeg_path, sidecar_path = handoff_paths(temp_path)
+    try:
+        with open(sidecar_path, encoding="utf-8") as f:
+            sidecar = json.load(f)
+        stat = os.stat(temp_path)
+        jpeg_size = os.path.getsize(jpeg_path)
+    except (OSError, ValueError):
+        return None
+    if (sidecar.get('version') != HANDOFF_VERSION
+            or sidecar.get('settings') != settings
+            or sidecar.get('source_size') != stat.st_size
+            or sidecar.get('source_mtime_ns') != stat.st_mtime_ns
+            or sidecar.get('jpeg_bytes') != jpeg_size
+            or not jpeg_size):
+        print(f"Handoff for {temp_path} is stale; re-reading the original.", file=sys.stderr)
+        return None
+    return sidecar
+
+
+def read_handoff(temp_path: str, settings: str) -> Optional[Handoff]:
+    sidecar = read_sidecar(temp_path, settings)
+    if sidecar is None:
+        return None
+    jpeg_path, _ = handoff_paths(temp_path)
+    try:
+        with open(jpeg_path, "rb") as f:
+            return Handoff(sidecar, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+    except (OSError, ValueError):
+        return None
@@ -0,0 +1,55 @@
+import cv2
+import numpy as np
+
+# =================================================================
+# 画質比較用の指標
+# =================================================================
+
+
+def to_gray(img: np.ndarray) -> np.ndarray:
+    """
+    RGB / グレーの uint8 画像をグレーにする。
+    """
+    if img.ndim == 3:
+        return cv2.cvtColor(img, cv2.COLOR_RGB2GRAY)
+    return img
+
+
+def resize_long_edge(img: np.ndarray, edge: int) -> np.ndarray:
+    """
+    長辺が edge になるよう縮小する（拡大はしない）。
+    """
+    h, w = img.shape[:2]
+    scale = edge / max(h, w)
+    if scale >= 1.0:
+        return img
+    return cv2.resize(img, (max(1, round(w * scale)), max(1, round(h * scale))), interpolation=cv2.INTER_AREA)
+
+
+def ssim(a: np.ndarray, b: np.ndarray) -> float:
+    """
+    2枚の画像の SSIM (ガウス窓 11x11, sigma=1.5) をグレースケールで計算して平均値を返す。
+    1.0 で完全一致。
+    """
+    x = to_gray(a).astype(np.float32)
+    y = to_gray(b).astype(np.float32)
+    c1 = (0.01 * 255) ** 2
+    c2 = (0.03 * 255) ** 2
+
+    def blur(z):
+        return cv2.GaussianBlur(z, (11, 11), 1.5)
+
+    mu_x, mu_y = blur(x), blur(y)
+    var_x = blur(x * x) - mu_x * mu_x
+    var_y = blur(y * y) - mu_y * mu_y
+    cov = blur(x * y) - mu_x * mu_y
+    ssim_map = ((2 * mu_x * mu_y + c1) * (2 * cov + c2)) / ((mu_x * mu_x + mu_y * mu_y + c1) * (var_x + var_y + c2))
+    return float(ssim_map.mean())
+
+
+def display_ssim(a: np.ndarray, b: np.ndarray, edge: int = 1024) -> float:
+    """
+    結果ページの表示サイズ (長辺 edge) に縮小してから SSIM を計算する。
+    鉛筆画の細かいテクスチャではなく、見た目の構造の一致を見るための指標。
+    """
+    return ssim(resize_long_edge(a, edge), resize_long_edge(b, edge))
@@ -0,0 +1,270 @@
+import sys
+import os
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import threading
+import subprocess
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Dict, List, Optional
+
+sys.path.append(os.path.dirname(__file__))
+from benchmark import write_fixture, percentile
+from mock_openai_server import add_arguments, state_from_args, start_server
+from handoff import handoff_paths
+
+# =================================================================
+# 負荷試験 (常駐ワーカー + OpenAI 互換のモックサーバー)
+# =================================================================
+# 使い方:
+#   python scripts/load_generator.py --sessions 20 --parallel 4 --photos 6 --latency lognormal:0.8:0.5 --rate-limit-rate 0.05
+#   python scripts/load_generator.py --base-url http://127.0.0.1:8089/v1 ...   # 別プロセスで起動したモックを使う
+# Node.js と同じく process_image.py / decide_effects.py を --worker で常駐させ、NDJSON でジョブを送る。
+# 1セッション = 1回のアップロード (photos 枚の process_image を並行実行 → decide_effects を1回)。
+# index.js と同じく、写真はジョブごとの一時ファイルにコピーして handoff: true で送り、
+# decide_effects の後で一時ファイルと受け渡しファイル (handoff.py) を削除する。
+# セッションを parallel 件ずつ同時に流し、ジョブごと・セッションごとの p50 / p95 / p99 と
+# スループット、モックサーバー側のリクエスト数・注入したエラー数を JSON で出す。
+
+SCRIPTS_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+class WorkerClient:
+    """
+    常駐ワーカー (--worker) の NDJSON クライアント。index.js の PythonWorker と同じ使い方をする。
+    """
+
+    def __init__(self, script: str, env: Dict[str, str], log):
+        self._proc = subprocess.Popen(
+            [sys.executable, os.path.join(SCRIPTS_DIR, script), "--worker"],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=log, text=True, env=env, bufsize=1
+        )
+        self._pending: Dict[int, Future] = {}
+        self._next_id = 0
+        self._lock = threading.Lock()
+        threading.Thread(target=self._read, daemon=True).start()
+
+    def _read(self) -> None:
+        for line in self._proc.stdout:
+            try:
+                message = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            with self._lock:
+                future = self._pending.pop(message.get('id'), None)
+            if future is None:
+                continue
+            if message.get('ok'):
+                future.set_result(message.get('result'))
+            else:
+                future.set_exception(RuntimeError(message.get('error')))
+        # ワーカーが終了したら待っているジョブをすべて失敗させる
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        for future in pending.values():
+            future.set_exception(RuntimeError("worker exited"))
+
+    def call(self, op: str, args: Dict[str, Any]) -> Any:
+        future: Future = Future()
+        with self._lock:
+            self._next_id += 1
+            job_id = self._next_id
+            self._pending[job_id] = future
+            self._proc.stdin.write(json.dumps({'id': job_id, 'op': op, 'args': args}) + "\n")
+            self._proc.stdin.flush()
+        return future.result()
+
+    def wait_ready(self) -> None:
+        """
+        import が終わるまで待つ (未知の op にはすぐエラーが返る)。起動時間を計測に含めないため。
+        """
+        try:
+            self.call('ping', {})
+        except RuntimeError:
+            pass
+
+    def close(self) -> None:
+        self._proc.stdin.close()
+        self._proc.wait()
+
+
+def summarize(seconds: List[float]) -> Dict[str, Any]:
+    if not seconds:
+        return {'count': 0}
+    return {
+        'count': len(seconds),
+        'p50_ms': round(percentile(seconds, 50) * 1000, 1),
+        'p95_ms': round(percentile(seconds, 95) * 1000, 1),
+        'p99_ms': round(percentile(seconds, 99) * 1000, 1),
+        'max_ms': round(max(seconds) * 1000, 1),
+    }
+
+
+class LoadRun:
+    def __init__(self, process_worker: WorkerClient, effects_worker: WorkerClient, output_dir: str, upload_dir: str):
+        self.process_worker = process_worker
+        self.effects_worker = effects_worker
+        self.output_dir = output_dir
+        self.upload_dir = upload_dir
+        self.timings: Dict[str, List[float]] = {'process_image': [], 'decide_effects': [], 'session': []}
+        self.errors: Dict[str, int] = {'process_image': 0, 'decide_effects': 0}
+        self.style_sources: Dict[str, int] = {}
+        self.fallbacks = 0
+        self._lock = threading.Lock()
+
+    def _timed(self, kind: str, fn, *args):
+        start = time.perf_counter()
+        try:
+            return fn(*args)
+        except Exception as e:
+            print(f"{kind} failed: {e}", file=sys.stderr)
+            with self._lock:
+                self.errors[kind] += 1
+            return None
+        finally:
+            with self._lock:
+                self.timings[kind].append(time.perf_counter() - start)
+
+    def _process_one(self, session: int, index: int, path: str, temp_path: str) -> Optional[Dict[str, Any]]:
+        # index.js の processImage と同じ引数
+        meta = self._timed('process_image', self.process_worker.call, 'process_image', {
+            'temp_path': temp_path,
+            'output_dir': self.output_dir,
+            'result_id': f"load{session}-{index}",
+            'original_name': os.path.basename(path),
+            'handoff': True,
+        })
+        if meta:
+            with self._lock:
+                source = meta.get('style_source', 'unknown')
+                self.style_sources[source] = self.style_sources.get(source, 0) + 1
+        return meta
+
+    def session(self, session: int, paths: List[str], photo_workers: ThreadPoolExecutor) -> None:
+        # multer の一時ファイルと同じく、アップロードごとに別のファイルにする (コピーは計測に含めない)
+        temp_paths = [os.path.join(self.upload_dir, f"s{session}-{i}{os.path.splitext(path)[1]}") for i, path in enumerate(paths)]
+        for path, temp_path in zip(paths, temp_paths):
+            shutil.copyfile(path, temp_path)
+        start = time.perf_counter()
+        try:
+            futures = [photo_workers.submit(self._process_one, session, i, path, temp_path)
+                       for i, (path, temp_path) in enumerate(zip(paths, temp_paths))]
+            metas = [m for m in (f.result() for f in futures) if m]
+            if metas:
+                effects = self._timed('decide_effects', self.effects_worker.call, 'decide_effects', {'items': metas})
+                if effects:
+                    # 'default' は API の選択肢に含まれない (解析が失敗してフォールバックした写真)
+                    with self._lock:
+                        self.fallbacks += sum(1 for e in effects if e.get('analysis', {}).get('emotion') == 'default')
+        finally:
+            # index.js の cleanupUploadFile と同じく、一時ファイルと受け渡しファイルを消す
+            for temp_path in temp_paths:
+                for leftover in (temp_path, *handoff_paths(temp_path)):
+                    try:
+                        os.remove(leftover)
+                    except FileNotFoundError:
+                        pass
+        with self._lock:
+            self.timings['session'].append(time.perf_counter() - start)
+
+
+def fetch_stats(base_url: str) -> Optional[Dict[str, Any]]:
+    from urllib.request import urlopen
+    try:
+        with urlopen(base_url.rstrip("/") + "/stats", timeout=5) as response:
+            return json.load(response)
+    except Exception:
+        return None
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Drive process_image / decide_effects workers against a mock OpenAI API")
+    parser.add_argument("--sessions", type=int, default=10, help="number of uploads to simulate")
+    parser.add_argument("--parallel", type=int, default=2, help="uploads in flight at once")
+    parser.add_argument("--photos", type=int, default=6, help="photos per upload")
+    parser.add_argument("--distinct", type=int, default=12, help="distinct synthetic photos to cycle through")
+    parser.add_argument("--mp", type=float, default=2, help="synthetic photo size in megapixels")
+    parser.add_argument("--inputs", nargs="*", default=[], help="use these photos instead of synthetic ones")
+    parser.add_argument("--worker-concurrency", type=int, default=4, help="PY_WORKER_CONCURRENCY for each worker")
+    parser.add_argument("--force-analysis", action="store_true",
+                        help="send every photo to the API from process_image even if LOCAL_STYLE_THRESHOLD is set (sets it to 2)")
+    parser.add_argument("--base-url", default=None, help="use an already running mock / API instead of starting one")
+    parser.add_argument("--output", default=None, help="write the report JSON here")
+    parser.add_argument("--log", default=None, help="append worker stderr here (default: discard)")
+    add_arguments(parser)
+    args = parser.parse_args()
+
+    server = None
+    base_url = args.base_url
+    if base_url is None:
+        server = start_server(state_from_args(args))
+        base_url = f"http://127.0.0.1:{server.server_address[1]}/v1"
+
+    workdir = tempfile.mkdtemp(prefix="loadgen-")
+    env = dict(os.environ)
+    env.update({
+        'OPENAI_BASE_URL': base_url,
+        'OPENAI_API_KEY': env.get('OPENAI_API_KEY', 'mock'),
+        'PY_WORKER_CONCURRENCY': str(args.worker_concurrency),
+        # 毎回 API まで届くように解析キャッシュは使わない
+        'ANALYSIS_CACHE_DISABLE': '1',
+        'TELEMETRY': env.get('TELEMETRY', '0'),
+    })
+    if args.force_analysis:
+        env['LOCAL_STYLE_THRESHOLD'] = '2'
+
+    log = open(args.log, 'a', encoding='utf-8') if args.log else subprocess.DEVNULL
+    try:
+        paths = [os.path.abspath(p) for p in args.inputs]
+        if not paths:
+            for i in range(args.distinct):
+                path = os.path.join(workdir, f"photo{i}.jpg")
+                write_fixture(path, args.mp, with_exif=i % 2 == 1, seed=i)
+                paths.append(path)
+        output_dir = os.path.join(workdir, "out")
+        os.makedirs(output_dir)
+        upload_dir = os.path.join(workdir, "uploads")
+        os.makedirs(upload_dir)
+
+        process_worker = WorkerClient("process_image.py", env, log)
+        effects_worker = WorkerClient("decide_effects.py", env, log)
+        process_worker.wait_ready()
+        effects_worker.wait_ready()
+        run = LoadRun(process_worker, effects_worker, output_dir, upload_dir)
+
+        started = time.perf_counter()
+        photo_workers = ThreadPoolExecutor(max_workers=max(1, args.parallel * args.photos))
+        with ThreadPoolExecutor(max_workers=max(1, args.parallel)) as sessions:
+            for s in range(args.sessions):
+                session_paths = [paths[(s * args.photos + i) % len(paths)] for i in range(args.photos)]
+                sessions.submit(run.session, s, session_paths, photo_workers)
+        elapsed = time.perf_counter() - started
+        photo_workers.shutdown()
+        process_worker.close()
+        effects_worker.close()
+    finally:
+        if log is not subprocess.DEVNULL:
+            log.close()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    report = {
+        'base_url': base_url,
+        'sessions': args.sessions,
+        'parallel': args.parallel,
+        'photos_per_session': args.photos,
+        'elapsed_s': round(elapsed, 2),
+        'photos_per_sec': round(len(run.timings['process_image']) / elapsed, 3),
+        'latency': {kind: summarize(values) for kind, values in run.timings.items()},
+        'errors': run.errors,
+        'style_source': run.style_sources,
+        'fallback_effects': run.fallbacks,
+        'server': fetch_stats(base_url),
+    }
+    if server is not None:
+        server.shutdown()
+    print(json.dumps(report, indent=2))
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2)
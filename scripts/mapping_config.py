@@ -236,4 +236,85 @@ if "default" in EMOTION_LABELS:
 EMOTION_LABELS_STR = ", ".join(EMOTION_LABELS)
 
 
+# =================================================================
+# GPT 解析用のラベルスキーマ (Structured Outputs)
+# =================================================================
+# ラベルの一覧はプロンプトに埋め込まず、JSON スキーマの enum で渡す。
+# strict モードでは回答が必ず enum のどれかになるので、想定外の値で "default" に落ちることがない。
+
+STYLE_LABELS = ['vivid', 'sad', 'sketch']
+
+
+def _validate_labels() -> None:
+    """
+    ラベル一覧とマッピングの整合性を読み込み時に確認する（壊れた設定で API を呼ばないため）。
+    """
+    for name, labels, mapping in (
+        ("SCENERY_LABELS", SCENERY_LABELS, MUSIC_MAPPING),
+        ("EMOTION_LABELS", EMOTION_LABELS, STAMP_MAPPING),
+    ):
+        if len(set(labels)) != len(labels):
+            raise ValueError(f"{name} contains duplicate labels")
+        if "default" in labels:
+            raise ValueError(f"{name} must not offer 'default' to the model")
+        missing = [label for label in labels if label not in mapping]
+        if missing:
+            raise ValueError(f"{name} has labels without a mapping: {missing}")
+
+
+_validate_labels()
+
+ANALYSIS_PROPERTIES = {
+    "style": {"type": "string", "enum": STYLE_LABELS},
+    "scenery": {"type": "string", "enum": SCENERY_LABELS},
+    "emotion": {"type": "string", "enum": EMOTION_LABELS},
+}
+
+# 1枚用: {"style", "scenery", "emotion"}
+ANALYSIS_SCHEMA = {
+    "type": "object",
+    "properties": ANALYSIS_PROPERTIES,
+    "required": list(ANALYSIS_PROPERTIES),
+    "additionalProperties": False,
+}
+
+# バッチ用: {"results": [{"index", "style", "scenery", "emotion"}, ...]}
+BATCH_ANALYSIS_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "results": {
+            "type": "array",
+            "items": {
+                "type": "object",
+                "properties": {"index": {"type": "integer"}, **ANALYSIS_PROPERTIES},
+                "required": ["index", *ANALYSIS_PROPERTIES],
+                "additionalProperties": False,
+            },
+        },
+    },
+    "required": ["results"],
+    "additionalProperties": False,
+}
+
+
+def response_format(name: str, schema: dict) -> dict:
+    """
+    chat.completions.create の response_format に渡す値 (strict な JSON スキーマ)。
+    """
+    return {"type": "json_schema", "json_schema": {"name": name, "strict": True, "schema": schema}}
+
+
+ANALYSIS_RESPONSE_FORMAT = response_format("image_analysis", ANALYSIS_SCHEMA)
+BATCH_ANALYSIS_RESPONSE_FORMAT = response_format("image_analysis_batch", BATCH_ANALYSIS_SCHEMA)
 
+# 1枚用・バッチ用で共通の先頭部分。毎回同じ文字列にしてプロンプトキャッシュに載りやすくする
+# (ラベルの値は enum で渡すので、ここでは選び方だけを書く)
+ANALYSIS_PROMPT_PREFIX = (
+    "You label travel photos for a photo-album app.\n"
+    "style: the filter that fits best.\n"
+    "  vivid: landscapes, food, or happy scenes (enhance color/contrast).\n"
+    "  sad: rainy, dark, or melancholic scenes (desaturate, cool tone).\n"
+    "  sketch: architectural, structural, or high-contrast lines (pencil style).\n"
+    "scenery: the place or situation shown (choose from the schema enum).\n"
+    "emotion: the feeling the photo conveys (choose from the schema enum).\n"
+)
@@ -0,0 +1,192 @@
+import sys
+import os
+import json
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from typing import Dict, Any, Iterable, List, Optional, Tuple
+from PIL import Image, ExifTags
+
+# Exif の読み取りと向き補正 (process_image.py と analysis.py の両方から使う)
+
+# =================================================================
+# 0. タグ番号 (ExifTags.TAGS を毎回探さないよう、読み込み時に一度だけ解決する)
+# =================================================================
+TAG_ORIENTATION = int(ExifTags.Base.Orientation)              # 274
+TAG_DATETIME_ORIGINAL = int(ExifTags.Base.DateTimeOriginal)   # 36867
+TAG_GPS_INFO = int(ExifTags.Base.GPSInfo)                     # 34853
+
+GPS_LATITUDE_REF = int(ExifTags.GPS.GPSLatitudeRef)
+GPS_LATITUDE = int(ExifTags.GPS.GPSLatitude)
+GPS_LONGITUDE_REF = int(ExifTags.GPS.GPSLongitudeRef)
+GPS_LONGITUDE = int(ExifTags.GPS.GPSLongitude)
+
+# scan() の並列数 (ヘッダーを読むだけなので I/O 待ちが中心)
+SCAN_WORKERS = int(os.environ.get("EXIF_SCAN_WORKERS", "8"))
+
+# =================================================================
+# 1. Exifデータ取得関数
+# =================================================================
+
+def get_exif(img: Image.Image) -> Optional[Dict[int, Any]]:
+    """
+    Pillow ImageオブジェクトからExif情報の辞書を安全に取得する。
+    公開 API の getexif() を使い、IFD0・Exif IFD・GPS IFD (TAG_GPS_INFO の下に辞書として) を
+    1つの辞書にまとめて返す（従来の img._getexif() と同じ形）。
+    Exif はファイルのヘッダーから読むだけなので、画素はデコードしない。
+    """
+    try:
+        exif = img.getexif()
+        if not exif:
+            # Exif情報が存在しない場合はNoneを返す
+            return None
+        exif_dict = dict(exif)
+        exif_dict.update(exif.get_ifd(ExifTags.IFD.Exif))
+        gps_info = exif.get_ifd(ExifTags.IFD.GPSInfo)
+        if gps_info:
+            exif_dict[TAG_GPS_INFO] = dict(gps_info)
+        else:
+            exif_dict.pop(TAG_GPS_INFO, None)
+        return exif_dict
+    except Exception:
+        return None
+
+# =================================================================
+# 2. 撮影日時抽出関数
+# =================================================================
+
+def get_datetime(exif_dict: Dict[int, Any]) -> Optional[str]:
+    """
+    Exif辞書から撮影日時を抽出し、ISO形式の文字列で返す。
+    """
+    if not exif_dict:
+        return None
+    
+    if TAG_DATETIME_ORIGINAL in exif_dict:
+        dt_str = exif_dict[TAG_DATETIME_ORIGINAL] # 例: 'YYYY:MM:DD HH:MM:SS'
+        try:
+            return datetime.strptime(dt_str, '%Y:%m:%d %H:%M:%S').isoformat()
+        except ValueError:
+            return None
+    return None
+
+# =================================================================
+# 3. 位置情報抽出関数
+# =================================================================
+def _convert_to_degrees(value: Tuple[Tuple[int, int], ...]) -> float:
+    """
+    GPS座標のDMS形式 (Degree/Minute/Second) を10進数に変換する補助関数。
+    """
+    d = float(value[0])
+    m = float(value[1])
+    s = float(value[2])
+    return d + (m / 60.0) + (s / 3600.0)
+
+
+def get_gps(exif_dict: Dict[int, Any]) -> Optional[Dict[str, float]]:
+    """
+    Exif辞書から緯度と経度を抽出し、辞書で返す。
+    """
+    if not exif_dict:
+        print("GPS Warning: Exif data is missing.", file=sys.stderr)
+        return None
+
+    if TAG_GPS_INFO not in exif_dict:
+        print("GPS Warning: GPSInfo tag is missing from Exif.", file=sys.stderr)
+        return None
+    
+    gps_info = exif_dict[TAG_GPS_INFO]
+
+    # 必要なGPSタグのキー
+    lat_tag = GPS_LATITUDE
+    lon_tag = GPS_LONGITUDE
+    lat_ref_tag = GPS_LATITUDE_REF
+    lon_ref_tag = GPS_LONGITUDE_REF
+
+    if not all(tag in gps_info for tag in [lat_tag, lon_tag, lat_ref_tag, lon_ref_tag]):
+        print("GPS Warning: One or more critical GPS tags (Lat/Lon/Ref) are missing.", file=sys.stderr)
+        return None
+
+    try:
+        # 10進数に変換
+        lat = _convert_to_degrees(gps_info[lat_tag])
+        lon = _convert_to_degrees(gps_info[lon_tag])
+        # print(f"Extracted Raw Lat/Lon: {lat}, {lon}", file=sys.stderr)
+        # 南北/東西の情報を適用
+        if gps_info[lat_ref_tag] != 'N':
+            lat *= -1
+        if gps_info[lon_ref_tag] != 'E':
+            lon *= -1
+        print(f"Successfully extracted GPS: {lat}, {lon}", file=sys.stderr)
+        return {'latitude': lat, 'longitude': lon}
+
+    except Exception as e:
+        print(f"GPS Warning: Error during conversion: {e}", file=sys.stderr)
+        return None
+
+# =================================================================
+# 4. 回転関数
+# =================================================================
+
+def rotate_image(img: Image.Image, exif_dict: Dict[int, Any]) -> Image.Image:
+    """
+    Exif辞書のOrientationタグに基づき、画像を物理的に回転させる。
+    """
+    if not exif_dict:
+        return img
+    
+    if TAG_ORIENTATION not in exif_dict:
+        return img
+    
+    o = exif_dict[TAG_ORIENTATION]
+    
+    # Orientationタグの値に基づいて回転/反転を適用
+    if o == 3:
+        img = img.transpose(Image.ROTATE_180)
+    elif o == 6:
+        img = img.transpose(Image.ROTATE_270)
+    elif o == 8:
+        img = img.transpose(Image.ROTATE_90)
+    return img
+
+# =================================================================
+# 5. 一括スキャン
+# =================================================================
+
+def scan_one(path: str) -> Dict[str, Any]:
+    """
+    1枚分のヘッダーだけを読み、撮影日時・位置・向き・(向き補正後の) サイズを返す。
+    """
+    try:
+        with Image.open(path) as img:
+            size = img.size
+            exif = get_exif(img)
+    except Exception as e:
+        return {'path': path, 'error': str(e)}
+
+    orientation = exif.get(TAG_ORIENTATION) if exif else None
+    if orientation in (5, 6, 7, 8):
+        size = (size[1], size[0])
+    return {
+        'path': path,
+        'date_time': get_datetime(exif) if exif else None,
+        'location': get_gps(exif) if exif else None,
+        'orientation': orientation,
+        'size': list(size),
+    }
+
+def scan(paths: Iterable[str], workers: int = SCAN_WORKERS) -> List[Dict[str, Any]]:
+    """
+    複数の画像の Exif をまとめて読む（入力順で返す）。画素はデコードしないので、
+    重い画像処理の前に旅程 (撮影日時・位置) を組み立てるのに使える。
+    """
+    paths = list(paths)
+    if workers <= 1 or len(paths) <= 1:
+        return [scan_one(p) for p in paths]
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(scan_one, paths))
+
+
+if __name__ == "__main__":
+    # 使い方: python metadata.py <image> [<image> ...]  → 1行1枚の JSON
+    for item in scan(sys.argv[1:]):
+        print(json.dumps(item, ensure_ascii=False))
@@ -0,0 +1,231 @@
+import sys
+import os
+import json
+import time
+import math
+import random
+import hashlib
+import argparse
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, List, Optional, Tuple
+
+sys.path.append(os.path.dirname(__file__))
+from mapping_config import STYLE_LABELS, SCENERY_LABELS, EMOTION_LABELS
+
+# =================================================================
+# 負荷試験用の OpenAI 互換サーバー (chat.completions の画像解析だけ)
+# =================================================================
+# 使い方:
+#   python scripts/mock_openai_server.py --port 8089 --latency lognormal:0.8:0.5 --rate-limit-rate 0.05
+#   OPENAI_BASE_URL=http://127.0.0.1:8089/v1 OPENAI_API_KEY=mock python scripts/process_image.py ...
+# 回答は画像データのハッシュから mapping_config のラベルを選ぶので、同じ画像には常に同じ答えを返す。
+# response_format が image_analysis_batch のときは {"results": [{"index", ...}, ...]} で答える。
+# 遅延の分布:
+#   fixed:<秒>  uniform:<最小>:<最大>  lognormal:<中央値>:<sigma>
+# 画像1枚ごとに --per-image 秒を足す (バッチは枚数分遅くなる)。
+# GET /stats でリクエスト数・エラー注入数などを返す。
+
+
+def parse_latency(spec: str):
+    """
+    遅延の指定を「random.Random を受け取って秒数を返す関数」にする。
+    """
+    kind, _, params = spec.partition(":")
+    values = [float(v) for v in params.split(":")] if params else []
+    if kind == "fixed" and len(values) == 1:
+        return lambda rng: values[0]
+    if kind == "uniform" and len(values) == 2:
+        return lambda rng: rng.uniform(values[0], values[1])
+    if kind == "lognormal" and len(values) == 2:
+        return lambda rng: rng.lognormvariate(math.log(values[0]), values[1])
+    raise ValueError(f"Invalid latency spec: {spec} (fixed:S, uniform:MIN:MAX or lognormal:MEDIAN:SIGMA)")
+
+
+def answer_for(image_url: str) -> Dict[str, str]:
+    """
+    画像データのハッシュから決まる style / scenery / emotion。
+    """
+    digest = hashlib.sha256(image_url.encode("utf-8")).digest()
+    return {
+        'style': STYLE_LABELS[digest[0] % len(STYLE_LABELS)],
+        'scenery': SCENERY_LABELS[int.from_bytes(digest[1:3], 'big') % len(SCENERY_LABELS)],
+        'emotion': EMOTION_LABELS[int.from_bytes(digest[3:5], 'big') % len(EMOTION_LABELS)],
+    }
+
+
+def image_urls(messages: List[Dict[str, Any]]) -> List[str]:
+    urls = []
+    for message in messages:
+        content = message.get('content')
+        if isinstance(content, list):
+            for part in content:
+                if isinstance(part, dict) and part.get('type') == 'image_url':
+                    urls.append(part['image_url']['url'])
+    return urls
+
+
+def text_chars(messages: List[Dict[str, Any]]) -> int:
+    total = 0
+    for message in messages:
+        content = message.get('content')
+        if isinstance(content, str):
+            total += len(content)
+        elif isinstance(content, list):
+            total += sum(len(part.get('text', '')) for part in content if isinstance(part, dict))
+    return total
+
+
+class MockState:
+    """
+    遅延・エラー注入の設定と統計 (スレッド間で共有する)。
+    """
+
+    def __init__(self, latency: str = "fixed:0", per_image: float = 0.0, error_rate: float = 0.0,
+                 rate_limit_rate: float = 0.0, retry_after: float = 1.0, seed: int = 0):
+        self.latency = parse_latency(latency)
+        self.per_image = per_image
+        self.error_rate = error_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.retry_after = retry_after
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self.stats = {'requests': 0, 'images': 0, 'ok': 0, 'errors_500': 0, 'errors_429': 0, 'bad_request': 0}
+
+    def draw(self, images: int) -> Tuple[float, Optional[int]]:
+        """
+        このリクエストの (遅延秒数, 注入するステータス or None) を決める。
+        """
+        with self._lock:
+            self.stats['requests'] += 1
+            self.stats['images'] += images
+            delay = max(0.0, self.latency(self._rng)) + self.per_image * images
+            roll = self._rng.random()
+        if roll < self.rate_limit_rate:
+            return 0.0, 429
+        if roll < self.rate_limit_rate + self.error_rate:
+            return delay, 500
+        return delay, None
+
+    def record(self, key: str) -> None:
+        with self._lock:
+            self.stats[key] += 1
+
+
+def completion_body(request: Dict[str, Any]) -> Dict[str, Any]:
+    urls = image_urls(request.get('messages', []))
+    schema_name = ((request.get('response_format') or {}).get('json_schema') or {}).get('name')
+    if schema_name == "image_analysis_batch":
+        content = {'results': [dict(index=i, **answer_for(url)) for i, url in enumerate(urls)]}
+    else:
+        content = answer_for(urls[0]) if urls else {'style': STYLE_LABELS[0], 'scenery': SCENERY_LABELS[0], 'emotion': EMOTION_LABELS[0]}
+    text = json.dumps(content)
+    # 画像1枚 (low detail 相当) 85 トークン + テキスト 4文字 1トークンの概算
+    prompt_tokens = 85 * len(urls) + text_chars(request.get('messages', [])) // 4
+    completion_tokens = max(1, len(text) // 4)
+    return {
+        'id': f"chatcmpl-mock-{hashlib.sha1(text.encode()).hexdigest()[:12]}",
+        'object': 'chat.completion',
+        'created': int(time.time()),
+        'model': request.get('model', 'mock'),
+        'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': text}, 'finish_reason': 'stop'}],
+        'usage': {'prompt_tokens': prompt_tokens, 'completion_tokens': completion_tokens,
+                  'total_tokens': prompt_tokens + completion_tokens},
+    }
+
+
+def make_handler(state: MockState):
+    class Handler(BaseHTTPRequestHandler):
+        # Keep-Alive でコネクションを使い回せるようにする (本物の API と同じ条件で測る)
+        protocol_version = "HTTP/1.1"
+
+        def _send(self, status: int, payload: Dict[str, Any], headers: Optional[Dict[str, str]] = None) -> None:
+            body = json.dumps(payload).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            for key, value in (headers or {}).items():
+                self.send_header(key, value)
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            if self.path.rstrip("/").endswith("/stats"):
+                with state._lock:
+                    stats = dict(state.stats)
+                self._send(200, stats)
+            else:
+                self._send(404, {'error': {'message': 'Not found', 'type': 'invalid_request_error'}})
+
+        def do_POST(self):
+            length = int(self.headers.get("Content-Length", "0"))
+            raw = self.rfile.read(length)
+            if not self.path.rstrip("/").endswith("/chat/completions"):
+                self._send(404, {'error': {'message': 'Not found', 'type': 'invalid_request_error'}})
+                return
+            try:
+                request = json.loads(raw)
+            except json.JSONDecodeError as e:
+                state.record('bad_request')
+                self._send(400, {'error': {'message': f"Invalid JSON: {e}", 'type': 'invalid_request_error'}})
+                return
+
+            delay, status = state.draw(len(image_urls(request.get('messages', []))))
+            time.sleep(delay)
+            if status == 429:
+                state.record('errors_429')
+                self._send(429, {'error': {'message': 'Rate limit reached (mock)', 'type': 'rate_limit_exceeded'}},
+                           {'Retry-After': f"{state.retry_after:g}"})
+            elif status == 500:
+                state.record('errors_500')
+                self._send(500, {'error': {'message': 'Internal error (mock)', 'type': 'server_error'}})
+            else:
+                state.record('ok')
+                self._send(200, completion_body(request))
+
+        def log_message(self, format, *args):
+            # リクエストごとのアクセスログは出さない
+            pass
+
+    return Handler
+
+
+def start_server(state: MockState, host: str = "127.0.0.1", port: int = 0) -> ThreadingHTTPServer:
+    """
+    バックグラウンドのスレッドでサーバーを起動する (port=0 なら空いているポート)。
+    base URL は f"http://{host}:{server.server_address[1]}/v1"。
+    """
+    server = ThreadingHTTPServer((host, port), make_handler(state))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def add_arguments(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument("--latency", default="lognormal:0.8:0.5",
+                        help="fixed:S, uniform:MIN:MAX or lognormal:MEDIAN:SIGMA (seconds)")
+    parser.add_argument("--per-image", type=float, default=0.15, help="extra seconds per image in the request")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of requests answered with 500")
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0, help="fraction of requests answered with 429")
+    parser.add_argument("--retry-after", type=float, default=1.0, help="Retry-After seconds sent with 429")
+    parser.add_argument("--seed", type=int, default=0)
+
+
+def state_from_args(args: argparse.Namespace) -> MockState:
+    return MockState(args.latency, args.per_image, args.error_rate, args.rate_limit_rate, args.retry_after, args.seed)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="OpenAI-compatible stand-in for the image analysis endpoint")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8089)
+    add_arguments(parser)
+    args = parser.parse_args()
+
+    server = ThreadingHTTPServer((args.host, args.port), make_handler(state_from_args(args)))
+    server.daemon_threads = True
+    print(f"Mock OpenAI server on http://{args.host}:{args.port}/v1", file=sys.stderr)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,351 @@
+import os
+import sys
+import json
+import time
+import bisect
+import random
+import threading
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from typing import TYPE_CHECKING, Any, Callable, Dict, Optional
+
+sys.path.append(os.path.dirname(__file__))
+from telemetry import span, count
+
+# openai (import に 1 秒近くかかる) と dotenv は実際に API を呼ぶときまで読み込まない。
+# ローカル判定で確定した写真や、解析済みの写真だけの decide_effects では一度も読み込まれない
+if TYPE_CHECKING:
+    from openai import OpenAI
+
+# カレントディレクトリではなく、このスクリプトのある場所から一つ上の .env を確実に指定する
+ENV_PATH = os.path.join(os.path.dirname(__file__), '../.env')
+
+_client: Optional["OpenAI"] = None
+_client_lock = threading.Lock()
+
+
+def get_client() -> "OpenAI":
+    """
+    プロセス内で共有する OpenAI クライアントを返す。
+    初回呼び出し時に .env を読み込む。クライアント内部の HTTP コネクションプール
+    (Keep-Alive) を使い回すため、常駐ワーカーでは2枚目以降の画像で TLS ハンドシェイクが省略される。
+    """
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                from dotenv import load_dotenv
+                from openai import OpenAI
+                load_dotenv(ENV_PATH, override=True)
+                # 再試行とタイムアウトは call_with_deadline 側で管理する
+                # OPENAI_BASE_URL で接続先を差し替えられる (負荷試験では mock_openai_server.py を指す)
+                _client = OpenAI(
+                    api_key=os.environ.get("OPENAI_API_KEY"),
+                    base_url=os.environ.get("OPENAI_BASE_URL") or None,
+                    max_retries=0
+                )
+    return _client
+
+
+class RateLimiter:
+    """
+    1分あたりのリクエスト数を制限するトークンバケット（スレッドセーフ）。
+    rpm <= 0 の場合は制限しない。
+    """
+
+    def __init__(self, rpm: float):
+        self.rpm = rpm
+        self._capacity = max(1.0, rpm)
+        self._tokens = self._capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, timeout: Optional[float] = None) -> bool:
+        """
+        1リクエスト分の枠を取る。timeout 秒以内に取れない場合は待たずに False を返す。
+        """
+        if self.rpm <= 0:
+            return True
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self._capacity, self._tokens + (now - self._updated) * self.rpm / 60.0)
+                self._updated = now
+                if self._tokens >= 1.0:
+                    self._tokens -= 1.0
+                    return True
+                wait = (1.0 - self._tokens) * 60.0 / self.rpm
+            if deadline is not None and now + wait > deadline:
+                return False
+            time.sleep(wait)
+
+
+# プロセス内の全 API 呼び出しで共有するレート制限
+rate_limiter = RateLimiter(float(os.environ.get("OPENAI_RPM_LIMIT", "500")))
+
+
+# =================================================================
+# 締め切り付きの呼び出し (タイムアウト・再試行・ヘッジ・サーキットブレーカー)
+# =================================================================
+# 1回の解析にかけてよい時間 (秒)。これを超えたら諦めて呼び出し側のフォールバックに任せる
+OPENAI_DEADLINE_SECONDS = float(os.environ.get("OPENAI_DEADLINE_SECONDS", "20"))
+# 429 / 5xx / 接続エラーの再試行回数と、指数バックオフの初期値・上限 (秒)
+OPENAI_MAX_RETRIES = int(os.environ.get("OPENAI_MAX_RETRIES", "3"))
+OPENAI_BACKOFF_BASE = float(os.environ.get("OPENAI_BACKOFF_BASE", "0.5"))
+OPENAI_BACKOFF_MAX = float(os.environ.get("OPENAI_BACKOFF_MAX", "8"))
+# ヘッジ: 最初の呼び出しがこの秒数を超えたら2本目を投げ、早い方を使う。
+# "p95" で直近のレイテンシの p95、"0" (既定) で無効
+OPENAI_HEDGE_AFTER = os.environ.get("OPENAI_HEDGE_AFTER", "0")
+# 連続でこの回数失敗したら、OPENAI_BREAKER_RESET_SECONDS の間は API を呼ばずに失敗させる
+OPENAI_BREAKER_FAILURES = int(os.environ.get("OPENAI_BREAKER_FAILURES", "5"))
+OPENAI_BREAKER_RESET_SECONDS = float(os.environ.get("OPENAI_BREAKER_RESET_SECONDS", "30"))
+# この回数の呼び出しごとにレイテンシのヒストグラムを stderr に出す (0 で出さない)
+OPENAI_HISTOGRAM_EVERY = int(os.environ.get("OPENAI_HISTOGRAM_EVERY", "20"))
+
+
+class DeadlineExceeded(TimeoutError):
+    pass
+
+
+class RateLimitWaitExceeded(DeadlineExceeded):
+    """
+    ローカルのレート制限の枠を待つと期限を過ぎる (API は呼んでいないので、ブレーカーには数えない)。
+    """
+
+
+class CircuitOpenError(RuntimeError):
+    pass
+
+
+def is_retryable(error: Exception) -> bool:
+    """
+    再試行してよいエラーか (429・5xx・タイムアウト・接続エラー)。400 番台の他のエラーは何度送っても同じ。
+    """
+    if isinstance(error, DeadlineExceeded):
+        return True
+    # openai がまだ読み込まれていなければ、openai の例外ではありえない
+    openai = sys.modules.get('openai')
+    if openai is None:
+        return False
+    if isinstance(error, (openai.APITimeoutError, openai.APIConnectionError, openai.RateLimitError)):
+        return True
+    if isinstance(error, openai.APIStatusError):
+        return error.status_code >= 500
+    return False
+
+
+def _retry_after(error: Exception) -> Optional[float]:
+    response = getattr(error, 'response', None)
+    value = response.headers.get('retry-after') if response is not None else None
+    try:
+        return float(value) if value is not None else None
+    except ValueError:
+        return None
+
+
+class LatencyHistogram:
+    """
+    呼び出しのレイテンシ (秒) を固定のバケットで数える（スレッドセーフ）。
+    """
+
+    BUCKETS = [0.25, 0.5, 1, 2, 3, 5, 8, 13, 20, 30, 60]
+
+    def __init__(self):
+        self.counts = [0] * (len(self.BUCKETS) + 1)
+        self.total = 0
+        self.sum = 0.0
+        self.outcomes: Dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, seconds: float, outcome: str = "ok") -> None:
+        with self._lock:
+            self.counts[bisect.bisect_left(self.BUCKETS, seconds)] += 1
+            self.total += 1
+            self.sum += seconds
+            self.outcomes[outcome] = self.outcomes.get(outcome, 0) + 1
+
+    def quantile(self, q: float) -> Optional[float]:
+        """
+        q 分位点をバケットの上端で近似する。件数が少ないうちは None。
+        """
+        with self._lock:
+            if self.total < 20:
+                return None
+            rank = q * self.total
+            seen = 0
+            for bound, count in zip(self.BUCKETS + [float('inf')], self.counts):
+                seen += count
+                if seen >= rank:
+                    return bound
+        return None
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            labels = [f"le_{b}" for b in self.BUCKETS] + ["le_inf"]
+            return {
+                'count': self.total,
+                'mean_s': round(self.sum / self.total, 3) if self.total else None,
+                'buckets': dict(zip(labels, self.counts)),
+                'outcomes': dict(self.outcomes),
+            }
+
+
+class CircuitBreaker:
+    """
+    連続失敗が閾値を超えたら open にして、reset_seconds の間は呼び出しを止める。
+    その後は1件だけ試し (half-open)、成功すれば closed に戻る。
+    """
+
+    def __init__(self, failure_threshold: int, reset_seconds: float):
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+        self._trial_running = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at >= self.reset_seconds:
+            return "half_open"
+        return "open"
+
+    def allow(self) -> bool:
+        with self._lock:
+            state = self.state
+            if state == "closed":
+                return True
+            if state == "half_open" and not self._trial_running:
+                self._trial_running = True
+                return True
+            return False
+
+    def record_success(self) -> None:
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self._trial_running = False
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self.failures += 1
+            self._trial_running = False
+            if self.opened_at is not None or self.failures >= self.failure_threshold:
+                if self.opened_at is None:
+                    print(f"OpenAI circuit breaker opened after {self.failures} failures", file=sys.stderr)
+                self.opened_at = time.monotonic()
+
+
+# プロセス内の全 API 呼び出しで共有する
+latency_histogram = LatencyHistogram()
+circuit_breaker = CircuitBreaker(OPENAI_BREAKER_FAILURES, OPENAI_BREAKER_RESET_SECONDS)
+_hedge_executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix="openai-hedge")
+
+
+def _hedge_delay() -> Optional[float]:
+    if OPENAI_HEDGE_AFTER == "p95":
+        return latency_histogram.quantile(0.95)
+    delay = float(OPENAI_HEDGE_AFTER)
+    return delay if delay > 0 else None
+
+
+def _timed(fn: Callable[[float], Any], deadline: float) -> Any:
+    # レート制限の待ち時間も期限に含め、fn には待った後の残り時間を渡す
+    if not rate_limiter.acquire(deadline - time.monotonic()):
+        count("openai_requests_total", outcome="rate_limit_wait")
+        raise RateLimitWaitExceeded("local rate limit would exceed the deadline")
+    start = time.monotonic()
+    timeout = deadline - start
+    try:
+        with span("openai_request", timeout_s=round(timeout, 2)):
+            result = fn(timeout)
+    except Exception as e:
+        latency_histogram.observe(time.monotonic() - start, type(e).__name__)
+        count("openai_requests_total", outcome=type(e).__name__)
+        raise
+    latency_histogram.observe(time.monotonic() - start)
+    count("openai_requests_total", outcome="ok")
+    if OPENAI_HISTOGRAM_EVERY and latency_histogram.total % OPENAI_HISTOGRAM_EVERY == 0:
+        print(json.dumps({'openai_latency': latency_histogram.snapshot()}), file=sys.stderr)
+    return result
+
+
+def _attempt(fn: Callable[[float], Any], remaining: float) -> Any:
+    """
+    1回分の試行。ヘッジが有効で最初の呼び出しが遅い場合は2本目を投げ、先に成功した方を返す。
+    """
+    delay = _hedge_delay()
+    deadline = time.monotonic() + remaining
+    if delay is None or delay >= remaining:
+        return _timed(fn, deadline)
+
+    first = _hedge_executor.submit(_timed, fn, deadline)
+    done, _ = wait([first], timeout=delay)
+    if done:
+        return first.result()
+
+    print(f"Hedging OpenAI request after {delay:.2f}s", file=sys.stderr)
+    second = _hedge_executor.submit(_timed, fn, max(time.monotonic() + 0.1, deadline))
+    pending = {first, second}
+    error: Optional[Exception] = None
+    while pending:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            if future.exception() is None:
+                return future.result()
+            error = future.exception()
+    raise error
+
+
+def call_with_deadline(fn: Callable[[float], Any], budget: Optional[float] = None, label: str = "") -> Any:
+    """
+    fn(timeout) を budget 秒以内に成功させる。fn には残り時間をタイムアウトとして渡す。
+    429 / 5xx / 接続エラーはジッター付き指数バックオフで再試行し (Retry-After があれば従う)、
+    サーキットブレーカーが open の間は呼ばずに CircuitOpenError を送出する。
+    最終的に失敗した場合は例外を送出するので、呼び出し側でフォールバックする。
+    """
+    budget = OPENAI_DEADLINE_SECONDS if budget is None else budget
+    deadline = time.monotonic() + budget
+
+    for attempt in range(OPENAI_MAX_RETRIES + 1):
+        if not circuit_breaker.allow():
+            raise CircuitOpenError(f"OpenAI circuit breaker is {circuit_breaker.state}")
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise DeadlineExceeded(f"{label} exceeded its {budget:.1f}s budget")
+
+        try:
+            result = _attempt(fn, remaining)
+        except RateLimitWaitExceeded:
+            # API は呼んでいない (待っても期限内に枠が空かない) ので、ブレーカーには数えない
+            raise
+        except Exception as e:
+            if not is_retryable(e):
+                # リクエスト自体の問題なので、API の不調としては数えない (成功としても記録しない)
+                raise
+            circuit_breaker.record_failure()
+            remaining = deadline - time.monotonic()
+            if attempt == OPENAI_MAX_RETRIES or remaining <= 0:
+                raise
+            backoff = _retry_after(e) or random.uniform(0, min(OPENAI_BACKOFF_MAX, OPENAI_BACKOFF_BASE * 2 ** attempt))
+            if backoff >= remaining:
+                raise
+            print(f"OpenAI {label} failed ({type(e).__name__}); retry {attempt + 1} in {backoff:.2f}s", file=sys.stderr)
+            time.sleep(backoff)
+            continue
+
+        circuit_breaker.record_success()
+        return result
+
+
+def create_chat_completion(label: str = "", budget: Optional[float] = None, **kwargs) -> Any:
+    """
+    chat.completions.create を call_with_deadline で呼ぶ（レート制限もここで行う）。
+    """
+    return call_with_deadline(
+        lambda timeout: get_client().chat.completions.create(timeout=timeout, **kwargs),
+        budget=budget,
+        label=label
+    )
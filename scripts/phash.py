@@ -0,0 +1,194 @@
+import os
+from typing import Any, List, Optional, Tuple, Union
+
+import sys
+from PIL import Image
+
+sys.path.append(os.path.dirname(__file__))
+from metadata import get_exif, rotate_image
+
+# =================================================================
+# 知覚ハッシュ (dHash) と BK-tree による近似重複の検索
+# =================================================================
+# 連写などのほぼ同じ写真は dHash のハミング距離が小さくなる。
+# BK-tree は三角不等式で枝を刈るので、件数が増えても全件比較にはならない。
+# dHash は明るさの勾配しか見ないので、空・夕焼け・夜景・白い壁のような平坦な写真は内容が違っても
+# ほぼ同じハッシュ (ビットがほぼ全部 0) になる。そこで
+#   1. 立っているビットが少なすぎる (多すぎる) ハッシュは「ハッシュなし」として扱い、使い回さない
+#   2. 2x2 ブロックの平均色を一緒に持ち、dHash が近くても色が違えば別の写真とみなす
+# 受け渡しやキャッシュには signature() の 16 進文字列 (dHash 16 桁 + 平均色 24 桁) を使う。
+
+# これ以下のハミング距離 (64 bit 中) を「ほぼ同じ写真」とみなす
+PHASH_THRESHOLD = int(os.environ.get("PHASH_THRESHOLD", "6"))
+
+# 立っているビットがこれ未満 (または 64 からこれを引いた数より多い) の dHash は情報が少ないので使わない
+PHASH_MIN_BITS = int(os.environ.get("PHASH_MIN_BITS", "8"))
+
+# 2x2 ブロックの平均色 (RGB 各 0〜255) の差がすべてこれ以下なら、色も同じとみなす
+PHASH_COLOR_TOLERANCE = int(os.environ.get("PHASH_COLOR_TOLERANCE", "20"))
+
+HASH_SIZE = 8
+COLOR_GRID = 2
+
+# signature() の文字列の長さ (dHash + 平均色)
+_DHASH_HEX = HASH_SIZE * HASH_SIZE // 4
+_COLOR_HEX = COLOR_GRID * COLOR_GRID * 3 * 2
+
+# (dHash, 平均色のバイト列)
+Signature = Tuple[int, bytes]
+
+
+def dhash(image: Union[str, Image.Image], hash_size: int = HASH_SIZE) -> int:
+    """
+    画像の dHash (hash_size * hash_size bit) を返す。
+    (hash_size + 1) x hash_size のグレー画像で、横に隣り合う画素の明るさの大小をビットにする。
+    パスを渡した場合は JPEG の draft デコードで小さく読み込み、Exif の向きを補正する
+    (Image を渡す場合は rotate_image 済みのものを渡す)。
+    """
+    if isinstance(image, str):
+        with Image.open(image) as img:
+            exif = get_exif(img)
+            img.draft('L', (hash_size * 8, hash_size * 8))
+            return dhash(rotate_image(img, exif), hash_size)
+
+    # numpy は dhash を計算するときだけ読み込む (decide_effects は process_image が計算した
+    # ハッシュを受け取るので、通常は起動時に numpy を読み込まずに済む)
+    import numpy as np
+
+    small = image.convert("L") if image.mode not in ("L", "RGB") else image
+    small = small.resize((hash_size + 1, hash_size), Image.BOX, reducing_gap=2.0).convert("L")
+    pixels = np.asarray(small, dtype=np.int16)
+    bits = (pixels[:, 1:] > pixels[:, :-1]).flatten()
+    return int.from_bytes(np.packbits(bits).tobytes(), 'big')
+
+
+def is_informative(value: int, hash_size: int = HASH_SIZE, min_bits: int = PHASH_MIN_BITS) -> bool:
+    """
+    近似重複の判定に使える dHash か (平坦な画像のように、ほぼ全部 0 / 1 のものは使わない)。
+    """
+    bits = bin(value).count("1")
+    return min_bits <= bits <= hash_size * hash_size - min_bits
+
+
+def mean_colors(image: Image.Image, grid: int = COLOR_GRID) -> bytes:
+    """
+    grid x grid ブロックごとの平均色 (RGB) のバイト列。
+    """
+    rgb = image if image.mode == "RGB" else image.convert("RGB")
+    return rgb.resize((grid, grid), Image.BOX, reducing_gap=2.0).tobytes()
+
+
+def colors_match(a: bytes, b: bytes, tolerance: int = PHASH_COLOR_TOLERANCE) -> bool:
+    return len(a) == len(b) and all(abs(x - y) <= tolerance for x, y in zip(a, b))
+
+
+def signature(image: Union[str, Image.Image]) -> Optional[str]:
+    """
+    近似重複の判定用に dHash と平均色を 16 進文字列にまとめて返す。
+    dHash の情報が少ない (平坦な画像) 場合は None（使い回しの対象にしない）。
+    パスを渡した場合は dhash と同じく draft デコードし、Exif の向きを補正する。
+    """
+    if isinstance(image, str):
+        with Image.open(image) as img:
+            exif = get_exif(img)
+            img.draft('RGB', (HASH_SIZE * 8, HASH_SIZE * 8))
+            return signature(rotate_image(img, exif))
+    value = dhash(image)
+    if not is_informative(value):
+        return None
+    return to_hex(value) + mean_colors(image).hex()
+
+
+def parse_signature(value: Optional[str]) -> Optional[Signature]:
+    """
+    signature() の文字列を (dHash, 平均色) に戻す。
+    None・形式が違うもの (平均色のない古い dHash だけの値など)・情報の少ないものは None。
+    """
+    if not isinstance(value, str) or len(value) != _DHASH_HEX + _COLOR_HEX:
+        return None
+    try:
+        parsed = from_hex(value[:_DHASH_HEX]), bytes.fromhex(value[_DHASH_HEX:])
+    except ValueError:
+        return None
+    return parsed if is_informative(parsed[0]) else None
+
+
+def hamming(a: int, b: int) -> int:
+    return bin(a ^ b).count("1")
+
+
+def to_hex(value: int, hash_size: int = HASH_SIZE) -> str:
+    return f"{value:0{hash_size * hash_size // 4}x}"
+
+
+def from_hex(value: str) -> int:
+    return int(value, 16)
+
+
+class BKTree:
+    """
+    ハミング距離の BK-tree。同じハッシュの値は同じノードにまとめる。
+    ノード: [ハッシュ, 値のリスト, {距離: 子ノード}]
+    """
+
+    def __init__(self):
+        self._root: Optional[list] = None
+        self.size = 0
+
+    def add(self, key: int, value: Any) -> None:
+        self.size += 1
+        if self._root is None:
+            self._root = [key, [value], {}]
+            return
+        node = self._root
+        while True:
+            distance = hamming(key, node[0])
+            if distance == 0:
+                node[1].append(value)
+                return
+            child = node[2].get(distance)
+            if child is None:
+                node[2][distance] = [key, [value], {}]
+                return
+            node = child
+
+    def search(self, key: int, max_distance: int) -> List[Tuple[int, Any]]:
+        """
+        距離 max_distance 以内の (距離, 値) を距離の近い順に返す。
+        """
+        found = []
+        stack = [self._root] if self._root is not None else []
+        while stack:
+            node = stack.pop()
+            distance = hamming(key, node[0])
+            if distance <= max_distance:
+                found.extend((distance, value) for value in node[1])
+            # |d(key, child) - d(key, node)| <= max_distance を満たす枝だけ辿る
+            for edge, child in node[2].items():
+                if distance - max_distance <= edge <= distance + max_distance:
+                    stack.append(child)
+        found.sort(key=lambda item: item[0])
+        return found
+
+    def __len__(self) -> int:
+        return self.size
+
+
+def group_near_duplicates(signatures: List[Optional[Signature]], max_distance: int = PHASH_THRESHOLD) -> List[Optional[int]]:
+    """
+    入力順に見て、それより前の写真と dHash が max_distance 以内かつ平均色が近ければ
+    代表 (最初の写真) のインデックスを、そうでなければ None を返す。シグネチャが None の写真はグループにしない。
+    """
+    tree = BKTree()
+    representatives: List[Optional[int]] = []
+    for index, value in enumerate(signatures):
+        if value is None:
+            representatives.append(None)
+            continue
+        value_hash, value_colors = value
+        rep = next((other for _, (other, other_colors) in tree.search(value_hash, max_distance)
+                    if colors_match(value_colors, other_colors)), None)
+        representatives.append(rep)
+        if rep is None:
+            tree.add(value_hash, (index, value_colors))
+    return representatives
@@ -1,215 +1,229 @@
 import sys
 import os
-import base64
+import time
+import mmap
+import hashlib
+import contextvars
 from datetime import datetime
-from fractions import Fraction
-from typing import Dict, Any, Optional, Tuple
-from PIL import Image, ExifTags
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, Any, Iterator, List, Optional, Tuple
+from PIL import Image
 import cv2
 import json
 import numpy as np
-from openai import OpenAI 
-from dotenv import load_dotenv
 
-# カレントディレクトリではなく、このスクリプトのある場所から一つ上の .env を確実に指定する
-env_path = os.path.join(os.path.dirname(__file__), '../.env')
-load_dotenv(env_path, override=True)
+sys.path.append(os.path.dirname(__file__))
+from color_lut import scale_lut
+from sketch_engines import SKETCH_ENGINES, sketch_downscaled, sketch_opencv, guided_coefficients
+from buffer_pool import get_buffer, get_clahe, release_buffers
+from stage_profile import StageProfiler
+from telemetry import span, count, trace, flush
+from tiling import should_tile, enhance_tiled, pointwise_tiled, guided_upsample_tiled
+from metadata import get_exif, get_datetime, get_gps, rotate_image
+from analysis import analyze, write_analysis_handoff
+from analysis_cache import get_cache
+from phash import signature
+from style_classifier import classify_style_file, LOCAL_STYLE_THRESHOLD
 
 # =================================================================
-# 1. Exifデータ取得関数
+# 1〜4. Exif関連 (metadata.py)
 # =================================================================
+# get_exif / get_datetime / get_gps / rotate_image は metadata.py に移動
 
-def get_exif(img: Image.Image) -> Optional[Dict[int, Any]]:
+# =================================================================
+# 5.画像処理関数
+# =================================================================
+#1.映えの処理
+def enhance_image(
+    img_pil: Image.Image,
+    clahe_clip: float = 2.0,        # コントラスト強調の強さ（小さいほど自然）
+    saturation_scale: float = 1.2,  # 彩度アップ倍率（1.0〜1.15が自然）
+    sharp_amount: float = 0.3        # シャープの強さ（0〜0.5が推奨）
+) -> Image.Image:
     """
-    Pillow ImageオブジェクトからExif情報の辞書を安全に取得する。
+    Pillow Image を受け取り、
+    - CLAHE（マイルド）
+    - 彩度アップ（控えめ）
+    - アンシャープマスク（軽め）
+    を適用して、自然に映える画像を返す関数。
+    元の実装 (_enhance_image_reference) との差は 1 階調以内
+    (RGB の並びのまま変換しているだけなので、通常は完全に一致する)。
+    中間画像はスレッドごとのバッファプールを使い回し、CLAHE オブジェクトも再利用する。
+    FILTER_PROFILE=1 で段階ごとの時間とピークメモリを stderr に出す。
     """
-    try:
-        # Exif情報が存在しない場合はNoneを返す
-        return img._getexif()
-    except Exception:
-        return None
+    if should_tile(img_pil):
+        # 巨大な画像は CLAHE の LUT を全体で作り、横帯ごとに処理する (tiling.py)
+        return enhance_tiled(
+            img_pil,
+            lambda region, equalize: _enhance_kernel(region, clahe_clip, saturation_scale, equalize),
+            lambda region: _sharpen(region, sharp_amount),
+            clahe_clip,
+        )
 
-# =================================================================
-# 2. 撮影日時抽出関数
-# =================================================================
+    profiler = StageProfiler("enhance_image")
+
+    # Pillow → NumPy (BGR には変換せず RGB のまま処理する)
+    with profiler.stage("to_array"):
+        img = np.asarray(img_pil if img_pil.mode == "RGB" else img_pil.convert("RGB"))
+        h, w = img.shape[:2]
+
+    # ---- 1. コントラスト強調（CLAHE） + 2. 彩度アップ（控えめ） ----
+    with profiler.stage("clahe_saturation"):
+        img_vivid = _enhance_kernel(img, clahe_clip, saturation_scale)
 
-def get_datetime(exif_dict: Dict[int, Any]) -> Optional[str]:
+    # ---- 3. 軽いシャープ処理（アンシャープマスク） ----
+    with profiler.stage("sharpen"):
+        img_sharp = _sharpen(img_vivid, sharp_amount)
+
+    # NumPy → Pillow Image に戻す
+    with profiler.stage("to_image"):
+        result = Image.fromarray(img_sharp)
+
+    profiler.report(width=w, height=h)
+    return result
+
+def _enhance_kernel(
+    img: np.ndarray,
+    clahe_clip: float,
+    saturation_scale: float,
+    equalize: Optional[Callable[[np.ndarray, np.ndarray], np.ndarray]] = None
+) -> np.ndarray:
     """
-    Exif辞書から撮影日時を抽出し、ISO形式の文字列で返す。
+    enhance_image の CLAHE と彩度アップ。戻り値はバッファプールの配列（次の呼び出しで上書きされる）。
+    equalize(l, dst): CLAHE の代わりに使う関数（タイル処理では画像全体の LUT を適用するものを渡す）
     """
-    if not exif_dict:
-        return None
-    
-    # 'DateTimeOriginal' タグのキー (36867) を取得
-    tag_key = next((k for k, v in ExifTags.TAGS.items() if v == 'DateTimeOriginal'), None)
+    h, w = img.shape[:2]
+
+    # L チャンネルだけ取り出して CLAHE をかけ、同じ LAB バッファに書き戻す
+    lab = cv2.cvtColor(img, cv2.COLOR_RGB2LAB, dst=get_buffer("lab", (h, w, 3)))
+    l = cv2.extractChannel(lab, 0, dst=get_buffer("l", (h, w)))
+    l2 = get_buffer("l2", (h, w))
+    if equalize is None:
+        l2 = get_clahe(clahe_clip).apply(l, dst=l2)
+    else:
+        equalize(l, l2)
+    cv2.insertChannel(l2, lab, 0)
+    img_clahe = cv2.cvtColor(lab, cv2.COLOR_LAB2RGB, dst=get_buffer("rgb", (h, w, 3)))
 
-    if tag_key and tag_key in exif_dict:
-        dt_str = exif_dict[tag_key] # 例: 'YYYY:MM:DD HH:MM:SS'
-        try:
-            return datetime.strptime(dt_str, '%Y:%m:%d %H:%M:%S').isoformat()
-        except ValueError:
-            return None
-    return None
+    # S チャンネルだけを LUT で定数倍する (cv2.multiply と同じ丸め)
+    hsv = cv2.cvtColor(img_clahe, cv2.COLOR_RGB2HSV, dst=get_buffer("hsv", (h, w, 3)))
+    cv2.LUT(hsv, scale_lut((1.0, saturation_scale, 1.0), "round"), dst=hsv)
+    return cv2.cvtColor(hsv, cv2.COLOR_HSV2RGB, dst=get_buffer("vivid", (h, w, 3)))
 
-# =================================================================
-# 3. 位置情報抽出関数
-# =================================================================
-def _convert_to_degrees(value: Tuple[Tuple[int, int], ...]) -> float:
+def _sharpen(img: np.ndarray, sharp_amount: float) -> np.ndarray:
     """
-    GPS座標のDMS形式 (Degree/Minute/Second) を10進数に変換する補助関数。
+    軽いアンシャープマスク。戻り値だけは新しく確保する（プールのバッファは次の呼び出しで上書きされる）。
     """
-    d = float(value[0])
-    m = float(value[1])
-    s = float(value[2])
-    return d + (m / 60.0) + (s / 3600.0)
+    if sharp_amount <= 0:
+        return img.copy()
+    h, w = img.shape[:2]
+    blur = cv2.GaussianBlur(img, (0, 0), sigmaX=1.0, dst=get_buffer("blur", (h, w, 3)))
+    return cv2.addWeighted(img, 1.0 + sharp_amount, blur, -sharp_amount, 0)
 
+#sad関数
 
-def get_gps(exif_dict: Dict[int, Any]) -> Optional[Dict[str, float]]:
+def sad_filter(img_pil: Image.Image, mood: float = 0.6) -> Image.Image:
     """
-    Exif辞書から緯度と経度を抽出し、辞書で返す。
+    しんみりした雰囲気を少しだけ足すフィルター。
+    mood: 0.0（効果なし）〜 1.0（最大でもそこまでキツくない）
     """
-    if not exif_dict:
-        print("GPS Warning: Exif data is missing.", file=sys.stderr)
-        return None
 
-    gps_info_tag_key = next((k for k, v in ExifTags.TAGS.items() if v == 'GPSInfo'), None)
-    
-    if not gps_info_tag_key or gps_info_tag_key not in exif_dict:
-        print("GPS Warning: GPSInfo tag is missing from Exif.", file=sys.stderr)
-        return None
-    
-    gps_info = exif_dict[gps_info_tag_key]
-    gps_tag_map = {v: k for k, v in ExifTags.GPSTAGS.items()}
-    # print(f"GPS Info Tags: {gps_info}", file=sys.stderr)
-    # print(f"GPS Tag Map: {gps_tag_map}", file=sys.stderr)
-    
-    # 必要なGPSタグのキーを取得
-    lat_tag = gps_tag_map.get('GPSLatitude')
-    lon_tag = gps_tag_map.get('GPSLongitude')
-    lat_ref_tag = gps_tag_map.get('GPSLatitudeRef')
-    lon_ref_tag = gps_tag_map.get('GPSLongitudeRef')
-
-    # print(f"[GPS Tags] - Lat: {lat_tag}, Lon: {lon_tag}, LatRef: {lat_ref_tag}, LonRef: {lon_ref_tag}", file=sys.stderr)
-    # print(f"[GPS Info] - Lat:{gps_info[lat_tag]}, Lon{gps_info[lon_tag]}", file=sys.stderr)
-    # print(f"[GPS Info Type] - Lat:{type(gps_info[lat_tag])}, Lon{type(gps_info[lon_tag])}", file=sys.stderr)
-    # print(f"[GPS Info Type2] - Lat:{type(gps_info[lat_tag][0])}, Lon{type(gps_info[lon_tag][0])}", file=sys.stderr)
-    if not all(tag in gps_info for tag in [lat_tag, lon_tag, lat_ref_tag, lon_ref_tag]):
-        print("GPS Warning: One or more critical GPS tags (Lat/Lon/Ref) are missing.", file=sys.stderr)
-        return None
+    # mood を 0〜1 にクリップ
+    mood = max(0.0, min(1.0, mood))
 
-    try:
-        # 10進数に変換
-        lat = _convert_to_degrees(gps_info[lat_tag])
-        lon = _convert_to_degrees(gps_info[lon_tag])
-        # print(f"Extracted Raw Lat/Lon: {lat}, {lon}", file=sys.stderr)
-        # 南北/東西の情報を適用
-        if gps_info[lat_ref_tag] != 'N':
-            lat *= -1
-        if gps_info[lon_ref_tag] != 'E':
-            lon *= -1
-        print(f"Successfully extracted GPS: {lat}, {lon}", file=sys.stderr)
-        return {'latitude': lat, 'longitude': lon}
+    # mood から内部パラメータを決める（値はかなり控えめ）
+    sat_scale     = 1.0 - 0.35 * mood   # 彩度 ↓
+    bright_scale  = 1.0 - 0.08 * mood   # 明るさ ↓
+    cool_strength = 0.12 * mood         # ほんのり寒色寄りに
 
-    except Exception as e:
-        print(f"GPS Warning: Error during conversion: {e}", file=sys.stderr)
-        return None
+    def kernel(img: np.ndarray) -> np.ndarray:
+        # ---- 1. HSV で彩度と明るさだけいじる (H はそのまま) ----
+        hsv = cv2.cvtColor(img, cv2.COLOR_RGB2HSV)
+        cv2.LUT(hsv, scale_lut((1.0, sat_scale, bright_scale)), dst=hsv)
+        img_toned = cv2.cvtColor(hsv, cv2.COLOR_HSV2RGB)
 
-# =================================================================
-# 4. 回転関数
-# =================================================================
+        # ---- 2. ほんの少しだけ寒色寄りに（スケールで調整）----
+        # B（青）を少しだけ増やし、R（赤）を少しだけ減らす (RGB順)
+        cv2.LUT(img_toned, scale_lut((1.0 - cool_strength, 1.0, 1.0 + cool_strength)), dst=img_toned)
+        return img_toned
 
-def rotate_image(img: Image.Image, exif_dict: Dict[int, Any]) -> Image.Image:
-    """
-    Exif辞書のOrientationタグに基づき、画像を物理的に回転させる。
-    """
-    if not exif_dict:
-        return img
-    
-    orientation_tag_key = next((k for k, v in ExifTags.TAGS.items() if v == 'Orientation'), None)
-    
-    if not orientation_tag_key or orientation_tag_key not in exif_dict:
-        return img
-    
-    o = exif_dict[orientation_tag_key]
-    
-    # Orientationタグの値に基づいて回転/反転を適用
-    if o == 3:
-        img = img.transpose(Image.ROTATE_180)
-    elif o == 6:
-        img = img.transpose(Image.ROTATE_270)
-    elif o == 8:
-        img = img.transpose(Image.ROTATE_90)
-    return img
+    # 画素ごとに独立した処理なので、巨大な画像は横帯ごとに処理する
+    if should_tile(img_pil):
+        return pointwise_tiled(img_pil, kernel)
+
+    # Pillow → NumPy (RGB のまま処理する)
+    return Image.fromarray(kernel(np.asarray(img_pil if img_pil.mode == "RGB" else img_pil.convert("RGB"))))
 
-def analyze_image_mood(img_path: str) -> str:
+#鉛筆
+# 鉛筆画エンジンの既定値 (opencv / downscaled / dodge)。詳細は sketch_engines.py
+SKETCH_ENGINE = os.environ.get("SKETCH_ENGINE", "downscaled")
+SKETCH_WORK_EDGE = int(os.environ.get("SKETCH_WORK_EDGE", "1536"))
+
+def pencil_sketch_filter(img_pil: Image.Image, mood: float=0.3, engine: str = None) -> Image.Image:
     """
-    画像をGPT-4o-miniに送信し、最適なフィルターを決定する。
-    戻り値: 'vivid', 'sad', 'sketch' のいずれか
+    OpenCV の pencilSketch を使った鉛筆画フィルター。
+    mood: 0.0（効果なし）〜 1.0（控えめ〜標準の鉛筆画）
+    engine: 'opencv'（原寸で pencilSketch）, 'downscaled'（縮小して実行しガイド付きで拡大）,
+            'dodge'（覆い焼き合成）。省略時は SKETCH_ENGINE。
     """
-    api_key = os.environ.get("OPENAI_API_KEY")
-    load_dotenv(os.path.join(os.path.dirname(__file__), '../.env'))
-    client = OpenAI(api_key=api_key)
 
-    # 画像をBase64エンコード
-    with open(img_path, "rb") as image_file:
-        base64_image = base64.b64encode(image_file.read()).decode('utf-8')
+    # mood を 0〜1 に制限
+    mood = max(0.0, min(1.0, mood))
 
-    try:
-        response = client.chat.completions.create(
-            model="gpt-4o-mini", # コストと速度重視でminiを使用
-            messages=[
-                {
-                    "role": "user",
-                    "content": [
-                        {
-                            "type": "text", 
-                            "text": (
-                                "Analyze this image and decide which filter style fits best.\n"
-                                "1. 'vivid': For landscapes, food, or happy scenes (enhance color/contrast).\n"
-                                "2. 'sad': For rainy, dark, or melancholic scenes (desaturate, cool tone).\n"
-                                "3. 'sketch': For architectural, structural, or high-contrast lines (pencil style).\n"
-                                "Return ONLY the keyword: 'vivid', 'sad', or 'sketch'."
-                            )
-                        },
-                        {
-                            "type": "image_url",
-                            "image_url": {
-                                "url": f"data:image/jpeg;base64,{base64_image}"
-                            }
-                        }
-                    ]
-                }
-            ],
-            max_tokens=10
-        )
-        decision = response.choices[0].message.content.strip(" '\"").lower()
-        
-        # 想定外の回答が来た場合のガード
-        if decision not in ['vivid', 'sad', 'sketch']:
-            print(f"GPT returned unexpected value: {decision}. Fallback to 'vivid'.", file=sys.stderr)
-            return "vivid"
-            
-        return decision
+    # pencilSketch 用の軽めパラメータを生成
+    sigma_s = 30 + 70 * mood       # 空間スケール（大きいとより鉛筆画ぽい）
+    sigma_r = 0.05 + 0.15 * mood   # 反射率（小さい方が線が細く繊細）
+    shade   = 0.03 + 0.07 * mood   # 影の濃さ（控えめ～標準）
+
+    engine = engine or SKETCH_ENGINE
+    if engine not in SKETCH_ENGINES:
+        raise ValueError(f"Unknown sketch engine: {engine}")
+
+    if should_tile(img_pil):
+        # 巨大な画像では原寸の配列を作らず、縮小版で求めたガイド係数を横帯ごとに適用する
+        # (エンジンの指定にかかわらず downscaled と同じ方式になる)
+        return _pencil_sketch_tiled(img_pil, sigma_s, sigma_r, shade)
+
+    # Pillow → NumPy (RGB)
+    img = np.asarray(img_pil if img_pil.mode == "RGB" else img_pil.convert("RGB"))
+
+    # 今回は「控えめなグレー鉛筆画」のほうを使う
+    if engine == 'downscaled':
+        sketch = sketch_downscaled(img, sigma_s, sigma_r, shade, work_edge=SKETCH_WORK_EDGE)
+    else:
+        sketch = SKETCH_ENGINES[engine](img, sigma_s, sigma_r, shade)
+
+    # グレー → RGB → Pillow
+    sketch_rgb = cv2.cvtColor(sketch, cv2.COLOR_GRAY2RGB)
+    return Image.fromarray(sketch_rgb)
+
+def _pencil_sketch_tiled(img_pil: Image.Image, sigma_s: float, sigma_r: float, shade: float) -> Image.Image:
+    """
+    pencil_sketch_filter のタイル版。縮小 (長辺 SKETCH_WORK_EDGE) は Pillow で行い、
+    原寸で必要なのは横帯ごとのグレー化と係数の適用だけにする。
+    """
+    img_pil = img_pil if img_pil.mode == "RGB" else img_pil.convert("RGB")
+    width, height = img_pil.size
+    scale = SKETCH_WORK_EDGE / max(width, height)
+    small_size = (max(1, round(width * scale)), max(1, round(height * scale)))
+    small = np.asarray(img_pil.resize(small_size, Image.BOX))
+    small_sketch = sketch_opencv(small, sigma_s, sigma_r, shade)
+    small_gray = cv2.cvtColor(small, cv2.COLOR_RGB2GRAY)
+    return guided_upsample_tiled(img_pil, guided_coefficients(small_sketch, small_gray))
 
-    except Exception as e:
-        print(f"GPT API Error: {e}. Fallback to 'vivid'.", file=sys.stderr)
-        return "vivid"
 # =================================================================
-# 5.画像処理関数
+# 参照実装 (LUT 版との一致確認用)
 # =================================================================
-#1.映えの処理
-def enhance_image(
+# benchmark.py の一致確認 (check_parity) で高速版と比べる。
+
+def _enhance_image_reference(
     img_pil: Image.Image,
     clahe_clip: float = 2.0,        # コントラスト強調の強さ（小さいほど自然）
     saturation_scale: float = 1.2,  # 彩度アップ倍率（1.0〜1.15が自然）
     sharp_amount: float = 0.3        # シャープの強さ（0〜0.5が推奨）
 ) -> Image.Image:
     """
-    Pillow Image を受け取り、
-    - CLAHE（マイルド）
-    - 彩度アップ（控えめ）
-    - アンシャープマスク（軽め）
-    を適用して、自然に映える画像を返す関数。
+    enhance_image の元の実装（高速版との一致確認・ベンチマーク用）。
     """
 
     # RGB 変換（Pillow → NumPy）
@@ -252,12 +266,9 @@ def enhance_image(
     img_rgb = cv2.cvtColor(img_sharp, cv2.COLOR_BGR2RGB)
     return Image.fromarray(img_rgb)
 
-#sad関数
-
-def sad_filter(img_pil: Image.Image, mood: float = 0.6) -> Image.Image:
+def _sad_filter_reference(img_pil: Image.Image, mood: float = 0.6) -> Image.Image:
     """
-    しんみりした雰囲気を少しだけ足すフィルター。
-    mood: 0.0（効果なし）〜 1.0（最大でもそこまでキツくない）
+    sad_filter の元の実装（高速版との一致確認・ベンチマーク用）。
     """
 
     # mood を 0〜1 にクリップ
@@ -298,115 +309,346 @@ def sad_filter(img_pil: Image.Image, mood: float = 0.6) -> Image.Image:
     img_rgb = cv2.cvtColor(img_f, cv2.COLOR_BGR2RGB)
     return Image.fromarray(img_rgb)
 
-#鉛筆
-def pencil_sketch_filter(img_pil: Image.Image, mood: float=0.3) -> Image.Image:
+# =================================================================
+# メイン処理関数
+# =================================================================
+
+# 出力画像の長辺の上限 (0 で原寸のまま)。結果ページは画面サイズでしか表示しないため
+MAX_OUTPUT_DIM = int(os.environ.get("MAX_OUTPUT_DIM", "2048"))
+
+def load_image(input_path: str, max_dim: int = MAX_OUTPUT_DIM, source: Any = None) -> Tuple[Image.Image, Dict]:
     """
-    OpenCV の pencilSketch を使った鉛筆画フィルター。
-    mood: 0.0（効果なし）〜 1.0（控えめ〜標準の鉛筆画）
+    画像を開き、向きを補正して (画像, Exif) を返す。
+    max_dim を超える JPEG は draft デコードで 1/2, 1/4, 1/8 スケールのまま読み込み、
+    残りは reduce + LANCZOS で長辺 max_dim まで縮小する（原寸の画素は展開しない）。
+    source を渡すと、input_path の代わりにそこ (メモリマップなど) から読む。
     """
+    with span("exif") as s:
+        img_pil = Image.open(source if source is not None else input_path)
+        exif = get_exif(img_pil)
+        original_size = img_pil.size
+        s['found'] = bool(exif)
+
+    with span("decode", width=original_size[0], height=original_size[1], bytes=os.path.getsize(input_path)) as s:
+        if max_dim and max(original_size) > max_dim:
+            scale = max_dim / max(original_size)
+            target = (max(1, round(original_size[0] * scale)), max(1, round(original_size[1] * scale)))
+            # draft は target 以上になる最小のスケールを選ぶ (JPEG 以外では何もしない)
+            img_pil.draft('RGB', target)
+            if max(img_pil.size) > max_dim:
+                img_pil.thumbnail((max_dim, max_dim), Image.LANCZOS, reducing_gap=2.0)
+        img_pil.load()
+        s['out_width'], s['out_height'] = img_pil.size
+
+    with span("rotate"):
+        img_pil = rotate_image(img_pil, exif)
+    return img_pil, exif
 
-    # mood を 0〜1 に制限
-    mood = max(0.0, min(1.0, mood))
-
-    # pencilSketch 用の軽めパラメータを生成
-    sigma_s = 30 + 70 * mood       # 空間スケール（大きいとより鉛筆画ぽい）
-    sigma_r = 0.05 + 0.15 * mood   # 反射率（小さい方が線が細く繊細）
-    shade   = 0.03 + 0.07 * mood   # 影の濃さ（控えめ～標準）
+def load_image_with_digest(input_path: str, max_dim: int = MAX_OUTPUT_DIM) -> Tuple[Image.Image, Dict, str]:
+    """
+    load_image と同じだが、元ファイルの SHA-256 も返す。
+    ファイルをメモリマップし、ハッシュとデコードで同じページを使う (ファイルを2回読まない)。
+    """
+    with open(input_path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as source:
+        with span("sha256"):
+            digest = hashlib.sha256(source).hexdigest()
+        img_pil, exif = load_image(input_path, max_dim, source)
+    return img_pil, exif, digest
 
-    # Pillow → BGR(OpenCV)
-    img_pil = img_pil.convert("RGB")
-    img = np.array(img_pil)
-    img = cv2.cvtColor(img, cv2.COLOR_RGB2BGR)
+# =================================================================
+# 出力 (原寸・Web 表示用・サムネイル)
+# =================================================================
+# OUTPUT_FORMAT: jpeg (最適化済みプログレッシブ JPEG) / webp
+OUTPUT_FORMAT = os.environ.get("OUTPUT_FORMAT", "jpeg").lower()
+
+# 大きい順に並べる。max_dim は長辺の上限 (0 で縮小しない)
+RENDITIONS = [
+    {'name': 'full', 'max_dim': 0, 'quality': int(os.environ.get("OUTPUT_QUALITY", "85"))},
+    {'name': 'web', 'max_dim': int(os.environ.get("WEB_MAX_DIM", "1280")), 'quality': int(os.environ.get("WEB_QUALITY", "80"))},
+    {'name': 'thumb', 'max_dim': int(os.environ.get("THUMB_MAX_DIM", "320")), 'quality': int(os.environ.get("THUMB_QUALITY", "75"))},
+]
+
+# 形式ごとの (拡張子, Pillow の形式名, 保存オプション)
+ENCODERS = {
+    'jpeg': ('.jpg', 'JPEG', lambda quality: {'quality': quality, 'optimize': True, 'progressive': True}),
+    'webp': ('.webp', 'WEBP', lambda quality: {'quality': quality, 'method': 4}),
+}
+
+def save_renditions(img: Image.Image, output_dir: str, base_name: str, fmt: str = OUTPUT_FORMAT) -> Dict[str, str]:
+    """
+    処理済みの画像から RENDITIONS の各サイズを書き出し、{名前: 公開パス} を返す。
+    縮小は直前のサイズから順に行う。縮小が不要なサイズは直前のファイルをそのまま使う。
+    """
+    if fmt not in ENCODERS:
+        raise ValueError(f"Unknown output format: {fmt}")
+    ext, pil_format, options = ENCODERS[fmt]
+
+    img = img if img.mode == "RGB" else img.convert("RGB")
+    paths: Dict[str, str] = {}
+    previous = None
+    for rendition in RENDITIONS:
+        max_dim = rendition['max_dim']
+        if previous is not None and (not max_dim or max(img.size) <= max_dim):
+            paths[rendition['name']] = previous
+            continue
+        if max_dim and max(img.size) > max_dim:
+            img = img.copy()
+            img.thumbnail((max_dim, max_dim), Image.LANCZOS, reducing_gap=2.0)
+
+        suffix = '' if rendition['name'] == 'full' else f"-{rendition['name']}"
+        filename = f"{base_name}{suffix}{ext}"
+        output_path = os.path.join(output_dir, filename)
+        with span("save", rendition=rendition['name'], format=fmt, width=img.size[0], height=img.size[1]) as s:
+            img.save(output_path, pil_format, **options(rendition['quality']))
+            s['bytes'] = os.path.getsize(output_path)
+        previous = paths[rendition['name']] = '/results/images/' + filename
+    return paths
+
+# 解析 (ネットワーク待ち) とデコード・フィルター (CPU) を並行して行う。0 で従来どおり順番に処理する
+PIPELINE_ENABLED = os.environ.get("PROCESS_PIPELINE", "1") != "0"
+# 解析を待つ間にローカル判定のスタイルで原寸のフィルターを先にかける (投機実行) 確信度の下限。
+# ローカル判定は未調整なので、外れて捨てる分の CPU を使わないよう既定では無効 (1 より大きい)
+SPECULATIVE_MIN_CONFIDENCE = float(os.environ.get("SPECULATIVE_MIN_CONFIDENCE", "1.01"))
+_analysis_executor = ThreadPoolExecutor(max_workers=int(os.environ.get("PIPELINE_ANALYSIS_WORKERS", "8")))
+
+def apply_filter(style: str, img_pil: Image.Image, speculative: bool = False) -> Image.Image:
+    """
+    判定結果に基づき画像処理を実行する。
+    """
+    with span("filter", style=style, speculative=speculative, width=img_pil.size[0], height=img_pil.size[1]):
+        if style == "vivid":
+            return enhance_image(img_pil)
+        elif style == "sad":
+            return sad_filter(img_pil)
+        elif style == "sketch":
+            return pencil_sketch_filter(img_pil)
+        else:
+            return enhance_image(img_pil) # Default
+
+def process_image(
+    input_path: str,
+    output_dir: str,
+    result_id: str,
+    original_name: str,
+    handoff: bool = False
+) -> Dict[str, Any]:
+    """
+    1枚の画像を処理して保存し、Node.js に返すメタデータ辞書を返す。
+    失敗した場合は例外を送出する（CLI と常駐ワーカーの両方から呼ばれる）。
+    PROCESS_PIPELINE が有効なら、GPT の解析を待つ間に原寸のデコードを済ませておく。
+    ローカル判定の確信度が SPECULATIVE_MIN_CONFIDENCE 以上なら、そのスタイルでのフィルター (投機実行) も行う。
+    handoff=True なら、decide_effects 用の受け渡しファイル (handoff.py) を入力ファイルの隣に書き出す
+    (削除は呼び出し側が一時ファイルと一緒に行う)。
+    各段階の span には result_id と入力ファイル名の trace ID が付く。
+    """
+    try:
+        with trace(f"{result_id}:{os.path.basename(input_path)}"), span("process_image"):
+            return _process_image(input_path, output_dir, result_id, original_name, handoff)
+    finally:
+        # 作業バッファはジョブの間だけ使い回す (待機中のスレッドに大きな配列を残さない)
+        release_buffers()
+        flush()
+
+def _write_handoff(input_path: str, img_pil: Image.Image, phash: Optional[str], image_hash: Optional[str]) -> None:
+    with span("handoff"):
+        try:
+            write_analysis_handoff(input_path, img_pil, phash, image_hash)
+        except OSError as e:
+            # 書けなくても decide_effects が原寸から作り直すだけなので、処理は続ける
+            print(f"Handoff Warning: could not write analysis image for {input_path}: {e}", file=sys.stderr)
+
+def _process_image(
+    input_path: str,
+    output_dir: str,
+    result_id: str,
+    original_name: str,
+    handoff: bool = False
+) -> Dict[str, Any]:
+    started = time.perf_counter()
+
+    # 1. スタイルの判定 (ヘッダーと縮小デコードだけで行う)
+    # まず縮小画像の特徴量でローカルに判定し、確信度が高ければ GPT を待たずにフィルターを決める
+    count("images_processed_total")
+    with span("classify_local") as s:
+        local_style, confidence = classify_style_file(input_path)
+        s['style'], s['confidence'] = local_style, round(confidence, 3)
+    print(f"Local style: {local_style} (confidence {confidence:.2f}, threshold {LOCAL_STYLE_THRESHOLD})", file=sys.stderr)
+
+    analysis_future = None
+    if confidence < LOCAL_STYLE_THRESHOLD:
+        # GPTによるスタイル・風景・感情の判定 (API Call は1回だけ)
+        # 解析用の縮小画像はファイルから draft デコードで作るので、原寸のデコードを待たずに始められる
+        # API エラー時は 'vivid' 固定ではなくローカル判定の結果を使う
+        print("Consulting GPT-4o for image style, scenery and emotion...", file=sys.stderr)
+        # trace ID を解析スレッドにも引き継ぐ
+        analysis_future = _analysis_executor.submit(contextvars.copy_context().run, analyze, input_path, None, local_style)
+        if not PIPELINE_ENABLED:
+            analysis_future.result()
+
+    # 2. 入力パスから画像を読み込む (MAX_OUTPUT_DIM を超える場合は縮小デコード)
+    # 受け渡しファイルを書く場合は、decide_effects のキャッシュキーになる SHA-256 も読み込みと一緒に計算する
+    image_hash = None
+    if handoff and analysis_future is None and get_cache() is not None:
+        img_pil, exif, image_hash = load_image_with_digest(input_path)
+    else:
+        img_pil, exif = load_image(input_path)
+
+    meta_data = {
+        'temp_path': input_path,
+        # 近似重複の判定用 (decide_effects が同じ写真を読み直さなくて済むように)。平坦な写真は None
+        'phash': signature(img_pil)
+    }
+    if exif:
+        meta_data['date_time'] = get_datetime(exif)
+        meta_data['location'] = get_gps(exif) 
+    else:
+        meta_data['date_time'] = None
+        meta_data['location'] = None
+        print("No Exif data found in image.", file=sys.stderr)
+    # ログ出力 (Node.jsのstderrに出力される)
+    print(f"Extracted Metadata: {meta_data}", file=sys.stderr)
+
+    handoff_future = None
+    if handoff and analysis_future is None:
+        # scenery / emotion は decide_effects が解析するので、デコード済みの画像から解析用 JPEG を作って渡す
+        # (decide_effects が原寸を読み直して縮小・エンコードしなくて済む)。フィルターと並行して書き出す
+        handoff_future = _analysis_executor.submit(
+            contextvars.copy_context().run, _write_handoff, input_path, img_pil, meta_data['phash'], image_hash
+        )
 
-    # pencilSketch（gray, color を返す）
-    dst_gray, dst_color = cv2.pencilSketch(
-        img,
-        sigma_s=sigma_s,
-        sigma_r=sigma_r,
-        shade_factor=shade
-    )
+    # 3. 判定結果に基づき画像処理を実行
+    speculative = None
+    if analysis_future is None:
+        style = local_style
+        meta_data['style_source'] = 'local'
+        # scenery / emotion は decide_effects 側で解析する（analysis を渡さない）
+    else:
+        if PIPELINE_ENABLED and confidence >= SPECULATIVE_MIN_CONFIDENCE and not analysis_future.done():
+            # 確信度が高ければ、解析を待つ間にローカル判定のスタイルでフィルターをかけておく (外れたら捨てる)
+            speculative = apply_filter(local_style, img_pil, speculative=True)
+        with span("analysis_wait") as s:
+            wait_started = time.perf_counter()
+            analysis = analysis_future.result()
+            waited = time.perf_counter() - wait_started
+            s['style'] = analysis['style']
+        style = analysis['style']
+        print(f"GPT Decision: {analysis} (waited {waited:.2f}s after decode)", file=sys.stderr)
+        meta_data['style_source'] = 'gpt'
+        # decide_effects が再解析しなくて済むように風景・感情も渡す
+        meta_data['analysis'] = {
+            'scenery': analysis['scenery'],
+            'emotion': analysis['emotion']
+        }
 
-    # 今回は「控えめなグレー鉛筆画」のほうを使う
-    sketch = dst_gray
+    # メタデータに決定したスタイルも含める（フロントエンドで表示したければ）
+    meta_data['style'] = style
 
-    # グレー → RGB → Pillow
-    sketch_rgb = cv2.cvtColor(sketch, cv2.COLOR_GRAY2RGB)
-    return Image.fromarray(sketch_rgb)
+    if speculative is not None and style == local_style:
+        new_img = speculative
+    else:
+        if speculative is not None:
+            print(f"Speculative '{local_style}' filter discarded (GPT chose '{style}')", file=sys.stderr)
+            count("speculative_filter_discarded_total")
+        new_img = apply_filter(style, img_pil)
+
+    # 4. 処理後の画像を出力パスに保存する
+    if meta_data['date_time']:
+        time_prefix = datetime.fromisoformat(meta_data['date_time']).strftime('%y%m%d%H%M%S') # 日時をYYMMDDHHmmss形式にフォーマット (命名の基礎)
+    else:
+        # 日時情報がない場合は、処理時刻を使用
+        time_prefix = datetime.now().strftime('unknown_%y%m%d%H%M%S')
+    # 原寸・Web 表示用・サムネイルを1回の処理でまとめて書き出す
+    renditions = save_renditions(new_img, output_dir, f"{result_id}-{time_prefix}")
+    meta_data['filepath'] = renditions['full']
+    meta_data['renditions'] = renditions
+    if handoff_future is not None:
+        # decide_effects が呼ばれる前に書き終えておく
+        handoff_future.result()
+    print(f"Successfully processed image and saved to {output_dir}: {renditions} ({time.perf_counter() - started:.2f}s)", file=sys.stderr)
+    return meta_data
+
+
+def process_image_job(args: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    常駐ワーカー用のジョブハンドラ。
+    args: {"temp_path", "output_dir", "result_id", "original_name", "handoff" (省略時 False)}
+    """
+    return process_image(
+        args['temp_path'], args['output_dir'], args['result_id'], args['original_name'],
+        handoff=bool(args.get('handoff', False))
+    )
 
 # =================================================================
-# メイン処理関数
+# バッチ処理 (1プロセスで全コアを使う)
 # =================================================================
 
-def process_image(input_path: str, output_dir: str, result_id: str, original_name: str) -> None:
+# cv2 / Pillow の重い処理は GIL を解放するのでスレッドで十分並列化できる
+BATCH_WORKERS = int(os.environ.get("BATCH_WORKERS", str(os.cpu_count() or 1)))
+
+
+def _process_manifest_item(item: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    バッチの1件を処理する。失敗しても例外にせず、error を含む辞書を返す。
+    """
     try:
-        # 1. 入力パスから画像を読み込む
-        img_pil = Image.open(input_path)
+        return process_image_job(item)
+    except Exception as e:
+        print(f"Batch item failed ({item.get('temp_path')}): {e}", file=sys.stderr)
+        return {'temp_path': item.get('temp_path'), 'error': str(e)}
 
-        exif = get_exif(img_pil)
-        img_pil = rotate_image(img_pil, exif)
 
-        meta_data = {
-            'temp_path': input_path
-        }
-        if exif:
-            meta_data['date_time'] = get_datetime(exif)
-            meta_data['location'] = get_gps(exif) 
-        else:
-            meta_data['date_time'] = None
-            meta_data['location'] = None
-            print("No Exif data found in image.", file=sys.stderr)
-        # ログ出力 (Node.jsのstderrに出力される)
-        print(f"Extracted Metadata: {meta_data}", file=sys.stderr)
-        
-        # 2. GPTによるスタイル判定 (API Call)
-        print("Consulting GPT-4o for image style...", file=sys.stderr)
-        style = analyze_image_mood(input_path)
-        print(f"GPT Decision: {style}", file=sys.stderr)
-        
-        # メタデータに決定したスタイルも含める（フロントエンドで表示したければ）
-        meta_data['style'] = style
-
-        # 3. 判定結果に基づき画像処理を実行
-        if style == "vivid":
-            new_img = enhance_image(img_pil)
-        elif style == "sad":
-            new_img = sad_filter(img_pil)
-        elif style == "sketch":
-            new_img = pencil_sketch_filter(img_pil)
-        else:
-            new_img = enhance_image(img_pil) # Default
+def process_batch(manifest: List[Dict[str, Any]], workers: int = BATCH_WORKERS) -> Iterator[Dict[str, Any]]:
+    """
+    マニフェスト（process_image_job の args のリスト）をスレッドプールで処理し、
+    メタデータを入力順に1件ずつ返す。
+    """
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        yield from executor.map(_process_manifest_item, manifest)
 
-        # 3. 処理後の画像を出力パスに保存する
-        if meta_data['date_time']:
-            time_prefix = datetime.fromisoformat(meta_data['date_time']).strftime('%y%m%d%H%M%S') # 日時をYYMMDDHHmmss形式にフォーマット (命名の基礎)
-        else:
-            # 日時情報がない場合は、処理時刻を使用
-            time_prefix = datetime.now().strftime('unknown_%y%m%d%H%M%S')
-        file_ext = os.path.splitext(original_name)[1]
-        final_filename = f"{result_id}-{time_prefix}{file_ext}"
-        meta_data['filepath'] =  '/results/images/'+ final_filename
-        output_path = os.path.join(output_dir, final_filename)
-
-        new_img.save(output_path)
-        
-        print(json.dumps(meta_data)) # Node.js側で受け取るためにメタデータを標準出力に出力
-        print(f"Successfully processed image and saved to {output_path}", file=sys.stderr)
-        sys.exit(0) # 成功終了
 
-    except FileNotFoundError:
-        print(f"Error: Input file not found at {input_path}", file=sys.stderr)
-        sys.exit(1) # エラー終了
-    except Exception as e:
-        print(f"An unexpected error occurred: {e}", file=sys.stderr)
-        sys.exit(1) # エラー終了
+def process_batch_job(args: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """
+    常駐ワーカー用のジョブハンドラ。
+    args: {"items": [{"temp_path", "output_dir", "result_id", "original_name"}, ...]}
+    """
+    return list(process_batch(args.get('items', [])))
 
 # =================================================================
 # 実行部分
 # =================================================================
 
 if __name__ == "__main__":
+    if len(sys.argv) >= 2 and sys.argv[1] == "--profile-startup":
+        # 起動時間 (import) をモジュールごとに計測し、STARTUP_BUDGET_MS を超えていれば終了コード 1
+        from startup_profile import main as profile_startup
+        sys.exit(profile_startup("process_image"))
+
+    if len(sys.argv) >= 2 and sys.argv[1] == "--worker":
+        # 常駐モード: stdin から NDJSON のジョブを受け取り続ける
+        from worker import serve
+        concurrency = int(os.environ.get("PY_WORKER_CONCURRENCY", "4"))
+        serve({"process_image": process_image_job, "process_batch": process_batch_job}, concurrency=concurrency)
+        sys.exit(0)
+
+    if len(sys.argv) == 3 and sys.argv[1] == "--batch":
+        # バッチモード: マニフェスト(JSON配列)の画像を並列処理し、1件ごとに1行のJSONを入力順に出力する
+        manifest_path = sys.argv[2]
+        if manifest_path == "-":
+            manifest = json.load(sys.stdin)
+        else:
+            with open(manifest_path, encoding="utf-8") as f:
+                manifest = json.load(f)
+        failed = 0
+        for meta_data in process_batch(manifest):
+            failed += 'error' in meta_data
+            print(json.dumps(meta_data), flush=True)
+        sys.exit(1 if failed else 0)
+
     if len(sys.argv) != 5:
         print("Usage: python process_image.py <temp_path> <output_dir> <result_id> <original_name>", file=sys.stderr)
+        print("       python process_image.py --batch <manifest.json | ->", file=sys.stderr)
+        print("       python process_image.py --worker", file=sys.stderr)
+        print("       python process_image.py --profile-startup", file=sys.stderr)
         sys.exit(1)
     
     input_file = sys.argv[1]
@@ -414,4 +656,13 @@ if __name__ == "__main__":
     result_id = sys.argv[3]
     original_name = sys.argv[4]
     
-    process_image(input_file, output_dir, result_id, original_name)
\ No newline at end of file
+    try:
+        meta_data = process_image(input_file, output_dir, result_id, original_name)
+        print(json.dumps(meta_data)) # Node.js側で受け取るためにメタデータを標準出力に出力
+        sys.exit(0) # 成功終了
+    except FileNotFoundError:
+        print(f"Error: Input file not found at {input_file}", file=sys.stderr)
+        sys.exit(1) # エラー終了
+    except Exception as e:
+        print(f"An unexpected error occurred: {e}", file=sys.stderr)
+        sys.exit(1) # エラー終了
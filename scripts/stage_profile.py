@@ -0,0 +1,58 @@
+import os
+import sys
+import json
+import time
+import resource
+import tracemalloc
+from contextlib import contextmanager
+from typing import Dict, Iterator
+
+sys.path.append(os.path.dirname(__file__))
+from telemetry import span
+
+# =================================================================
+# 処理段階ごとの時間・メモリ計測
+# =================================================================
+# FILTER_PROFILE=1 のときだけ計測し、結果を1行の JSON として stderr に出す。
+# ピークメモリは tracemalloc (NumPy / OpenCV の配列確保も追跡される) と ru_maxrss の両方を出す。
+# 各段階の処理時間は FILTER_PROFILE に関係なく telemetry の span (<name>.<stage>) としても記録する。
+
+PROFILE_ENABLED = os.environ.get("FILTER_PROFILE") == "1"
+
+
+class StageProfiler:
+    def __init__(self, name: str, enabled: bool = PROFILE_ENABLED):
+        self.name = name
+        self.enabled = enabled
+        self.timings: Dict[str, float] = {}
+        if enabled:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+            tracemalloc.reset_peak()
+
+    @contextmanager
+    def stage(self, stage_name: str) -> Iterator[None]:
+        with span(f"{self.name}.{stage_name}"):
+            if not self.enabled:
+                yield
+                return
+            start = time.perf_counter()
+            try:
+                yield
+            finally:
+                self.timings[stage_name] = self.timings.get(stage_name, 0.0) + (time.perf_counter() - start) * 1000
+
+    def report(self, **extra) -> None:
+        if not self.enabled:
+            return
+        _, peak = tracemalloc.get_traced_memory()
+        payload = {
+            'profile': self.name,
+            'stages_ms': {k: round(v, 2) for k, v in self.timings.items()},
+            'total_ms': round(sum(self.timings.values()), 2),
+            'peak_traced_mb': round(peak / (1024 * 1024), 1),
+            # Linux では KiB 単位
+            'max_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        }
+        payload.update(extra)
+        print(json.dumps(payload), file=sys.stderr)
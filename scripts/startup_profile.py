@@ -0,0 +1,113 @@
+import sys
+import os
+import json
+import time
+import subprocess
+from typing import Dict, List, Optional, Tuple
+
+# =================================================================
+# 起動時間 (import) の計測と予算チェック
+# =================================================================
+# 使い方:
+#   python scripts/process_image.py --profile-startup
+#   python scripts/decide_effects.py --profile-startup
+# 新しいインタープリターで `python -X importtime` を実行し、Node.js がワーカーを起動したときと同じ
+# 条件 (キャッシュ済みの .pyc) でスクリプトの import にかかる時間をパッケージごとに集計する。
+# 起動から import 完了までの実時間が STARTUP_BUDGET_MS を超えたら終了コード 1 を返す (CI で使う)。
+# API を呼ぶときだけ読み込むモジュール (openai / dotenv) は deferred として別に表示し、予算には含めない。
+
+# ワーカー1回の起動 (インタープリター起動 + import) にかけてよい時間 (ミリ秒)
+STARTUP_BUDGET_MS = float(os.environ.get("STARTUP_BUDGET_MS", "600"))
+
+# 必要になるまで読み込まないモジュール (起動時に読み込まれていたら遅延読み込みが壊れている)
+DEFERRED_MODULES = ['openai', 'dotenv']
+
+SCRIPTS_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def parse_importtime(stderr: str) -> List[Tuple[str, int, int]]:
+    """
+    -X importtime の出力を (モジュール名, 自身の時間 us, 累積時間 us) のリストにする。
+    """
+    rows = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|", 2)
+        rows.append((name.strip(), int(self_us), int(cumulative_us)))
+    return rows
+
+
+def _run_importtime(code: str) -> Tuple[float, List[Tuple[str, int, int]]]:
+    start = time.perf_counter()
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", code],
+        cwd=SCRIPTS_DIR, capture_output=True, text=True,
+        # 計測中に span の行を出さない
+        env=dict(os.environ, TELEMETRY="0"),
+    )
+    wall_ms = (time.perf_counter() - start) * 1000
+    if proc.returncode != 0:
+        raise RuntimeError(f"import failed:\n{proc.stderr[-2000:]}")
+    return wall_ms, parse_importtime(proc.stderr)
+
+
+def by_package(rows: List[Tuple[str, int, int]]) -> Dict[str, float]:
+    """
+    自身の時間をトップレベルのパッケージごとに合計する (ミリ秒)。
+    """
+    totals: Dict[str, float] = {}
+    for name, self_us, _ in rows:
+        package = name.split(".")[0]
+        totals[package] = totals.get(package, 0.0) + self_us / 1000
+    return totals
+
+
+def profile_startup(module: str, budget_ms: float = STARTUP_BUDGET_MS, top: int = 15) -> Dict:
+    """
+    module の import を新しいプロセスで計測する。
+    1回目は .pyc の作成が混ざるので捨て、2回目を使う。
+    """
+    _run_importtime(f"import {module}")
+    wall_ms, rows = _run_importtime(f"import {module}")
+    packages = by_package(rows)
+    loaded = {name for name, _, _ in rows}
+    eager_deferred = [m for m in DEFERRED_MODULES if m in loaded]
+
+    # 遅延読み込みしているモジュールを後から読み込んだときのコスト (参考値)
+    probe = "; ".join([f"import {module}"] + [f"import {m}" for m in DEFERRED_MODULES if m not in loaded])
+    _, deferred_rows = _run_importtime(probe)
+    deferred = {m: round(ms, 1) for m, ms in by_package(deferred_rows).items() if m in DEFERRED_MODULES and m not in loaded}
+
+    module_ms = next((cumulative / 1000 for name, _, cumulative in rows if name == module), 0.0)
+    return {
+        'module': module,
+        'wall_ms': round(wall_ms, 1),
+        'import_ms': round(module_ms, 1),
+        'budget_ms': budget_ms,
+        'within_budget': wall_ms <= budget_ms and not eager_deferred,
+        'packages': {name: round(ms, 1) for name, ms in sorted(packages.items(), key=lambda item: -item[1])[:top]},
+        'deferred': deferred,
+        'eagerly_loaded_deferred': eager_deferred,
+    }
+
+
+def main(module: str, budget_ms: Optional[float] = None) -> int:
+    """
+    --profile-startup の処理。結果を JSON で stdout に出し、予算を超えていれば 1 を返す。
+    """
+    report = profile_startup(module, STARTUP_BUDGET_MS if budget_ms is None else budget_ms)
+    print(json.dumps(report, indent=2))
+    if report['eagerly_loaded_deferred']:
+        print(f"Startup check failed: {module} imports {report['eagerly_loaded_deferred']} at startup", file=sys.stderr)
+        return 1
+    if not report['within_budget']:
+        print(f"Startup check failed: {module} took {report['wall_ms']}ms (budget {report['budget_ms']}ms)", file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    # python scripts/startup_profile.py process_image decide_effects
+    modules = sys.argv[1:] or ['process_image', 'decide_effects']
+    sys.exit(max(main(m) for m in modules))
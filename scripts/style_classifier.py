@@ -0,0 +1,105 @@
+import os
+import sys
+from typing import Dict, Tuple
+
+import cv2
+import numpy as np
+from PIL import Image
+
+sys.path.append(os.path.dirname(__file__))
+from mapping_config import STYLE_LABELS
+
+# =================================================================
+# ローカルのスタイル判定 (vivid / sad / sketch)
+# =================================================================
+# 縮小画像から安い特徴量だけを計算し、線形スコア + softmax で確信度を出す。
+# 確信度が LOCAL_STYLE_THRESHOLD 以上なら GPT を待たずにフィルターを決める。
+# 重みは手で決めた初期値なので、bench_style_classifier.py で GPT の判定との一致率を見て調整する。
+# 一致率を確認するまでは既定で無効 (閾値 > 1 なので常に GPT を使う)。確認した閾値を環境変数で指定して有効にする。
+
+# これ以上の確信度ならローカル判定を採用する (1 より大きいと常に GPT を使う)
+LOCAL_STYLE_THRESHOLD = float(os.environ.get("LOCAL_STYLE_THRESHOLD", "1.01"))
+
+# 特徴量を計算する縮小画像の長辺
+FEATURE_EDGE = 256
+
+# スタイルごとの (特徴量の重み, バイアス)。特徴量はいずれも 0〜1 程度に正規化してある
+STYLE_WEIGHTS: Dict[str, Tuple[Dict[str, float], float]] = {
+    'vivid': ({'saturation': 4.0, 'colorfulness': 3.0, 'brightness': 1.5, 'dark_fraction': -2.0}, -1.5),
+    'sad': ({'saturation': -4.0, 'blue_cast': 3.0, 'dark_fraction': 3.0, 'brightness': -2.0}, 1.0),
+    'sketch': ({'edge_density': 12.0, 'colorfulness': -3.0, 'gray_fraction': 2.0}, -0.5),
+}
+
+
+def _thumbnail(img: Image.Image) -> np.ndarray:
+    """
+    長辺 FEATURE_EDGE の RGB 配列を作る（原寸のコピーは作らない）。
+    """
+    scale = min(1.0, FEATURE_EDGE / max(img.size))
+    size = (max(1, round(img.size[0] * scale)), max(1, round(img.size[1] * scale)))
+    small = img.resize(size, Image.BOX, reducing_gap=2.0) if scale < 1.0 else img
+    return np.asarray(small if small.mode == "RGB" else small.convert("RGB"))
+
+
+def extract_features(img: Image.Image) -> Dict[str, float]:
+    """
+    縮小画像からスタイル判定用の特徴量を計算する。
+    brightness / saturation: HSV の V / S の平均
+    dark_fraction / gray_fraction: 暗い画素 (V < 60) / ほぼ無彩色の画素 (S < 30) の割合
+    blue_cast: (B - R) の平均（寒色寄りなら正）
+    colorfulness: Hasler & Süsstrunk の colorfulness / 100
+    edge_density: Canny のエッジ画素の割合
+    """
+    rgb = _thumbnail(img)
+    hsv = cv2.cvtColor(rgb, cv2.COLOR_RGB2HSV)
+    s = hsv[:, :, 1]
+    v = hsv[:, :, 2]
+
+    r, g, b = (rgb[:, :, i].astype(np.float32) for i in range(3))
+    rg = r - g
+    yb = 0.5 * (r + g) - b
+    colorfulness = np.sqrt(rg.std() ** 2 + yb.std() ** 2) + 0.3 * np.sqrt(rg.mean() ** 2 + yb.mean() ** 2)
+
+    gray = cv2.cvtColor(rgb, cv2.COLOR_RGB2GRAY)
+    edges = cv2.Canny(gray, 100, 200)
+
+    return {
+        'brightness': float(v.mean()) / 255,
+        'saturation': float(s.mean()) / 255,
+        'dark_fraction': float(np.count_nonzero(v < 60)) / v.size,
+        'gray_fraction': float(np.count_nonzero(s < 30)) / s.size,
+        'blue_cast': float((b - r).mean()) / 255,
+        'colorfulness': float(colorfulness) / 100,
+        'edge_density': float(np.count_nonzero(edges)) / edges.size,
+    }
+
+
+def style_scores(features: Dict[str, float]) -> Dict[str, float]:
+    """
+    特徴量から各スタイルの確率 (softmax) を返す。
+    """
+    logits = np.array([
+        sum(weight * features[name] for name, weight in STYLE_WEIGHTS[label][0].items()) + STYLE_WEIGHTS[label][1]
+        for label in STYLE_LABELS
+    ])
+    probs = np.exp(logits - logits.max())
+    probs /= probs.sum()
+    return {label: float(p) for label, p in zip(STYLE_LABELS, probs)}
+
+
+def classify_style(img: Image.Image) -> Tuple[str, float]:
+    """
+    画像のスタイルをローカルで判定し、(スタイル, 確信度 0〜1) を返す。
+    """
+    scores = style_scores(extract_features(img))
+    style = max(scores, key=scores.get)
+    return style, scores[style]
+
+
+def classify_style_file(path: str) -> Tuple[str, float]:
+    """
+    ファイルから直接判定する。JPEG は draft デコードで小さく読むので、原寸のデコードを待たない。
+    """
+    with Image.open(path) as img:
+        img.draft('RGB', (FEATURE_EDGE, FEATURE_EDGE))
+        return classify_style(img)
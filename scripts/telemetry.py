@@ -0,0 +1,148 @@
+import os
+import sys
+import json
+import time
+import bisect
+import threading
+import contextvars
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, Optional, Tuple
+
+# =================================================================
+# 処理段階ごとの計測 (JSON ログ + Prometheus テキスト形式)
+# =================================================================
+# span(): 処理時間と属性を1行の JSON として stderr に出し、段階ごとのヒストグラムに加える。
+#   {"type": "span", "name": "decode", "ms": 12.3, "trace": "<写真ごとのID>", ...属性}
+# count(): キャッシュヒットや API に送ったバイト数などのカウンター。
+# TELEMETRY_PROM_DIR を指定すると、<dir>/<スクリプト名>.prom にヒストグラムとカウンターを書き出す
+# (node_exporter の textfile collector などで読み込める)。
+
+TELEMETRY_ENABLED = os.environ.get("TELEMETRY", "1") != "0"
+TELEMETRY_PROM_DIR = os.environ.get("TELEMETRY_PROM_DIR")
+# .prom ファイルを書き直す最短間隔 (秒)
+TELEMETRY_FLUSH_INTERVAL = float(os.environ.get("TELEMETRY_FLUSH_INTERVAL", "5"))
+
+SPAN_BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30]
+
+_trace_id: contextvars.ContextVar[Optional[str]] = contextvars.ContextVar("trace_id", default=None)
+
+_lock = threading.Lock()
+_write_lock = threading.Lock()
+# span 名 -> [バケットごとの件数..., +Inf], 合計秒数, 件数
+_histograms: Dict[str, Tuple[list, list]] = {}
+# (カウンター名, ラベルの組) -> 値
+_counters: Dict[Tuple[str, Tuple[Tuple[str, str], ...]], float] = {}
+_last_flush = 0.0
+
+
+@contextmanager
+def trace(trace_id: str) -> Iterator[None]:
+    """
+    この中で記録した span に trace_id を付ける（1枚の写真の span をまとめて追えるように）。
+    """
+    token = _trace_id.set(trace_id)
+    try:
+        yield
+    finally:
+        _trace_id.reset(token)
+
+
+def current_trace() -> Optional[str]:
+    return _trace_id.get()
+
+
+def observe(name: str, seconds: float) -> None:
+    with _lock:
+        buckets, totals = _histograms.setdefault(name, ([0] * (len(SPAN_BUCKETS) + 1), [0.0, 0]))
+        buckets[bisect.bisect_left(SPAN_BUCKETS, seconds)] += 1
+        totals[0] += seconds
+        totals[1] += 1
+
+
+@contextmanager
+def span(name: str, **attrs) -> Iterator[Dict[str, Any]]:
+    """
+    with span("decode", width=w) as s: ... s["bytes"] = n
+    のように使う。処理中に分かった値は返された辞書に追加する。
+    """
+    fields: Dict[str, Any] = dict(attrs)
+    start = time.perf_counter()
+    error = None
+    try:
+        yield fields
+    except Exception as e:
+        error = type(e).__name__
+        raise
+    finally:
+        seconds = time.perf_counter() - start
+        observe(name, seconds)
+        if TELEMETRY_ENABLED:
+            payload = {'type': 'span', 'name': name, 'ms': round(seconds * 1000, 2), 'trace': _trace_id.get()}
+            payload.update(fields)
+            if error:
+                payload['error'] = error
+            # 複数スレッドの行が混ざらないよう、改行まで1回で書き込む
+            line = json.dumps(payload, ensure_ascii=False, default=str) + "\n"
+            with _write_lock:
+                sys.stderr.write(line)
+                sys.stderr.flush()
+
+
+def count(name: str, value: float = 1, **labels) -> None:
+    key = (name, tuple(sorted((k, str(v)) for k, v in labels.items())))
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + value
+
+
+def _format_labels(labels: Tuple[Tuple[str, str], ...]) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{k}="{v}"' for k, v in labels) + "}"
+
+
+def render_prometheus() -> str:
+    """
+    現在のヒストグラムとカウンターを Prometheus のテキスト形式にする。
+    """
+    lines = [
+        "# HELP pipeline_span_seconds Duration of pipeline stages.",
+        "# TYPE pipeline_span_seconds histogram",
+    ]
+    with _lock:
+        for name, (buckets, (total, n)) in sorted(_histograms.items()):
+            cumulative = 0
+            for bound, c in zip(SPAN_BUCKETS + ["+Inf"], buckets):
+                cumulative += c
+                lines.append(f'pipeline_span_seconds_bucket{{span="{name}",le="{bound}"}} {cumulative}')
+            lines.append(f'pipeline_span_seconds_sum{{span="{name}"}} {total}')
+            lines.append(f'pipeline_span_seconds_count{{span="{name}"}} {n}')
+        seen = set()
+        for (name, labels), value in sorted(_counters.items()):
+            if name not in seen:
+                lines.append(f"# TYPE {name} counter")
+                seen.add(name)
+            lines.append(f"{name}{_format_labels(labels)} {value}")
+    return "\n".join(lines) + "\n"
+
+
+def flush(force: bool = False) -> None:
+    """
+    TELEMETRY_PROM_DIR が指定されていれば .prom ファイルを書き直す (一時ファイル + rename)。
+    """
+    global _last_flush
+    if not TELEMETRY_PROM_DIR:
+        return
+    now = time.monotonic()
+    if not force and now - _last_flush < TELEMETRY_FLUSH_INTERVAL:
+        return
+    _last_flush = now
+    script = os.path.splitext(os.path.basename(sys.argv[0] or "python"))[0] or "python"
+    path = os.path.join(TELEMETRY_PROM_DIR, f"{script}.prom")
+    try:
+        os.makedirs(TELEMETRY_PROM_DIR, exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(render_prometheus())
+        os.replace(tmp_path, path)
+    except OSError as e:
+        print(f"Telemetry Warning: could not write {path}: {e}", file=sys.stderr)
@@ -0,0 +1,292 @@
+import os
+import sys
+from typing import Callable, Iterator, List, Tuple
+
+import cv2
+import numpy as np
+from PIL import Image
+
+# =================================================================
+# タイル処理 (巨大な画像をメモリ上限内で処理する)
+# =================================================================
+# 入力の Pillow 画像から、のりしろ (halo) 付きの領域だけを切り出して NumPy に変換し、
+# 処理結果を出力画像へ順に貼り付けていく。全体の NumPy コピーや中間画像は作らない。
+#
+# enhance_image の CLAHE は画像全体を 8x8 のタイルに分けてヒストグラムを取り、隣り合うタイルの LUT を
+# 画素の位置で補間する。領域ごとに cv2.CLAHE をかけると補間の重みが領域内の座標で計算され、
+# 全体処理と数階調ずれる画素が出るので、タイル処理では
+#   1. 横帯ごとに L を計算して CLAHE タイルごとのヒストグラムを集め、OpenCV と同じ手順で全体の LUT を作る
+#   2. 横帯ごとに、画像全体の座標で OpenCV と同じ float32 の式で LUT を補間する
+# の2パスにする。結果は全体処理 (cv2.createCLAHE().apply) とビット単位で一致する
+# (benchmark.py の一致確認で確かめている)。
+
+# 作業用メモリの上限。画像がこれを超えそうな場合にタイル処理に切り替える
+TILE_MEMORY_BUDGET_MB = int(os.environ.get("TILE_MEMORY_BUDGET_MB", "1024"))
+
+# 1画素あたりの作業メモリ量の目安 (入力・LAB・HSV・ぼかし・出力などの uint8 3ch バッファ)
+WORKING_BYTES_PER_PIXEL = 30
+
+# CLAHE の LUT を補間するときに増える1画素あたりの作業メモリ (float32 の中間値)
+CLAHE_BYTES_PER_PIXEL = 16
+
+# アンシャープマスクのために横帯の上下に付けるのりしろ (ガウスぼかしの半径以上であること)
+SHARPEN_HALO = 8
+
+# 横帯を切り出すたびに増えるコピー (crop した Pillow 画像・np.asarray・貼り付け用の Image.fromarray)
+REGION_COPY_BYTES_PER_PIXEL = 9
+
+# 横帯1本の作業メモリの上限 (MB)。大きくしても速くならず、ピークメモリが全体処理より増えるだけなので小さく保つ
+TILE_BAND_MB = int(os.environ.get("TILE_BAND_MB", "64"))
+
+
+def should_tile(img_pil: Image.Image, budget_mb: int = TILE_MEMORY_BUDGET_MB) -> bool:
+    width, height = img_pil.size
+    return width * height * WORKING_BYTES_PER_PIXEL > budget_mb * 1024 * 1024
+
+
+def clahe_tile_geometry(width: int, height: int, grid: Tuple[int, int] = (8, 8)) -> Tuple[int, int]:
+    """
+    cv2.createCLAHE(tileGridSize=grid).apply と同じ規則でタイルサイズ (tile_w, tile_h) を返す。
+    OpenCV は幅か高さのどちらかが割り切れないと、両方を右下方向に BORDER_REFLECT_101 で拡張する。
+    """
+    tiles_x, tiles_y = grid
+    if width % tiles_x == 0 and height % tiles_y == 0:
+        return width // tiles_x, height // tiles_y
+    ext_w = width + tiles_x - (width % tiles_x)
+    ext_h = height + tiles_y - (height % tiles_y)
+    return ext_w // tiles_x, ext_h // tiles_y
+
+
+def band_budget(width: int, height: int, budget_bytes: int) -> int:
+    """
+    横帯1本に使ってよい作業メモリ (バイト)。
+    デコード済みの入力と原寸の出力 (どちらも RGB 3 バイト/画素) は処理の間ずっと残るので予算から引き、
+    さらに TILE_BAND_MB で抑える。
+    """
+    resident = width * height * 3 * 2
+    return max(0, min(TILE_BAND_MB * 1024 * 1024, budget_bytes - resident))
+
+
+def iter_bands(width: int, height: int, budget_bytes: int, bytes_per_pixel: int = WORKING_BYTES_PER_PIXEL) -> Iterator[Tuple[int, int]]:
+    """
+    画素ごとに独立した処理用に、横帯 (y0, y1) を順に返す。
+    1本の大きさは band_budget と、切り出しのコピー (REGION_COPY_BYTES_PER_PIXEL) を含めた bytes_per_pixel で決める。
+    """
+    band_bytes = band_budget(width, height, budget_bytes)
+    rows = max(1, band_bytes // max(1, width * (bytes_per_pixel + REGION_COPY_BYTES_PER_PIXEL)))
+    for y0 in range(0, height, rows):
+        yield y0, min(y0 + rows, height)
+
+
+def read_region(img_pil: Image.Image, box: Tuple[int, int, int, int], pad: Tuple[int, int] = (0, 0)) -> np.ndarray:
+    """
+    Pillow 画像の box 部分だけを RGB の NumPy 配列にし、右・下を BORDER_REFLECT_101 で拡張する。
+    """
+    region = np.asarray(img_pil.crop(box))
+    pad_x, pad_y = pad
+    if pad_x or pad_y:
+        region = cv2.copyMakeBorder(region, 0, pad_y, 0, pad_x, cv2.BORDER_REFLECT_101)
+    return region
+
+
+# =================================================================
+# 画像全体の CLAHE (横帯ごとに計算する)
+# =================================================================
+
+def _luminance(region: np.ndarray) -> np.ndarray:
+    # enhance_image と同じく RGB → LAB の L
+    return cv2.extractChannel(cv2.cvtColor(region, cv2.COLOR_RGB2LAB), 0)
+
+
+def _clip_histogram(hist: np.ndarray, clip_limit: int) -> np.ndarray:
+    """
+    OpenCV の CLAHE と同じ手順で、clip_limit を超えた分を全体に配り直す (端数は等間隔に1ずつ)。
+    """
+    clipped = int(np.maximum(hist - clip_limit, 0).sum())
+    hist = np.minimum(hist, clip_limit)
+    batch, residual = divmod(clipped, 256)
+    hist += batch
+    if residual:
+        step = max(256 // residual, 1)
+        hist[np.arange(0, 256, step)[:residual]] += 1
+    return hist
+
+
+def clahe_luts(
+    img_pil: Image.Image,
+    clip_limit: float,
+    grid: Tuple[int, int] = (8, 8),
+    budget_bytes: int = TILE_MEMORY_BUDGET_MB * 1024 * 1024
+) -> Tuple[np.ndarray, Tuple[int, int]]:
+    """
+    画像全体の CLAHE の LUT (tiles_y, tiles_x, 256) と CLAHE のタイルサイズ (tile_w, tile_h) を返す。
+    L は横帯ごとに計算し、原寸の配列は作らない。割り切れない大きさの画像は OpenCV と同じく
+    右・下を BORDER_REFLECT_101 で拡張した画像のヒストグラムを取る。
+    """
+    width, height = img_pil.size
+    tiles_x, tiles_y = grid
+    tile_w, tile_h = clahe_tile_geometry(width, height, grid)
+    pad_x, pad_y = tiles_x * tile_w - width, tiles_y * tile_h - height
+    hists = np.zeros((tiles_y, tiles_x, 256), np.int64)
+
+    def accumulate(ty: int, rows: np.ndarray) -> None:
+        for tx in range(tiles_x):
+            hists[ty, tx] += np.bincount(rows[:, tx * tile_w:(tx + 1) * tile_w].ravel(), minlength=256)
+
+    for y0, y1 in iter_bands(width, height, budget_bytes, bytes_per_pixel=12):
+        l = _luminance(read_region(img_pil, (0, y0, width, y1), (pad_x, 0)))
+        for ty in range(y0 // tile_h, (y1 - 1) // tile_h + 1):
+            r0, r1 = max(y0, ty * tile_h), min(y1, (ty + 1) * tile_h)
+            accumulate(ty, l[r0 - y0:r1 - y0])
+        # 下に拡張した pad_y 行は、行 height - 2 から上へ pad_y 行分の鏡像 (最後のタイル行に入る)
+        m0, m1 = max(y0, height - 1 - pad_y), min(y1, height - 1)
+        if pad_y and m0 < m1:
+            accumulate(tiles_y - 1, l[m0 - y0:m1 - y0])
+
+    total = tile_w * tile_h
+    limit = max(int(clip_limit * total / 256), 1) if clip_limit > 0 else 0
+    scale = np.float32(255) / np.float32(total)
+    luts = np.empty((tiles_y, tiles_x, 256), np.uint8)
+    for ty in range(tiles_y):
+        for tx in range(tiles_x):
+            hist = _clip_histogram(hists[ty, tx], limit) if limit else hists[ty, tx]
+            luts[ty, tx] = np.clip(np.rint(np.cumsum(hist).astype(np.float32) * scale), 0, 255)
+    return luts, (tile_w, tile_h)
+
+
+def _interpolation_weights(offset: int, count: int, tile: int, tiles: int) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    # OpenCV の CLAHE_Interpolation_Body と同じ float32 の計算 (座標は画像全体のもの)
+    position = np.arange(offset, offset + count, dtype=np.float32) * (np.float32(1) / np.float32(tile)) - np.float32(0.5)
+    lower = np.floor(position)
+    weight = position - lower
+    lower = lower.astype(np.int32)
+    return weight, np.maximum(lower, 0), np.minimum(lower + 1, tiles - 1)
+
+
+def _runs(lower: np.ndarray, upper: np.ndarray) -> List[Tuple[int, int]]:
+    # (lower, upper) が同じ値の連続区間 [start, end) のリスト
+    change = np.flatnonzero((np.diff(lower) != 0) | (np.diff(upper) != 0)) + 1
+    bounds = [0, *change.tolist(), len(lower)]
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def apply_clahe_luts(
+    l: np.ndarray,
+    luts: np.ndarray,
+    tile_size: Tuple[int, int],
+    origin: Tuple[int, int] = (0, 0),
+    dst: np.ndarray = None
+) -> np.ndarray:
+    """
+    clahe_luts の LUT を、画像の origin (x0, y0) から切り出した L チャンネル l に適用する。
+    補間に使う4つの LUT が同じになる区画ごとに cv2.LUT で引き、OpenCV と同じ順で
+    (p11 * xa1 + p12 * xa) * ya1 + (p21 * xa1 + p22 * xa) * ya を計算する。
+    """
+    tiles_y, tiles_x, _ = luts.shape
+    height, width = l.shape
+    xa, x1, x2 = _interpolation_weights(origin[0], width, tile_size[0], tiles_x)
+    ya, y1, y2 = _interpolation_weights(origin[1], height, tile_size[1], tiles_y)
+    xa1, ya1 = np.float32(1) - xa, np.float32(1) - ya
+    if dst is None:
+        dst = np.empty((height, width), np.uint8)
+
+    for r0, r1 in _runs(y1, y2):
+        for c0, c1 in _runs(x1, x2):
+            block = l[r0:r1, c0:c1]
+            wx, wx1 = xa[c0:c1], xa1[c0:c1]
+            top = cv2.LUT(block, luts[y1[r0], x1[c0]]).astype(np.float32)
+            top *= wx1
+            top += cv2.LUT(block, luts[y1[r0], x2[c0]]).astype(np.float32) * wx
+            top *= ya1[r0:r1, None]
+            bottom = cv2.LUT(block, luts[y2[r0], x1[c0]]).astype(np.float32)
+            bottom *= wx1
+            bottom += cv2.LUT(block, luts[y2[r0], x2[c0]]).astype(np.float32) * wx
+            bottom *= ya[r0:r1, None]
+            top += bottom
+            np.rint(top, out=top)
+            np.clip(top, 0, 255, out=top)
+            dst[r0:r1, c0:c1] = top
+    return dst
+
+
+# =================================================================
+# タイル版フィルター
+# =================================================================
+
+def enhance_tiled(
+    img_pil: Image.Image,
+    kernel: Callable[[np.ndarray, Callable[[np.ndarray, np.ndarray], np.ndarray]], np.ndarray],
+    sharpen: Callable[[np.ndarray], np.ndarray],
+    clip_limit: float,
+    budget_mb: int = TILE_MEMORY_BUDGET_MB
+) -> Image.Image:
+    """
+    enhance_image のタイル版。CLAHE の LUT を画像全体で作ってから、横帯ごとに処理する。
+    kernel(region, equalize): CLAHE と彩度調整を行い、同じサイズの RGB 配列を返す
+        (CLAHE は equalize(l, dst) で行う。region の位置に合わせた全体の LUT が適用される)
+    sharpen(region): アンシャープマスクを行う（ガウスぼかしの半径 <= SHARPEN_HALO であること）
+    """
+    img_pil = img_pil if img_pil.mode == "RGB" else img_pil.convert("RGB")
+    width, height = img_pil.size
+    output = Image.new("RGB", (width, height))
+    budget = budget_mb * 1024 * 1024
+    luts, tile_size = clahe_luts(img_pil, clip_limit, (8, 8), budget)
+
+    for y0, y1 in iter_bands(width, height, budget, WORKING_BYTES_PER_PIXEL + CLAHE_BYTES_PER_PIXEL):
+        # ぼかしが全体処理と同じになるよう、上下にのりしろを付けて切り出す
+        ry0, ry1 = max(0, y0 - SHARPEN_HALO), min(height, y1 + SHARPEN_HALO)
+        region = read_region(img_pil, (0, ry0, width, ry1))
+        vivid = kernel(region, lambda l, dst: apply_clahe_luts(l, luts, tile_size, (0, ry0), dst))
+        sharp = sharpen(vivid)
+        output.paste(Image.fromarray(np.ascontiguousarray(sharp[y0 - ry0:y1 - ry0])), (0, y0))
+
+    print(f"Tiled enhance: {width}x{height}, budget {budget_mb} MB", file=sys.stderr)
+    return output
+
+
+def pointwise_tiled(
+    img_pil: Image.Image,
+    kernel: Callable[[np.ndarray], np.ndarray],
+    budget_mb: int = TILE_MEMORY_BUDGET_MB
+) -> Image.Image:
+    """
+    画素ごとに独立した色変換 (sad_filter など) のタイル版。のりしろは不要。
+    """
+    img_pil = img_pil if img_pil.mode == "RGB" else img_pil.convert("RGB")
+    width, height = img_pil.size
+    output = Image.new("RGB", (width, height))
+    for y0, y1 in iter_bands(width, height, budget_mb * 1024 * 1024):
+        band = read_region(img_pil, (0, y0, width, y1))
+        output.paste(Image.fromarray(kernel(band)), (0, y0))
+    return output
+
+
+def guided_upsample_tiled(
+    img_pil: Image.Image,
+    coefficients: Tuple[np.ndarray, np.ndarray],
+    budget_mb: int = TILE_MEMORY_BUDGET_MB
+) -> Image.Image:
+    """
+    Fast Guided Filter の係数 (a, b)（低解像度）を横帯ごとに原寸へ拡大して適用する。
+    out = a * gray + 255 * b。係数の拡大は cv2.resize(INTER_LINEAR) と同じ座標対応で remap する。
+    """
+    img_pil = img_pil if img_pil.mode == "RGB" else img_pil.convert("RGB")
+    width, height = img_pil.size
+    a_small, b_small = coefficients
+    sh, sw = a_small.shape
+    output = Image.new("RGB", (width, height))
+
+    map_x = ((np.arange(width, dtype=np.float32) + 0.5) * (sw / width) - 0.5).reshape(1, -1)
+    # 帯ごとに remap 用の座標 2 枚・係数 2 枚・積 (いずれも float32) と RGB・グレーを持つ
+    for y0, y1 in iter_bands(width, height, budget_mb * 1024 * 1024, bytes_per_pixel=36):
+        map_y = ((np.arange(y0, y1, dtype=np.float32) + 0.5) * (sh / height) - 0.5).reshape(-1, 1)
+        mx = np.broadcast_to(map_x, (y1 - y0, width)).astype(np.float32)
+        my = np.broadcast_to(map_y, (y1 - y0, width)).astype(np.float32)
+        a = cv2.remap(a_small, mx, my, cv2.INTER_LINEAR, borderMode=cv2.BORDER_REPLICATE)
+        b = cv2.remap(b_small, mx, my, cv2.INTER_LINEAR, borderMode=cv2.BORDER_REPLICATE)
+        gray = cv2.cvtColor(read_region(img_pil, (0, y0, width, y1)), cv2.COLOR_RGB2GRAY)
+        out = cv2.multiply(a, gray, dtype=cv2.CV_32F)
+        cv2.scaleAdd(b, 255.0, out, dst=out)
+        band = cv2.cvtColor(cv2.convertScaleAbs(out), cv2.COLOR_GRAY2RGB)
+        output.paste(Image.fromarray(band), (0, y0))
+    return output
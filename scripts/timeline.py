@@ -0,0 +1,268 @@
+import sys
+import os
+import json
+import math
+import argparse
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Tuple
+
+# =================================================================
+# 旅程 (timeline) の組み立て
+# =================================================================
+# 1回のアップロード分の写真のメタデータ (date_time / location) から mock_data.json と同じ形の
+#   {"trip_title", "timeline": [{"order_id", "display_time", "location": {"name", "latitude", "longitude"}, ...}]}
+# を作る。timeline の1件は1つの「立ち寄り地点 (stop)」で、複数の写真をまとめる。
+#   1. 撮影日時で並べる (O(n log n))
+#   2. 先頭から順に、直前の stop の中心から TIMELINE_STOP_RADIUS_M 以内かつ
+#      間隔が TIMELINE_STOP_GAP_MINUTES 以内の写真を同じ stop にまとめる (O(n))
+#   3. 同じ場所への再訪 (朝と夜のホテルなど) はグリッドの空間インデックスで探し、同じ place_id を付ける
+#      (周囲 3x3 セルだけを見るので1件あたり O(1)。全組み合わせの距離計算はしない)
+#   4. stop ごとの滞在時間と、前の stop からの距離 (haversine) を計算する
+# 地名 (location.name) は表示側で逆ジオコーディングするので None のまま返す。
+
+# 同じ stop とみなす距離 (メートル) と撮影間隔 (分)
+TIMELINE_STOP_RADIUS_M = float(os.environ.get("TIMELINE_STOP_RADIUS_M", "250"))
+TIMELINE_STOP_GAP_MINUTES = float(os.environ.get("TIMELINE_STOP_GAP_MINUTES", "120"))
+
+EARTH_RADIUS_M = 6371008.8
+# 緯度1度あたりの距離 (メートル)
+METERS_PER_DEGREE = math.pi * EARTH_RADIUS_M / 180
+
+
+def haversine_m(lat1: float, lon1: float, lat2: float, lon2: float) -> float:
+    """
+    2点間の大円距離 (メートル)。
+    """
+    phi1, phi2 = math.radians(lat1), math.radians(lat2)
+    dphi = phi2 - phi1
+    dlambda = math.radians(lon2 - lon1)
+    a = math.sin(dphi / 2) ** 2 + math.cos(phi1) * math.cos(phi2) * math.sin(dlambda / 2) ** 2
+    return 2 * EARTH_RADIUS_M * math.asin(min(1.0, math.sqrt(a)))
+
+
+class GridIndex:
+    """
+    緯度経度を cell_m 四方のセルに分けた空間インデックス。
+    cell_m 以内の点は必ず周囲 3x3 セルのどこかにあるので、検索はそこだけを見る。
+    セルの経度方向の幅は行 (緯度帯) ごとに、極に近い側の緯度で cell_m 以上になるように決める
+    (経度 ±180 度をまたぐ点どうしは別のセルになり、見つからない)。
+    """
+
+    def __init__(self, cell_m: float):
+        self.cell_m = cell_m
+        self._cells: Dict[Tuple[int, int], List[Tuple[float, float, Any]]] = {}
+
+    def _row(self, lat: float) -> int:
+        return math.floor(lat * METERS_PER_DEGREE / self.cell_m)
+
+    def _column(self, row: int, lon: float) -> int:
+        edge = min(90.0, max(abs(row), abs(row + 1)) * self.cell_m / METERS_PER_DEGREE)
+        width = self.cell_m / (METERS_PER_DEGREE * max(1e-9, math.cos(math.radians(edge))))
+        return math.floor(lon / width)
+
+    def _cell(self, lat: float, lon: float) -> Tuple[int, int]:
+        row = self._row(lat)
+        return row, self._column(row, lon)
+
+    def add(self, lat: float, lon: float, value: Any) -> None:
+        self._cells.setdefault(self._cell(lat, lon), []).append((lat, lon, value))
+
+    def nearest(self, lat: float, lon: float, max_m: float) -> Optional[Any]:
+        """
+        max_m (<= cell_m) 以内で最も近い点の値を返す（なければ None）。
+        """
+        row = self._row(lat)
+        best, best_distance = None, max_m
+        for r in (row - 1, row, row + 1):
+            column = self._column(r, lon)
+            for c in (column - 1, column, column + 1):
+                for other_lat, other_lon, value in self._cells.get((r, c), ()):
+                    distance = haversine_m(lat, lon, other_lat, other_lon)
+                    if distance <= best_distance:
+                        best, best_distance = value, distance
+        return best
+
+
+def _parse_time(value: Any) -> Optional[datetime]:
+    """
+    撮影日時を naive (撮影地の現地時刻) にそろえて返す。
+    Exif の DateTimeOriginal はオフセットなし、OffsetTimeOriginal があればオフセット付きになるので、
+    両方が混ざっても比較できるようにオフセットは捨て、記録された現地時刻をそのまま使う。
+    """
+    if not isinstance(value, str):
+        return None
+    try:
+        return datetime.fromisoformat(value).replace(tzinfo=None)
+    except ValueError:
+        return None
+
+
+def _parse_location(value: Any) -> Optional[Tuple[float, float]]:
+    if not isinstance(value, dict):
+        return None
+    lat, lon = value.get('latitude'), value.get('longitude')
+    if isinstance(lat, (int, float)) and isinstance(lon, (int, float)) and -90 <= lat <= 90 and -180 <= lon <= 180:
+        return float(lat), float(lon)
+    return None
+
+
+class _Stop:
+    def __init__(self, index: int, time: datetime, location: Optional[Tuple[float, float]]):
+        self.photos = [index]
+        self.start = self.end = time
+        self._sum_lat = self._sum_lon = 0.0
+        self._located = 0
+        if location:
+            self._add_location(location)
+
+    def _add_location(self, location: Tuple[float, float]) -> None:
+        self._sum_lat += location[0]
+        self._sum_lon += location[1]
+        self._located += 1
+
+    @property
+    def center(self) -> Optional[Tuple[float, float]]:
+        if not self._located:
+            return None
+        return self._sum_lat / self._located, self._sum_lon / self._located
+
+    def accepts(self, time: datetime, location: Optional[Tuple[float, float]], radius_m: float, gap_minutes: float) -> bool:
+        if (time - self.end).total_seconds() > gap_minutes * 60:
+            return False
+        center = self.center
+        # 位置のない写真は時間だけで判断する
+        return location is None or center is None or haversine_m(*center, *location) <= radius_m
+
+    def add(self, index: int, time: datetime, location: Optional[Tuple[float, float]]) -> None:
+        self.photos.append(index)
+        self.end = time
+        if location:
+            self._add_location(location)
+
+
+def _image_entry(item: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    renditions = item.get('renditions') or {}
+    url = renditions.get('web') or item.get('filepath')
+    return {'url': url, 'thumbnail': renditions.get('thumb') or url} if url else None
+
+
+def _ux_assets(item: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    effects = item.get('effects') or {}
+    if not effects:
+        return None
+    return {
+        'stamp_image': os.path.basename(effects['stamp']) if effects.get('stamp') else None,
+        'music_file': os.path.basename(effects['sound']) if effects.get('sound') else None,
+    }
+
+
+def _trip_title(start: datetime, end: datetime) -> str:
+    if start.date() == end.date():
+        return f"{start:%Y/%m/%d}の旅"
+    return f"{start:%Y/%m/%d}〜{end:%m/%d}の旅"
+
+
+def build_timeline(
+    items: List[Dict[str, Any]],
+    radius_m: float = TIMELINE_STOP_RADIUS_M,
+    gap_minutes: float = TIMELINE_STOP_GAP_MINUTES
+) -> Dict[str, Any]:
+    """
+    写真のメタデータ (process_image / metadata.scan の出力、decide_effects の結果を結合したもの) から旅程を作る。
+    timeline[].photos は items のインデックス。撮影日時のない写真は unplaced に入れる。
+    """
+    dated = []
+    unplaced = []
+    for index, item in enumerate(items):
+        time = _parse_time(item.get('date_time'))
+        if time is None:
+            unplaced.append(index)
+        else:
+            dated.append((time, index, _parse_location(item.get('location'))))
+    dated.sort(key=lambda row: (row[0], row[1]))
+
+    stops: List[_Stop] = []
+    for time, index, location in dated:
+        if stops and stops[-1].accepts(time, location, radius_m, gap_minutes):
+            stops[-1].add(index, time, location)
+        else:
+            stops.append(_Stop(index, time, location))
+
+    places = GridIndex(radius_m)
+    place_count = 0
+    timeline = []
+    previous_center = None
+    total_distance_m = 0.0
+    for order_id, stop in enumerate(stops, start=1):
+        center = stop.center
+        entry: Dict[str, Any] = {
+            'order_id': order_id,
+            'display_time': f"{stop.start:%H:%M}",
+            'date': stop.start.date().isoformat(),
+            'start_time': stop.start.isoformat(),
+            'end_time': stop.end.isoformat(),
+            'duration_minutes': round((stop.end - stop.start).total_seconds() / 60, 1),
+            'location': None,
+            'place_id': None,
+            'distance_from_previous_m': None,
+            'photo_count': len(stop.photos),
+            'photos': stop.photos,
+            'image': _image_entry(items[stop.photos[0]]),
+            'ux_assets': _ux_assets(items[stop.photos[0]]),
+        }
+        if center:
+            place_id = places.nearest(*center, radius_m)
+            if place_id is None:
+                place_count += 1
+                place_id = place_count
+                places.add(*center, place_id)
+            entry['place_id'] = place_id
+            entry['location'] = {'name': None, 'latitude': round(center[0], 6), 'longitude': round(center[1], 6)}
+            if previous_center:
+                distance = haversine_m(*previous_center, *center)
+                entry['distance_from_previous_m'] = round(distance, 1)
+                total_distance_m += distance
+            previous_center = center
+        timeline.append(entry)
+
+    return {
+        'trip_title': _trip_title(stops[0].start, stops[-1].end) if stops else None,
+        'timeline': timeline,
+        'summary': {
+            'photos': len(items),
+            'stops': len(stops),
+            'places': place_count,
+            'total_distance_km': round(total_distance_m / 1000, 3),
+            'duration_minutes': round((stops[-1].end - stops[0].start).total_seconds() / 60, 1) if stops else 0.0,
+        },
+        'unplaced': unplaced,
+    }
+
+
+def timeline_job(args: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    常駐ワーカー用のジョブハンドラ。
+    args: {"items": [画像メタデータ, ...]}
+    """
+    items = args.get('items', [])
+    if not isinstance(items, list):
+        items = [items]
+    return build_timeline(items)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build a trip timeline from photo metadata")
+    parser.add_argument("inputs", nargs="*", help="image files (Exif is read with metadata.scan)")
+    parser.add_argument("--results", default=None, help="results JSON ({imageData: [...]}) written by the server")
+    parser.add_argument("--radius", type=float, default=TIMELINE_STOP_RADIUS_M, help="stop radius in meters")
+    parser.add_argument("--gap", type=float, default=TIMELINE_STOP_GAP_MINUTES, help="max minutes between photos of a stop")
+    args = parser.parse_args()
+
+    if args.results:
+        with open(args.results, encoding='utf-8') as f:
+            items = json.load(f).get('imageData', [])
+    else:
+        sys.path.append(os.path.dirname(__file__))
+        from metadata import scan
+        items = scan(args.inputs)
+    print(json.dumps(build_timeline(items, args.radius, args.gap), indent=2, ensure_ascii=False))
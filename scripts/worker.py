@@ -0,0 +1,67 @@
+import sys
+import json
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict
+
+# =================================================================
+# 常駐ワーカー (NDJSON over stdin/stdout)
+# =================================================================
+# Node.js から1行1ジョブの JSON を受け取り、1行1結果の JSON を返す。
+#   入力: {"id": 1, "op": "process_image", "args": {...}}
+#   出力: {"id": 1, "ok": true, "result": {...}}
+#         {"id": 1, "ok": false, "error": "..."}
+# stdout はプロトコル専用。ログは従来どおり stderr に出力すること。
+
+Handler = Callable[[Dict[str, Any]], Any]
+
+
+def serve(handlers: Dict[str, Handler], concurrency: int = 1) -> None:
+    """
+    stdin から JSON ジョブを読み続け、対応するハンドラを実行して結果を stdout に書き出す。
+    concurrency > 1 の場合はスレッドプールで並行実行する（結果の順序はジョブ完了順）。
+    stdin が閉じられたら実行中のジョブを待ってから終了する。
+    """
+    write_lock = threading.Lock()
+
+    def respond(payload: Dict[str, Any]) -> None:
+        line = json.dumps(payload, ensure_ascii=False)
+        with write_lock:
+            sys.stdout.write(line + "\n")
+            sys.stdout.flush()
+
+    def run(job: Any) -> None:
+        # id がないと呼び出し側は応答を待ち続けるので、形が不正なジョブにも必ずエラーを返す
+        if not isinstance(job, dict) or job.get("id") is None:
+            print(f"Worker received a malformed job: {job!r}", file=sys.stderr)
+            respond({"id": None, "ok": False, "error": "Malformed job: expected an object with an id"})
+            return
+        job_id = job.get("id")
+        op = job.get("op")
+        handler = handlers.get(op) if isinstance(op, str) else None
+        if handler is None:
+            respond({"id": job_id, "ok": False, "error": f"Unknown op: {op}"})
+            return
+        try:
+            args = job.get("args") or {}
+            if not isinstance(args, dict):
+                raise ValueError("args must be an object")
+            result = handler(args)
+            respond({"id": job_id, "ok": True, "result": result})
+        except Exception as e:
+            print(f"Worker job {job_id} ({op}) failed: {e}", file=sys.stderr)
+            respond({"id": job_id, "ok": False, "error": str(e)})
+
+    print(f"Worker ready (ops: {', '.join(handlers)}, concurrency: {concurrency})", file=sys.stderr)
+    with ThreadPoolExecutor(max_workers=max(1, concurrency)) as executor:
+        for raw in sys.stdin:
+            raw = raw.strip()
+            if not raw:
+                continue
+            try:
+                job = json.loads(raw)
+            except json.JSONDecodeError as e:
+                print(f"Worker received invalid JSON: {e}", file=sys.stderr)
+                respond({"id": None, "ok": False, "error": f"Invalid JSON: {e}"})
+                continue
+            executor.submit(run, job)